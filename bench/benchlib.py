@@ -0,0 +1,130 @@
+import importlib.util
+import logging
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN_FILE = os.path.join(BASE_DIR, "main.py")
+PROMPT_DIR = os.path.join(BASE_DIR, "prompt")
+WEB_DIR = os.path.join(BASE_DIR, "web")
+# 合成提示词时随机插入的片段：可选项、文档标题、占位符与可选步骤。
+PROMPT_EXTRAS = [
+    "\n### 可选描述\n- 方案A {{context}}\n- 方案B\n1) 方案C\n\n",
+    "\n《用户手册》说明\n",
+    "\n---\n**注意**\n{{input}} {{options}}\n",
+    "\n## STEP 3｜交付物 D3（可选）\n### 文档说明\n内容\n",
+]
+SEARCH_LATIN_WORDS = (
+    "api sdk json http token model redis mysql kafka docker vue react login oauth webhook "
+    "cache queue etl dashboard report export"
+).split()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(len(ordered) * fraction + 0.5) - 1))]
+
+
+def bundled_prompts():
+    texts = []
+    for root, _, files in os.walk(PROMPT_DIR):
+        for name in sorted(files):
+            if name.endswith(".md"):
+                with open(os.path.join(root, name), "r", encoding="utf-8") as handle:
+                    texts.append(handle.read())
+    if not texts:
+        raise SystemExit(f"未找到内置提示词: {PROMPT_DIR}")
+    return texts
+
+
+def build_prompt_library(root, count, seed=7, per_dir=50):
+    # 以内置提示词为底本，随机插入片段生成 count 个变体；每 10 个带一段路由 front matter。
+    rng = random.Random(seed)
+    sources = bundled_prompts()
+    paths = []
+    for index in range(count):
+        lines = rng.choice(sources).splitlines()
+        for _ in range(rng.randint(0, 6)):
+            lines.insert(rng.randint(0, len(lines)), rng.choice(PROMPT_EXTRAS))
+        if index % 10 == 0:
+            lines.insert(0, "---\nroutes:\n  1: fast@a\n---")
+        relative = os.path.join(f"g{index // per_dir:02d}", f"p{index:04d}.md")
+        os.makedirs(os.path.join(root, os.path.dirname(relative)), exist_ok=True)
+        with open(os.path.join(root, relative), "w", encoding="utf-8") as handle:
+            handle.write("\n".join(lines))
+        paths.append(relative)
+    return paths
+
+
+def build_search_library(root, count, seed=43, per_dir=500):
+    # 检索基准用的大规模提示词库：词表取自内置提示词中的汉字片段，按 Zipf 分布抽词成句。
+    rng = random.Random(seed)
+    runs = re.findall(r"[一-鿿]{2,}", "".join(bundled_prompts()))
+    vocab = set()
+    for run in runs:
+        position = 0
+        while position < len(run) - 1:
+            size = rng.choice((2, 2, 3, 4))
+            vocab.add(run[position:position + size])
+            position += size
+    vocab = sorted(word for word in vocab if len(word) >= 2)
+    rng.shuffle(vocab)
+    weights = [1 / (rank + 1) for rank in range(len(vocab))]
+
+    def words(k):
+        return rng.choices(vocab, weights, k=k)
+
+    paths = []
+    for index in range(count):
+        lines = [f"🎯 Prompt｜{''.join(words(2))} → {''.join(words(2))}", ""]
+        for step in range(1, rng.randint(4, 8)):
+            lines.append(f"## STEP {step}｜{''.join(words(2))}")
+            for _ in range(rng.randint(4, 9)):
+                sentence = words(rng.randint(6, 14))
+                if rng.random() < 0.2:
+                    word = f" {rng.choice(SEARCH_LATIN_WORDS)} "
+                    sentence.insert(rng.randrange(len(sentence)), word)
+                lines.append("- " + "".join(sentence) + "。")
+            lines.append("")
+        relative = os.path.join(f"d{index // per_dir:02d}", f"p{index:05d}.md")
+        os.makedirs(os.path.join(root, os.path.dirname(relative)), exist_ok=True)
+        with open(os.path.join(root, relative), "w", encoding="utf-8") as handle:
+            handle.write("\n".join(lines))
+        paths.append(relative)
+    return paths
+
+
+def make_app_dir(main_file=MAIN_FILE, prompt_dir=None, prefix="bench-"):
+    # 独立的运行目录：复制 main.py，前端与提示词目录用符号链接，日志与数据互不干扰。
+    app_dir = tempfile.mkdtemp(prefix=prefix)
+    shutil.copy(main_file, os.path.join(app_dir, "main.py"))
+    os.symlink(WEB_DIR, os.path.join(app_dir, "web"))
+    os.symlink(prompt_dir or PROMPT_DIR, os.path.join(app_dir, "prompt"))
+    return app_dir
+
+
+def load_app(app_dir, name="bench_main"):
+    # 同一进程内可分别加载当前版本与对照版本（如 git show <rev>:main.py 导出的文件）。
+    spec = importlib.util.spec_from_file_location(name, os.path.join(app_dir, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    logging.disable(logging.INFO)
+    return module
+
+
+def start_server(module, ssl_context=None):
+    if hasattr(module, "rebuild_config_snapshot"):
+        module.rebuild_config_snapshot()
+    server = module.ThreadingHTTPServer(("127.0.0.1", 0), module.RequestHandler)
+    server.daemon_threads = True
+    if ssl_context is not None:
+        server.socket = ssl_context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
@@ -0,0 +1,104 @@
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from benchlib import MAIN_FILE, build_prompt_library, make_app_dir
+
+
+# 直连本机，不经过环境变量中的代理。
+OPENER = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def poll(url):
+    try:
+        with OPENER.open(url, timeout=5) as response:
+            response.read()
+        return True
+    except (OSError, urllib.error.URLError):
+        return False
+
+
+def run_once(app_dir, prompt_path, timeout):
+    # 从启动进程起计时：首个 /api/steps 成功响应与 /readyz 返回 200 的时间。
+    port = free_port()
+    env = dict(
+        os.environ,
+        PORT=str(port),
+        HOST="127.0.0.1",
+        PROMPT_PATH=prompt_path,
+        API_KEY="",
+        BASE_URL="",
+        WARMUP="1",
+        WORKERS="1",
+    )
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(app_dir, "main.py")],
+        env=env,
+        cwd=app_dir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    first = ready = None
+    try:
+        while first is None or ready is None:
+            if time.perf_counter() - start > timeout:
+                raise SystemExit("等待服务启动超时")
+            if first is None and poll(f"http://127.0.0.1:{port}/api/steps"):
+                first = time.perf_counter() - start
+            if ready is None and poll(f"http://127.0.0.1:{port}/readyz"):
+                ready = time.perf_counter() - start
+            time.sleep(0.005)
+    finally:
+        process.terminate()
+        process.wait()
+    return first, ready
+
+
+def measure(label, main_file, library, prompt_path, restarts, timeout):
+    app_dir = make_app_dir(main_file, library)
+    try:
+        for index in range(restarts + 1):
+            first, ready = run_once(app_dir, prompt_path, timeout)
+            name = "cold" if index == 0 else "restart"
+            print(
+                f"{label:8s} {name:7s} first /api/steps {first * 1000:6.0f} ms, "
+                f"ready {ready * 1000:6.0f} ms"
+            )
+    finally:
+        shutil.rmtree(app_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="冷启动与重启耗时基准（WARMUP=1）")
+    parser.add_argument("--files", type=int, default=1000, help="合成提示词数量")
+    parser.add_argument("--restarts", type=int, default=2, help="冷启动后的重启次数")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--baseline", help="对照版本的 main.py，如 git show <rev>:main.py 导出的文件")
+    args = parser.parse_args(argv)
+    library = tempfile.mkdtemp(prefix="bench-prompts-")
+    try:
+        paths = build_prompt_library(library, args.files)
+        print(f"files={len(paths)}")
+        if args.baseline:
+            measure("baseline", args.baseline, library, paths[0], args.restarts, args.timeout)
+        measure("current", MAIN_FILE, library, paths[0], args.restarts, args.timeout)
+    finally:
+        shutil.rmtree(library, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
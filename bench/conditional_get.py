@@ -0,0 +1,121 @@
+import argparse
+import http.client
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchlib import MAIN_FILE, load_app, make_app_dir, percentile, start_server
+
+
+def configure_environment(directory, endpoints):
+    # 多端点、多路由的配置让 /api/config 响应体接近实际部署（约 3KB）。
+    prompt_path = os.path.join(directory, "prompt.md")
+    with open(prompt_path, "w", encoding="utf-8") as handle:
+        handle.write(
+            "# 基准\n## STEP 0｜事实\n提取事实\n"
+            + "".join(f"## STEP {n}｜步骤{n}\n### 可选描述\n- 方案A\n- 方案B\n" for n in range(1, 9))
+        )
+    os.environ["SYSTEM_PROMPT_FILE"] = prompt_path
+    os.environ["WARMUP"] = "false"
+    os.environ["API_KEY"] = "sk-bench"
+    os.environ["LLM_ENDPOINTS"] = json.dumps(
+        [
+            {
+                "name": f"ep{n}",
+                "base_url": f"https://h{n}.example/v1/chat/completions",
+                "api_key": "sk-" + "x" * 40,
+                "weight": 1,
+            }
+            for n in range(endpoints)
+        ]
+    )
+    os.environ["LLM_ROUTES"] = json.dumps(
+        [{"step": n, "model": f"m{n}", "endpoint": f"ep{n}"} for n in range(1, endpoints + 1)]
+    )
+
+
+def time_serialization(module, count):
+    # 进程内单次生成 /api/config 响应体的耗时；带 public_payload 的版本直接复用已编码的字节。
+    snapshot = module.get_config_snapshot() if hasattr(module, "get_config_snapshot") else None
+    if snapshot is not None and hasattr(snapshot, "public_payload"):
+
+        def build():
+            return module.get_config_snapshot().public_payload[0]
+
+    else:
+
+        def build():
+            return json.dumps(
+                module.public_config(module.get_effective_config()), ensure_ascii=False
+            ).encode("utf-8")
+
+    build()
+    began = time.perf_counter()
+    for _ in range(count):
+        build()
+    return (time.perf_counter() - began) / count
+
+
+def poll(port, path, conditional, count):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    etag = None
+    latencies = []
+    received = statuses = 0
+    for _ in range(count):
+        headers = {"If-None-Match": etag} if conditional and etag else {}
+        began = time.perf_counter()
+        connection.request("GET", path, headers=headers)
+        response = connection.getresponse()
+        body = response.read()
+        latencies.append(time.perf_counter() - began)
+        etag = response.getheader("ETag") or etag
+        received += len(body)
+        statuses += response.status == 304
+    connection.close()
+    return latencies, received / count, statuses
+
+
+def measure(label, main_file, polls):
+    app_dir = make_app_dir(main_file)
+    module = load_app(app_dir, name=f"bench_{label}")
+    server, port = start_server(module)
+    try:
+        cost = time_serialization(module, 20000)
+        print(f"{label:8s} /api/config body build {cost * 1e6:.2f} us/request")
+        for path in ("/api/steps", "/api/config"):
+            for conditional in (False, True):
+                poll(port, path, conditional, 300)
+                latencies, size, not_modified = poll(port, path, conditional, polls)
+                print(
+                    f"{label:8s} {path:12s} {'If-None-Match' if conditional else 'plain':13s} "
+                    f"mean={sum(latencies) / len(latencies) * 1e6:6.0f} us "
+                    f"p99={percentile(latencies, 0.99) * 1e6:6.0f} us "
+                    f"body={size:6.0f} B/poll 304s={not_modified}"
+                )
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(app_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="/api/steps 与 /api/config 轮询的条件请求基准")
+    parser.add_argument("--polls", type=int, default=3000, help="每种组合的轮询次数")
+    parser.add_argument("--endpoints", type=int, default=20, help="配置中的端点与路由条数")
+    parser.add_argument("--baseline", help="对照版本的 main.py，如 git show <rev>:main.py 导出的文件")
+    args = parser.parse_args(argv)
+    directory = tempfile.mkdtemp(prefix="bench-etag-")
+    try:
+        configure_environment(directory, args.endpoints)
+        if args.baseline:
+            measure("baseline", args.baseline, args.polls)
+        measure("current", MAIN_FILE, args.polls)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
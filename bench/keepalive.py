@@ -0,0 +1,98 @@
+import argparse
+import http.client
+import os
+import shutil
+import ssl
+import sys
+import tempfile
+import time
+
+from benchlib import MAIN_FILE, load_app, make_app_dir, percentile, start_server
+
+# 模拟一次页面会话：加载页面的 6 个请求，加上 24 次生图任务轮询（任务不存在，返回 404）。
+SESSION = [
+    "/",
+    "/style.css",
+    "/app.js",
+    "/api/config",
+    "/api/image_config",
+    "/api/prompts",
+] + ["/api/image_jobs/0123456789ab"] * 24
+
+
+def measure(label, main_file, sessions, server_context, client_context):
+    app_dir = make_app_dir(main_file)
+    module = load_app(app_dir, name=f"bench_{label}")
+    server, port = start_server(module, server_context)
+    connects = [0]
+    base = http.client.HTTPSConnection if client_context else http.client.HTTPConnection
+    extra = {"context": client_context} if client_context else {}
+
+    class CountingConnection(base):
+        def connect(self):
+            connects[0] += 1
+            super().connect()
+
+    # 浏览器行为：服务端声明 Connection: close 或断开时，http.client 会自动重连。
+    def run_session():
+        connection = CountingConnection("127.0.0.1", port, timeout=10, **extra)
+        latencies = []
+        for path in SESSION:
+            began = time.perf_counter()
+            connection.request("GET", path)
+            connection.getresponse().read()
+            latencies.append(time.perf_counter() - began)
+        connection.close()
+        return latencies
+
+    try:
+        for _ in range(3):
+            run_session()
+        connects[0] = 0
+        latencies = []
+        began = time.perf_counter()
+        for _ in range(sessions):
+            latencies += run_session()
+        total = time.perf_counter() - began
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(app_dir, ignore_errors=True)
+    print(
+        f"{label:8s} {'tls' if client_context else 'tcp'} requests={len(latencies)} "
+        f"connects={connects[0]} per_session={total * 1000 / sessions:.1f} ms "
+        f"p50={percentile(latencies, 0.5) * 1000:.3f} ms p99={percentile(latencies, 0.99) * 1000:.3f} ms"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="浏览器式会话在持久连接下的连接数与耗时基准")
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--baseline", help="对照版本的 main.py，如 git show <rev>:main.py 导出的文件")
+    parser.add_argument("--cert", help="TLS 证书；与 --key 同时指定时在服务端套上 TLS")
+    parser.add_argument("--key", help="TLS 私钥")
+    args = parser.parse_args(argv)
+    server_context = client_context = None
+    if args.cert and args.key:
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(args.cert, args.key)
+        client_context = ssl.create_default_context()
+        client_context.check_hostname = False
+        client_context.verify_mode = ssl.CERT_NONE
+    # 固定一个最小提示词，避免依赖 prompt/ 下的选择状态。
+    directory = tempfile.mkdtemp(prefix="bench-keepalive-")
+    prompt_path = os.path.join(directory, "prompt.md")
+    with open(prompt_path, "w", encoding="utf-8") as handle:
+        handle.write("# 基准\n## STEP 1｜方案\n写方案\n")
+    os.environ["SYSTEM_PROMPT_FILE"] = prompt_path
+    os.environ["WARMUP"] = "false"
+    try:
+        if args.baseline:
+            measure("baseline", args.baseline, args.sessions, server_context, client_context)
+        measure("current", MAIN_FILE, args.sessions, server_context, client_context)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+import argparse
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchlib import MAIN_FILE, build_prompt_library, load_app, make_app_dir
+
+
+def make_compiler(module):
+    # 当前版本：decode_prompt_bytes + compile_prompt_text；单遍编译之前的版本只有 parse_system_prompt_file。
+    if hasattr(module, "compile_prompt_text"):
+
+        def compile_file(path):
+            with open(path, "rb") as handle:
+                return module.compile_prompt_text(module.decode_prompt_bytes(handle.read()))
+
+        return compile_file
+    return module.parse_system_prompt_file
+
+
+def comparable(result):
+    # 统一成单遍编译之前的字典结构，用于核对两版解析结果一致。
+    if isinstance(result, dict):
+        return (
+            result["steps"],
+            result["step_blocks"],
+            result["step0_block"],
+            result["assumption_step_id"],
+            result["base_prompt"],
+            result["routes"],
+        )
+    data = result.to_dict()
+    return (
+        [step["meta"] for step in data["steps"]],
+        {step.id: step.block for step in result.steps},
+        data["step0_block"],
+        data["assumption_step_id"],
+        data["base_prompt"],
+        data["routes"],
+    )
+
+
+def measure(label, main_file, paths, rounds):
+    app_dir = make_app_dir(main_file)
+    module = load_app(app_dir, name=f"bench_{label}")
+    compile_file = make_compiler(module)
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for path in paths:
+            compile_file(path)
+        best = min(best, time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    kept = [compile_file(path) for path in paths]
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results = [comparable(item) for item in kept]
+    del kept
+    shutil.rmtree(app_dir, ignore_errors=True)
+    print(
+        f"{label:8s} parse {best / len(paths) * 1000:.3f} ms/file, "
+        f"retained {retained / len(paths) / 1024:.1f} KB/file"
+    )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="提示词编译耗时与常驻内存基准")
+    parser.add_argument("--files", type=int, default=400, help="合成提示词数量")
+    parser.add_argument("--rounds", type=int, default=5, help="取最快一轮")
+    parser.add_argument("--baseline", help="对照版本的 main.py，如 git show <rev>:main.py 导出的文件")
+    args = parser.parse_args(argv)
+    root = tempfile.mkdtemp(prefix="bench-prompts-")
+    try:
+        paths = [os.path.join(root, item) for item in build_prompt_library(root, args.files)]
+        size = sum(os.path.getsize(path) for path in paths) / len(paths) / 1024
+        print(f"files={len(paths)} avg={size:.1f} KB")
+        expected = measure("baseline", args.baseline, paths, args.rounds) if args.baseline else None
+        results = measure("current", MAIN_FILE, paths, args.rounds)
+        if expected is not None:
+            mismatches = [path for path, a, b in zip(paths, expected, results) if a != b]
+            print(f"mismatches={len(mismatches)}")
+            for path in mismatches[:10]:
+                print(f"  {path}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+import argparse
+import gc
+import heapq
+import math
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+from benchlib import MAIN_FILE, build_search_library, load_app, make_app_dir, percentile
+
+
+def rss_mib():
+    # 仅 Linux：/proc/self/statm 第二列为常驻页数。
+    try:
+        with open("/proc/self/statm", "r") as handle:
+            return int(handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return 0.0
+
+
+def exhaustive_rank(module, index, terms, limit):
+    # 遍历全部倒排项的精确 BM25，作为召回率基准。
+    norms = index.norms
+    total = len(norms)
+    scores = {}
+    for term in terms:
+        entry = index.postings.get(term)
+        if not entry:
+            continue
+        ids, counts = entry
+        df = min(len(ids), total)
+        idf = math.log(1 + (total - df + 0.5) / (df + 0.5)) * (module.BM25_K1 + 1)
+        for doc_id, count in zip(ids, counts):
+            if doc_id in norms:
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * count / (count + norms[doc_id])
+    return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+
+def build_queries(library, paths, count, seed):
+    rng = random.Random(seed)
+    sample = ""
+    for position in (123, 4567, 8901):
+        with open(os.path.join(library, paths[position % len(paths)]), encoding="utf-8") as handle:
+            sample += handle.read()
+    words = sorted(set(re.findall(r"[一-鿿]{2,4}", sample)))
+    latin = ["api", "redis", "oauth", "webhook", "dashboard"]
+    return {
+        "cjk 2-4 chars": [rng.choice(words)[: rng.choice((2, 3, 4))] for _ in range(count)],
+        "two cjk phrases": [f"{rng.choice(words)} {rng.choice(words)}" for _ in range(count)],
+        "long cjk run": [rng.choice(words) + rng.choice(words) + rng.choice(words) for _ in range(count)],
+        "latin + cjk": [f"{rng.choice(latin)} {rng.choice(words)}" for _ in range(count)],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="/api/prompts/search 的 BM25 检索耗时与召回率基准")
+    parser.add_argument("--files", type=int, default=10000, help="合成提示词数量")
+    parser.add_argument("--queries", type=int, default=300, help="每类查询条数")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--main", default=MAIN_FILE, help="待测的 main.py，默认当前版本")
+    args = parser.parse_args(argv)
+    library = tempfile.mkdtemp(prefix="bench-search-")
+    app_dir = None
+    try:
+        start = time.perf_counter()
+        paths = build_search_library(library, args.files)
+        print(f"library: {len(paths)} files in {time.perf_counter() - start:.1f}s")
+        app_dir = make_app_dir(args.main, library)
+        module = load_app(app_dir)
+        index = module.PROMPT_SEARCH
+        # 先编译全部提示词，索引构建的耗时与内存只计入索引本身。
+        start = time.perf_counter()
+        for path in paths:
+            module.load_system_prompt_data(os.path.join(library, path))
+        print(f"compile: {time.perf_counter() - start:.1f}s")
+        gc.collect()
+        before = rss_mib()
+        start = time.perf_counter()
+        index.refresh(force=True)
+        build = time.perf_counter() - start
+        gc.collect()
+        snap = index.snapshot()
+        print(
+            f"index build: {build:.2f}s, {snap['docs']} docs, {snap['terms']} terms, "
+            f"{snap['postings']} postings, +{rss_mib() - before:.0f} MiB RSS"
+        )
+        print(
+            f"{'query class':16s} {'exhaustive':>10s} {'first-use':>10s} {'ranked p50/p99':>16s} "
+            f"{'+snippets p50':>14s} {'recall@' + str(args.limit):>10s}   (ms)"
+        )
+        for name, queries in build_queries(library, paths, args.queries, seed=1).items():
+            first, ranked, full, exact, recall = [], [], [], [], []
+            for query in queries:
+                terms = list(dict.fromkeys(module.tokenize_search_text(query)))
+                # 首次出现的高频词需要建 champion 列表，单独统计。
+                began = time.perf_counter()
+                index.rank(terms, args.limit)
+                first.append(time.perf_counter() - began)
+                began = time.perf_counter()
+                got = index.rank(terms, args.limit)
+                ranked.append(time.perf_counter() - began)
+                began = time.perf_counter()
+                index.search(query, args.limit)
+                full.append(time.perf_counter() - began)
+                began = time.perf_counter()
+                reference = exhaustive_rank(module, index, terms, args.limit)
+                exact.append(time.perf_counter() - began)
+                expected = {doc_id for doc_id, _ in reference}
+                found = {doc_id for doc_id, _ in got}
+                recall.append(len(expected & found) / max(1, len(expected)))
+            print(
+                f"{name:16s} {percentile(exact, 0.5) * 1000:10.2f} "
+                f"{percentile(first, 0.5) * 1000:10.2f} "
+                f"{percentile(ranked, 0.5) * 1000:7.2f} / {percentile(ranked, 0.99) * 1000:6.2f} "
+                f"{percentile(full, 0.5) * 1000:14.2f} {sum(recall) / len(recall):10.3f}"
+            )
+        # 增量刷新：改动一个文件并新增一个文件。
+        changed = os.path.join(library, paths[5])
+        with open(changed, "a", encoding="utf-8") as handle:
+            handle.write("\n- 独一无二的量子纠缠检索词。\n")
+        added = os.path.join(library, os.path.dirname(paths[0]), "zz_new.md")
+        with open(added, "w", encoding="utf-8") as handle:
+            handle.write("新增 quantum 提示词\n\n## STEP 1｜量子纠缠\n- 内容。")
+        start = time.perf_counter()
+        index.refresh(force=True)
+        elapsed = (time.perf_counter() - start) * 1000
+        hits = len(index.search("量子纠缠", 5)["results"])
+        print(f"incremental refresh (1 changed + 1 added): {elapsed:.0f} ms, hits={hits}")
+    finally:
+        shutil.rmtree(library, ignore_errors=True)
+        if app_dir:
+            shutil.rmtree(app_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,43 @@
 # -*- coding: utf-8 -*-
+from array import array
+import base64
+import binascii
+import bisect
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import fnmatch
+import gzip
+import hashlib
+import heapq
+import hmac
+import html
+import http.client
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import ipaddress
 import json
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, WatchedFileHandler
+import math
 import os
+import queue
+import random
 import re
+import selectors
+import signal
+import socket
+import sqlite3
+import ssl
+import sys
 import threading
 import time
+import tracemalloc
+import types
 import urllib.error
 import urllib.request
 import urllib.parse
 import uuid
+import zipfile
+import zlib
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 WEB_DIR = os.path.join(BASE_DIR, "web")
@@ -21,7 +48,10 @@ DEFAULT_BASE_URL = "https://api.qnaigc.com/v1/chat/completions"
 DEFAULT_IMAGE_ENDPOINT = "/images/generations"
 
 LOG_DIR = os.path.join(BASE_DIR, "logs")
+DATA_DIR = os.path.join(BASE_DIR, "data")
 LOG_FILE = os.path.join(LOG_DIR, "app.log")
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
 DEFAULT_SYSTEM_PROMPT_FILE = os.path.join(BASE_DIR, "prompt/需求分析.md")
 
 MAX_BODY_BYTES = 1_000_000
@@ -42,6 +72,16 @@ PHONE_RE = re.compile(r"\b1\d{10}\b")
 TOKEN_RE = re.compile(r"\b[A-Za-z0-9_\-]{20,}\b")
 KEY_RE = re.compile(r"(sk-[A-Za-z0-9]{8,})")
 BEARER_RE = re.compile(r"(?i)bearer\s+[A-Za-z0-9\-_.=]{8,}")
+PHONE_HINT_RE = re.compile(r"1\d{10}")
+# 脱敏预筛选：按字符对齐编码为 ASCII 后，把 TOKEN_RE 字符类映射为 a、其余映射为空格，
+# 用 C 层子串查找定位可能命中的片段，不可能命中的规则整条跳过。
+REDACT_WORD_BYTES = frozenset(
+    b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_-"
+)
+REDACT_RUN_TABLE = bytes(
+    ord("a") if code in REDACT_WORD_BYTES else ord(" ") for code in range(256)
+)
+REDACT_TOKEN_RUN = b"a" * 20
 
 
 def setup_logging():
@@ -55,7 +95,7 @@ def setup_logging():
         "%(asctime)s %(levelname)s [%(threadName)s] %(name)s: %(message)s"
     )
     file_handler = RotatingFileHandler(
-        LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=3, encoding="utf-8"
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
     )
     file_handler.setLevel(level)
     file_handler.setFormatter(formatter)
@@ -71,61 +111,142 @@ setup_logging()
 logger = logging.getLogger("app")
 
 
-def load_env_files():
+ENV_FILES = (".env", ".eny")
+# 由环境变量文件写入 os.environ 的键值，重新加载时据此更新或移除。
+ENV_FILE_VALUES = {}
+
+
+def read_env_file(path):
+    values = {}
+    with open(path, "r", encoding="utf-8") as handle:
+        for line in handle:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.lower().startswith("export "):
+                line = line[7:].strip()
+            if "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            key = key.strip()
+            value = value.strip()
+            if not key:
+                continue
+            if (value.startswith('"') and value.endswith('"')) or (
+                value.startswith("'") and value.endswith("'")
+            ):
+                value = value[1:-1]
+            values[key] = value
+    return values
+
+
+def get_env_files_mtime():
+    mtimes = []
+    for filename in ENV_FILES:
+        try:
+            mtimes.append(os.path.getmtime(os.path.join(BASE_DIR, filename)))
+        except OSError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+def load_env_files(reload=False):
     # Load .env (and .eny if present) without overriding existing env vars.
-    for filename in (".env", ".eny"):
+    # 重新加载时，之前由文件写入且未被外部改动的键会随文件更新或移除。
+    desired = {}
+    for filename in ENV_FILES:
         path = os.path.join(BASE_DIR, filename)
         if not os.path.isfile(path):
             continue
-        loaded_keys = []
         try:
-            with open(path, "r", encoding="utf-8") as handle:
-                for line in handle:
-                    line = line.strip()
-                    if not line or line.startswith("#"):
-                        continue
-                    if line.lower().startswith("export "):
-                        line = line[7:].strip()
-                    if "=" not in line:
-                        continue
-                    key, value = line.split("=", 1)
-                    key = key.strip()
-                    value = value.strip()
-                    if not key:
-                        continue
-                    if (value.startswith('"') and value.endswith('"')) or (
-                        value.startswith("'") and value.endswith("'")
-                    ):
-                        value = value[1:-1]
-                    if os.getenv(key) in (None, ""):
-                        os.environ[key] = value
-                        loaded_keys.append(key)
+            values = read_env_file(path)
         except OSError:
             continue
-        if loaded_keys:
+        loaded_keys = []
+        for key, value in values.items():
+            if key in desired:
+                continue
+            current = os.environ.get(key)
+            if current not in (None, "") and ENV_FILE_VALUES.get(key) != current:
+                continue
+            desired[key] = value
+            loaded_keys.append(key)
+        if loaded_keys and not reload:
             logger.info("已加载环境变量文件: %s (%d项)", filename, len(loaded_keys))
+    changed = []
+    for key in list(ENV_FILE_VALUES):
+        if key in desired:
+            continue
+        if os.environ.get(key) == ENV_FILE_VALUES.pop(key):
+            del os.environ[key]
+            changed.append(key)
+    for key, value in desired.items():
+        if os.environ.get(key) != value:
+            os.environ[key] = value
+            changed.append(key)
+        ENV_FILE_VALUES[key] = value
+    return changed
 
 
 load_env_files()
 
-SYSTEM_PROMPT_CACHE = {"path": None, "mtime": None, "data": None}
+SYSTEM_PROMPT_CACHE = {}
 USER_PROMPT_CACHE = {"path": None, "mtime": None, "text": None}
 SYSTEM_PROMPT_LOCK = threading.Lock()
 USER_PROMPT_LOCK = threading.Lock()
 STEP_HEADING_RE = re.compile(r"^#{2,6}\s*STEP\s*(\d+)\s*[｜|]\s*(.+)$", re.IGNORECASE)
+FRONT_MATTER_RE = re.compile(r"\A---[ \t]*\n(.*?)\n---[ \t]*(?:\n|\Z)", re.S)
+FRONT_MATTER_KEY_RE = re.compile(r"^([A-Za-z_][\w-]*)[ \t]*:(?:[ \t].*)?$")
 OPTION_HEADING_RE = re.compile(
     r"^(?:\*\*)?(示例方向|示例|可选项|可选描述|可选)(?:\*\*)?[:：]?$"
 )
+# 编译结果的结构变化时递增，旧版本的缓存条目随之失效。
+PROMPT_PARSER_VERSION = 3
+PROMPT_CACHE_FILE = os.path.join(
+    os.getenv("PROMPT_CACHE_DIR", "").strip() or os.path.join(DATA_DIR, "prompt_cache"),
+    "compiled.json",
+)
+PROMPT_CACHE_FLUSH_SECONDS = 1.0
+# 提示词检索：拉丁字母与数字按词切分，中日韩文字按相邻两字切分。
+SEARCH_TOKEN_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+|[0-9a-z]+")
+PROMPT_SEARCH_TITLE_WEIGHT = 3
+PROMPT_SEARCH_STEP_WEIGHT = 2
+PROMPT_SEARCH_LIMIT_MAX = 50
+PROMPT_SEARCH_SNIPPET_CHARS = 120
+PROMPT_SEARCH_COMPACT_RATIO = 0.25
+# 每个词只取权重最高的若干文档参与初排，候选再按完整 BM25 精排。
+PROMPT_SEARCH_CHAMPIONS = 256
+PROMPT_SEARCH_CHAMPION_CACHE = 1024
+PROMPT_SEARCH_RESCORE = 100
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 可选描述标题最长为“**可选描述**：”，更长的行无需再做正则匹配。
+OPTION_HEADING_MAX_LEN = 9
 BULLET_RE = re.compile(r"^\s*[-*•]\s+(.+)$")
+DOC_TITLE_RE = re.compile(r"[《](.+?)[》]")
+PLACEHOLDER_RE = re.compile(r"\{\{(\w+)\}\}")
+INPUT_STEP_META = {
+    "id": "input",
+    "title": "需求输入",
+    "question": "请粘贴或输入原始需求描述。",
+    "input_label": "原始需求描述",
+    "input_placeholder": "请尽量完整描述业务背景、目标与边界。",
+    "output_visible": False,
+    "generate": False,
+}
 NUMBERED_RE = re.compile(r"^\s*\d+[.)]\s+(.+)$")
 
 CONFIG_LOCK = threading.Lock()
+CONFIG_SNAPSHOT = None
+SHARED_CONFIG_STATE = {"token": ""}
 RUNTIME_CONFIG = {
     "api_key": "",
     "model": "",
     "base_url": "",
     "log_llm": None,
     "prompt_path": "",
+    "endpoints": None,
+    "routes": None,
 }
 
 
@@ -163,10 +284,7 @@ def resolve_prompt_path(relative_path):
 
 
 def get_selected_prompt_path():
-    with CONFIG_LOCK:
-        runtime_path = normalize_prompt_path(RUNTIME_CONFIG.get("prompt_path", ""))
-    env_path = normalize_prompt_path(os.getenv("PROMPT_PATH", ""))
-    candidate = runtime_path or env_path
+    candidate = get_effective_config().get("prompt_path", "")
     if not candidate:
         return ""
     return resolve_prompt_path(candidate)
@@ -205,6 +323,36 @@ def build_prompt_tree(base_path):
     return entries
 
 
+PROMPT_TREE_CACHE = {"root": None, "built": 0.0, "tree": None}
+
+
+def get_prompt_tree(force=False):
+    # 目录树短时缓存，新增的提示词文件最多 PROMPT_TREE_TTL_SECONDS 秒后出现。
+    root = get_prompt_root()
+    cache = PROMPT_TREE_CACHE
+    now = time.monotonic()
+    if (
+        not force
+        and cache["root"] == root
+        and cache["tree"] is not None
+        and now - cache["built"] < PROMPT_TREE_TTL_SECONDS
+    ):
+        return cache["tree"]
+    tree = build_prompt_tree(root)
+    PROMPT_TREE_CACHE.update({"root": root, "built": now, "tree": tree})
+    return tree
+
+
+def list_prompt_files(tree):
+    paths = []
+    for item in tree:
+        if item["type"] == "dir":
+            paths.extend(list_prompt_files(item.get("children", [])))
+        else:
+            paths.append(item["path"])
+    return paths
+
+
 def get_user_prompt_path():
     env_path = os.getenv("USER_PROMPT_FILE", "").strip()
     if env_path:
@@ -253,14 +401,513 @@ def get_env_int(*names, default=DEFAULT_TIMEOUT_SECONDS):
 TIMEOUT_SECONDS = get_env_int("TIMEOUT_S", "API_TIMEOUT_S")
 
 
-def get_effective_config():
-    with CONFIG_LOCK:
-        runtime = dict(RUNTIME_CONFIG)
-    api_key = runtime.get("api_key") or os.getenv("API_KEY", "").strip()
+LLM_RESPONSE_MAX_BYTES = get_env_int("LLM_RESPONSE_MAX_KB", default=2048) * 1024
+IMAGE_RESPONSE_MAX_BYTES = get_env_int("IMAGE_RESPONSE_MAX_MB", default=64) * 1024 * 1024
+RESPONSE_CHUNK_BYTES = 64 * 1024
+UPSTREAM_SSL_CONTEXT = ssl.create_default_context()
+UPSTREAM_USER_AGENT = "PromptExecutor/1.0"
+LATENCY_WINDOW = 200
+ENV_RELOAD_INTERVAL_SECONDS = get_env_int("ENV_RELOAD_INTERVAL_S", default=2)
+UPSTREAM_POOL_MAX_IDLE = 8
+UPSTREAM_IDLE_SECONDS = get_env_int("UPSTREAM_IDLE_S", default=50)
+UPSTREAM_WARM_CONNECTIONS = 2
+CLIENT_POLL_SECONDS = 0.25
+# 浏览器长连接：等待下一个请求的空闲超时与单连接可处理的请求数上限。
+HTTP_KEEPALIVE_TIMEOUT_SECONDS = max(1, get_env_int("HTTP_KEEPALIVE_TIMEOUT_S", default=15))
+HTTP_KEEPALIVE_MAX_REQUESTS = max(1, get_env_int("HTTP_KEEPALIVE_MAX_REQUESTS", default=100))
+# 估算取消调用节省的 token：无用量数据时按每字符 1 token、每次输出 1000 token 计。
+LLM_TOKENS_PER_CHAR = 1.0
+LLM_COMPLETION_TOKENS_ESTIMATE = 1000
+LLM_USAGE_EMA_ALPHA = 0.2
+DEBUG_PROFILE_MAX_SECONDS = 60
+DEBUG_PROFILE_INTERVAL_MS = 10
+DEBUG_PROFILE_TOP_MAX = 100
+WARMUP_ENABLED = parse_bool(os.getenv("WARMUP", "").strip()) is not False
+PROMPT_TREE_TTL_SECONDS = 5
+LLM_HEDGE_ENABLED = parse_bool(os.getenv("LLM_HEDGE", "").strip()) is True
+LLM_HEDGE_PERCENTILE = 0.9
+LLM_HEDGE_MIN_SAMPLES = 20
+LLM_HEDGE_MIN_MS = get_env_int("LLM_HEDGE_MIN_MS", default=1000)
+LLM_HEDGE_MAX_RATIO = get_env_int("LLM_HEDGE_MAX_PERCENT", default=10) / 100
+LLM_HEDGE_BURST = 5.0
+LLM_ENDPOINT_MAX = 16
+LLM_ENDPOINT_FAILURE_THRESHOLD = 3
+LLM_ENDPOINT_COOLDOWN_S = get_env_int("LLM_ENDPOINT_COOLDOWN_S", default=30)
+
+TRANSCRIPT_DIR = os.path.join(LOG_DIR, "transcripts")
+TRANSCRIPT_SEGMENT_BYTES = get_env_int("TRANSCRIPT_SEGMENT_MB", default=16) * 1024 * 1024
+TRANSCRIPT_SEGMENT_SECONDS = get_env_int("TRANSCRIPT_SEGMENT_S", default=3600)
+TRANSCRIPT_MAX_SEGMENTS = get_env_int("TRANSCRIPT_MAX_SEGMENTS", default=48)
+
+
+class TranscriptStore:
+    # 追加写入的 LLM 完整记录：每条记录是一行 JSON，单独压缩为一个 gzip member
+    # 追加到分段文件（多个 member 拼接仍是合法 gzip，可直接 zcat）；
+    # 同名 .idx 旁路索引记录 trace_id、偏移和长度，按 trace_id 读取时只解压对应 member。
+    def __init__(self, directory, segment_bytes, segment_seconds, max_segments):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+        self.segment = None
+        self.segment_started = 0.0
+        self.sequence = 0
+        self.index = {}
+        self.index_offsets = {}
+
+    def _segment_names(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted(name for name in names if name.endswith(".jsonl.gz"))
+
+    def _open_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        self.sequence += 1
+        self.segment = f"transcript-{stamp}-{os.getpid()}-{self.sequence:04d}.jsonl.gz"
+        self.segment_started = time.monotonic()
+        names = self._segment_names()
+        for name in names[: max(0, len(names) - self.max_segments + 1)]:
+            for path in (name, name[: -len(".jsonl.gz")] + ".idx"):
+                try:
+                    os.remove(os.path.join(self.directory, path))
+                except OSError:
+                    pass
+            logger.info("LLM完整记录分段已清理: %s", name)
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+        member = gzip.compress(line)
+        with self.lock:
+            path = os.path.join(self.directory, self.segment) if self.segment else ""
+            size = os.path.getsize(path) if path and os.path.isfile(path) else 0
+            if (
+                not self.segment
+                or size >= self.segment_bytes
+                or time.monotonic() - self.segment_started >= self.segment_seconds
+            ):
+                self._open_segment()
+                path = os.path.join(self.directory, self.segment)
+                size = 0
+            with open(path, "ab") as handle:
+                offset = handle.tell()
+                handle.write(member)
+            index_path = path[: -len(".jsonl.gz")] + ".idx"
+            with open(index_path, "a", encoding="utf-8") as handle:
+                handle.write(f"{record.get('trace_id', '')}\t{offset}\t{len(member)}\n")
+
+    def _refresh_index(self):
+        # 只读取各 .idx 文件新增的尾部，已删除分段的条目随之移除。
+        live = set()
+        for name in self._segment_names():
+            index_name = name[: -len(".jsonl.gz")] + ".idx"
+            live.add(name)
+            index_path = os.path.join(self.directory, index_name)
+            start = self.index_offsets.get(name, 0)
+            try:
+                with open(index_path, "rb") as handle:
+                    handle.seek(start)
+                    chunk = handle.read()
+            except OSError:
+                continue
+            consumed = chunk.rfind(b"\n") + 1
+            for raw in chunk[:consumed].decode("utf-8", "replace").splitlines():
+                parts = raw.split("\t")
+                if len(parts) != 3:
+                    continue
+                try:
+                    entry = (name, int(parts[1]), int(parts[2]))
+                except ValueError:
+                    continue
+                self.index.setdefault(parts[0], []).append(entry)
+            self.index_offsets[name] = start + consumed
+        for name in list(self.index_offsets):
+            if name not in live:
+                del self.index_offsets[name]
+        for trace_id in list(self.index):
+            entries = [entry for entry in self.index[trace_id] if entry[0] in live]
+            if entries:
+                self.index[trace_id] = entries
+            else:
+                del self.index[trace_id]
+
+    def get(self, trace_id):
+        with self.lock:
+            self._refresh_index()
+            entries = list(self.index.get(trace_id, []))
+        records = []
+        for name, offset, length in entries:
+            try:
+                with open(os.path.join(self.directory, name), "rb") as handle:
+                    handle.seek(offset)
+                    member = handle.read(length)
+                records.append(json.loads(gzip.decompress(member).decode("utf-8")))
+            except (OSError, EOFError, ValueError):
+                logger.warning("LLM完整记录读取失败 trace=%s segment=%s", trace_id, name)
+        return records
+
+
+TRANSCRIPT_STORE = TranscriptStore(
+    TRANSCRIPT_DIR,
+    TRANSCRIPT_SEGMENT_BYTES,
+    TRANSCRIPT_SEGMENT_SECONDS,
+    TRANSCRIPT_MAX_SEGMENTS,
+)
+
+
+WORKERS = max(1, get_env_int("WORKERS", default=1))
+WORKER_INDEX = 0
+WORKER_RESTART_MAX_DELAY_SECONDS = 30
+WORKER_STABLE_SECONDS = 10
+SHARED_CACHE_FILE = os.path.join(DATA_DIR, "shared_cache.db")
+FACTS_CACHE_TTL_SECONDS = get_env_int("FACTS_CACHE_TTL_S", default=86400)
+FACTS_CACHE_MAX_ENTRIES = 1000
+
+
+def connect_sqlite(path):
+    # 自动提交模式，事务由调用方显式 BEGIN；WAL 模式下读写互不阻塞。
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class SharedCache:
+    # 进程间共享的键值缓存：SQLite WAL 模式下读写互不阻塞，多个工作进程共用一个文件。
+    # 每个线程持有自己的连接，fork 后按进程号重新连接；读写失败只记日志，按未命中处理。
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "errors": 0}
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None and self.local.pid == os.getpid():
+            return connection
+        connection = connect_sqlite(self.path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "expires REAL NOT NULL, updated REAL NOT NULL, "
+            "PRIMARY KEY (ns, key)) WITHOUT ROWID"
+        )
+        self.local.connection = connection
+        self.local.pid = os.getpid()
+        return connection
+
+    def close(self):
+        # fork 前由父进程调用，子进程不能沿用父进程的 SQLite 连接。
+        connection = getattr(self.local, "connection", None)
+        self.local.connection = None
+        if connection is not None and self.local.pid == os.getpid():
+            connection.close()
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def _transact(self, action, func):
+        try:
+            connection = self._connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(connection)
+                connection.execute("COMMIT")
+            finally:
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+        except sqlite3.Error as exc:
+            self._count("errors")
+            logger.warning("共享缓存%s失败: %s", action, exc)
+            return None
+        return result
+
+    def get(self, namespace, key, touch=False):
+        now = time.time()
+        try:
+            connection = self._connection()
+            row = connection.execute(
+                "SELECT value FROM cache WHERE ns = ? AND key = ? AND (expires = 0 OR expires > ?)",
+                (namespace, key, now),
+            ).fetchone()
+            if row and touch:
+                connection.execute(
+                    "UPDATE cache SET updated = ? WHERE ns = ? AND key = ?", (now, namespace, key)
+                )
+        except sqlite3.Error as exc:
+            self._count("errors")
+            logger.warning("共享缓存读取失败: %s", exc)
+            return None
+        self._count("hits" if row else "misses")
+        return json.loads(row[0]) if row else None
+
+    def put(self, namespace, key, value, ttl=0, max_entries=0):
+        raw = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+
+        def write(connection):
+            connection.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                (namespace, key, raw, now + ttl if ttl > 0 else 0, now),
+            )
+            connection.execute(
+                "DELETE FROM cache WHERE ns = ? AND expires > 0 AND expires <= ?", (namespace, now)
+            )
+            if max_entries:
+                connection.execute(
+                    "DELETE FROM cache WHERE ns = ? AND key IN ("
+                    "SELECT key FROM cache WHERE ns = ? ORDER BY updated DESC LIMIT -1 OFFSET ?)",
+                    (namespace, namespace, max_entries),
+                )
+            return True
+
+        if self._transact("写入", write):
+            self._count("writes")
+
+    def pop(self, namespace, key):
+        # 取出并删除，多个进程同时取同一键时只有一个能拿到。
+        now = time.time()
+
+        def take(connection):
+            row = connection.execute(
+                "SELECT value FROM cache WHERE ns = ? AND key = ? AND (expires = 0 OR expires > ?)",
+                (namespace, key, now),
+            ).fetchone()
+            connection.execute("DELETE FROM cache WHERE ns = ? AND key = ?", (namespace, key))
+            return row
+
+        row = self._transact("读取", take)
+        self._count("hits" if row else "misses")
+        return json.loads(row[0]) if row else None
+
+    def delete(self, namespace, key=None):
+        if key is None:
+            sql, params = "DELETE FROM cache WHERE ns = ?", (namespace,)
+        else:
+            sql, params = "DELETE FROM cache WHERE ns = ? AND key = ?", (namespace, key)
+        self._transact("清理", lambda connection: connection.execute(sql, params))
+
+    def count(self, namespace):
+        try:
+            row = self._connection().execute(
+                "SELECT COUNT(*) FROM cache WHERE ns = ?", (namespace,)
+            ).fetchone()
+        except sqlite3.Error:
+            return 0
+        return row[0]
+
+    def exclusive(self, action, func):
+        # 持有共享库写锁执行 func，用作跨进程互斥；SQLite 出错时不执行并返回 None。
+        return self._transact(action, lambda connection: func())
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+SHARED_CACHE = SharedCache(SHARED_CACHE_FILE)
+
+
+def parse_llm_endpoints(raw):
+    if raw is None or raw == "":
+        return []
+    if isinstance(raw, str):
+        try:
+            raw = json.loads(raw)
+        except json.JSONDecodeError as exc:
+            raise ValueError("endpoints 必须为 JSON 数组") from exc
+    if not isinstance(raw, list):
+        raise ValueError("endpoints 必须为数组")
+    if len(raw) > LLM_ENDPOINT_MAX:
+        raise ValueError(f"endpoints 最多 {LLM_ENDPOINT_MAX} 个")
+    endpoints = []
+    seen = set()
+    for index, item in enumerate(raw):
+        if not isinstance(item, dict):
+            raise ValueError("端点配置必须为对象")
+        base_url = normalize_text(item.get("base_url", ""), MAX_CONTEXT_LEN)
+        api_key = normalize_text(item.get("api_key", ""), MAX_OPTION_LEN)
+        if not base_url.startswith("https://"):
+            raise ValueError("端点 base_url 必须使用 https://")
+        if not api_key:
+            raise ValueError("端点缺少 api_key")
+        weight = item.get("weight", 1)
+        if isinstance(weight, bool) or not isinstance(weight, (int, float)) or not weight > 0:
+            raise ValueError("端点 weight 必须为正数")
+        name = normalize_text(item.get("name", ""), 64) or f"ep{index + 1}"
+        if (base_url, api_key) in seen:
+            continue
+        seen.add((base_url, api_key))
+        endpoints.append(
+            {"name": name, "base_url": base_url, "api_key": api_key, "weight": float(weight)}
+        )
+    return endpoints
+
+
+def get_env_llm_endpoints():
+    try:
+        return parse_llm_endpoints(os.getenv("LLM_ENDPOINTS", "").strip())
+    except ValueError as exc:
+        logger.warning("LLM_ENDPOINTS 配置无效，已忽略: %s", exc)
+        return []
+
+
+def normalize_route_pattern(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return f"STEP{value}_*"
+    pattern = normalize_text(value if isinstance(value, str) else "", 64).upper()
+    if pattern.isdigit():
+        return f"STEP{int(pattern)}_*"
+    return pattern
+
+
+def parse_llm_routes(raw):
+    # 路由规则：按 LLM 调用 tag（支持 * 通配，或直接写步骤号）覆盖模型与端点。
+    if raw is None or raw == "":
+        return []
+    if isinstance(raw, str):
+        try:
+            raw = json.loads(raw)
+        except json.JSONDecodeError as exc:
+            raise ValueError("routes 必须为 JSON 数组") from exc
+    if not isinstance(raw, list):
+        raise ValueError("routes 必须为数组")
+    routes = []
+    for item in raw:
+        if not isinstance(item, dict):
+            raise ValueError("路由规则必须为对象")
+        pattern = normalize_route_pattern(item.get("step", item.get("tag", "")))
+        model = normalize_text(item.get("model", ""), MAX_OPTION_LEN)
+        endpoint = normalize_text(item.get("endpoint", ""), 64)
+        if not pattern:
+            raise ValueError("路由规则缺少 tag 或 step")
+        if not model and not endpoint:
+            raise ValueError("路由规则需指定 model 或 endpoint")
+        routes.append({"match": pattern, "model": model, "endpoint": endpoint})
+    return routes
+
+
+def get_env_llm_routes():
+    try:
+        return parse_llm_routes(os.getenv("LLM_ROUTES", "").strip())
+    except ValueError as exc:
+        logger.warning("LLM_ROUTES 配置无效，已忽略: %s", exc)
+        return []
+
+
+def parse_prompt_front_matter(text):
+    # 提示词开头可用 --- 包裹的头信息声明路由，例如：
+    # routes:
+    #   STEP0_FACTS: fast-model
+    #   1: fast-model@endpoint
+    # 只有每个顶层行都是 key: 形式且含 routes 段时才视为头信息；
+    # 以 --- 分隔线开头的普通提示词原样返回。
+    match = FRONT_MATTER_RE.match(text)
+    if not match:
+        return text, []
+    routes = []
+    sections = set()
+    section = ""
+    for raw_line in match.group(1).splitlines():
+        line = raw_line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if not raw_line[0].isspace():
+            key_match = FRONT_MATTER_KEY_RE.match(line)
+            if not key_match:
+                return text, []
+            section = key_match.group(1).lower()
+            sections.add(section)
+            continue
+        if section != "routes":
+            continue
+        key, _, value = line.partition(":")
+        model, _, endpoint = value.strip().partition("@")
+        pattern = normalize_route_pattern(key.strip())
+        if pattern and (model.strip() or endpoint.strip()):
+            routes.append(
+                {"match": pattern, "model": model.strip(), "endpoint": endpoint.strip()}
+            )
+    if "routes" not in sections:
+        return text, []
+    return text[match.end():], routes
+
+
+def build_etag(body):
+    # 强 ETag 取响应体摘要：内容相同的响应在各工作进程中得到相同的标签。
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match, etag):
+    if_none_match = (if_none_match or "").strip()
+    return if_none_match == "*" or etag in if_none_match
+
+
+def public_config(config, version=None):
+    # 端点列表不回传 api_key。
+    public = dict(config)
+    public["endpoints"] = [
+        {"name": item["name"], "base_url": item["base_url"], "weight": item["weight"]}
+        for item in config.get("endpoints", [])
+    ]
+    public["routes"] = [dict(item) for item in config.get("routes", [])]
+    public["version"] = get_config_version() if version is None else version
+    return public
+
+
+def build_config_version(values, image):
+    # 版本号取配置内容摘要：内容相同则版本相同，多进程模式下各工作进程给出一致的版本。
+    canonical = json.dumps([values, image], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:12]
+
+
+class ConfigSnapshot:
+    # 不可变的配置快照：写入方整体替换 CONFIG_SNAPSHOT，读取方直接引用，无需加锁。
+    __slots__ = ("version", "values", "image", "payload")
+
+    def __init__(self, values, image):
+        self.version = build_config_version(values, image)
+        self.values = types.MappingProxyType(values)
+        self.image = types.MappingProxyType(image)
+        self.payload = None
+
+    @property
+    def public_payload(self):
+        # GET /api/config 的响应体与 ETag：首次请求时编码一次，配置变化时随快照整体替换。
+        if self.payload is None:
+            body = json.dumps(public_config(self.values, self.version), ensure_ascii=False).encode(
+                "utf-8"
+            )
+            self.payload = (body, build_etag(body))
+        return self.payload
+
+
+def build_effective_config(runtime):
+    endpoints = runtime.get("endpoints")
+    if endpoints is None:
+        endpoints = get_env_llm_endpoints()
+    routes = runtime.get("routes")
+    if routes is None:
+        routes = get_env_llm_routes()
+    first = endpoints[0] if endpoints else {}
+    api_key = (
+        runtime.get("api_key")
+        or os.getenv("API_KEY", "").strip()
+        or first.get("api_key", "")
+    )
     model = runtime.get("model") or os.getenv("MODEL", "").strip() or DEFAULT_MODEL
     base_url = (
         runtime.get("base_url")
         or os.getenv("BASE_URL", "").strip()
+        or first.get("base_url", "")
         or DEFAULT_BASE_URL
     )
     log_llm = runtime.get("log_llm")
@@ -279,10 +926,12 @@ def get_effective_config():
         "base_url": base_url,
         "log_llm": log_llm,
         "prompt_path": prompt_path,
+        "endpoints": tuple(endpoints),
+        "routes": tuple(routes),
     }
 
 
-def get_effective_image_config():
+def build_effective_image_config():
     return {
         "api_key": os.getenv("IMG_API_KEY", "").strip()
         or os.getenv("OPENAI_API_KEY", "").strip(),
@@ -294,6 +943,74 @@ def get_effective_image_config():
     }
 
 
+def rebuild_config_snapshot():
+    global CONFIG_SNAPSHOT
+    with CONFIG_LOCK:
+        runtime = dict(RUNTIME_CONFIG)
+        CONFIG_SNAPSHOT = ConfigSnapshot(
+            build_effective_config(runtime), build_effective_image_config()
+        )
+        return CONFIG_SNAPSHOT
+
+
+def get_config_snapshot():
+    return CONFIG_SNAPSHOT or rebuild_config_snapshot()
+
+
+def get_config_version():
+    return get_config_snapshot().version
+
+
+def get_effective_config():
+    return get_config_snapshot().values
+
+
+def get_effective_image_config():
+    return dict(get_config_snapshot().image)
+
+
+def publish_runtime_config():
+    # 调用方需持有 CONFIG_LOCK；多进程模式下把运行时配置写入共享缓存，其它工作进程轮询同步。
+    token = uuid.uuid4().hex
+    SHARED_CACHE.put("config", "runtime", {"token": token, "runtime": dict(RUNTIME_CONFIG)})
+    SHARED_CONFIG_STATE["token"] = token
+
+
+def sync_runtime_config():
+    shared = SHARED_CACHE.get("config", "runtime")
+    if not shared or shared.get("token") == SHARED_CONFIG_STATE["token"]:
+        return False
+    with CONFIG_LOCK:
+        RUNTIME_CONFIG.update(shared.get("runtime", {}))
+        SHARED_CONFIG_STATE["token"] = shared.get("token")
+    return True
+
+
+def watch_env_files(interval):
+    # 同时负责多进程模式下运行时配置的同步。
+    mtimes = get_env_files_mtime()
+    while True:
+        time.sleep(interval)
+        if WORKERS > 1 and sync_runtime_config():
+            snapshot = rebuild_config_snapshot()
+            logger.info("运行时配置已从共享缓存同步 version=%s", snapshot.version)
+        current = get_env_files_mtime()
+        if current == mtimes:
+            continue
+        mtimes = current
+        try:
+            changed = load_env_files(reload=True)
+        except Exception:
+            logger.exception("环境变量文件重新加载失败")
+            continue
+        snapshot = rebuild_config_snapshot()
+        logger.info(
+            "环境变量文件已重新加载 version=%s changed=%s",
+            snapshot.version,
+            ",".join(sorted(changed)) or "-",
+        )
+
+
 def update_runtime_config(payload):
     api_key = payload.get("api_key") if "api_key" in payload else None
     model = payload.get("model") if "model" in payload else None
@@ -301,6 +1018,14 @@ def update_runtime_config(payload):
     prompt_path = payload.get("prompt_path") if "prompt_path" in payload else None
     log_llm_provided = "log_llm" in payload
     log_llm = payload.get("log_llm") if log_llm_provided else None
+    endpoints_provided = "endpoints" in payload
+    endpoints = None
+    if endpoints_provided and payload.get("endpoints") is not None:
+        endpoints = parse_llm_endpoints(payload.get("endpoints"))
+    routes_provided = "routes" in payload
+    routes = None
+    if routes_provided and payload.get("routes") is not None:
+        routes = parse_llm_routes(payload.get("routes"))
     if api_key is not None:
         api_key = normalize_text(api_key, MAX_OPTION_LEN)
     if model is not None:
@@ -321,6 +1046,8 @@ def update_runtime_config(payload):
             if parsed is None:
                 raise ValueError("log_llm 必须为布尔值")
             log_llm = parsed
+    if WORKERS > 1:
+        sync_runtime_config()
     with CONFIG_LOCK:
         if api_key is not None:
             RUNTIME_CONFIG["api_key"] = api_key
@@ -332,6 +1059,13 @@ def update_runtime_config(payload):
             RUNTIME_CONFIG["prompt_path"] = prompt_path
         if log_llm_provided:
             RUNTIME_CONFIG["log_llm"] = log_llm
+        if endpoints_provided:
+            RUNTIME_CONFIG["endpoints"] = endpoints
+        if routes_provided:
+            RUNTIME_CONFIG["routes"] = routes
+        if WORKERS > 1:
+            publish_runtime_config()
+    rebuild_config_snapshot()
 
 
 def render_template(template, values):
@@ -341,47 +1075,6 @@ def render_template(template, values):
     return rendered.strip()
 
 
-def parse_step_blocks(text):
-    steps = []
-    current = None
-    buffer = []
-    for raw_line in text.splitlines():
-        line = raw_line.strip()
-        match = STEP_HEADING_RE.match(line)
-        if match:
-            if current:
-                current["content"] = "\n".join(buffer).strip()
-                steps.append(current)
-            current = {
-                "number": int(match.group(1)),
-                "title": match.group(2).strip(),
-            }
-            buffer = []
-        else:
-            buffer.append(raw_line)
-    if current:
-        current["content"] = "\n".join(buffer).strip()
-        steps.append(current)
-    return steps
-
-
-def summarize_step_block(content):
-    for line in content.splitlines():
-        candidate = line.strip()
-        if not candidate:
-            continue
-        if set(candidate) <= {"-"}:
-            continue
-        if candidate.startswith("**") and candidate.endswith("**") and len(candidate.strip("*")) <= 8:
-            continue
-        if candidate.startswith("#"):
-            continue
-        if len(candidate) > 120:
-            candidate = candidate[:120] + "..."
-        return candidate
-    return ""
-
-
 def safe_filename(name):
     cleaned = re.sub(r'[\\/:*?"<>|｜]', "", name).strip()
     if not cleaned:
@@ -390,7 +1083,7 @@ def safe_filename(name):
 
 
 def extract_doc_title(content):
-    match = re.search(r"[《](.+?)[》]", content)
+    match = DOC_TITLE_RE.search(content)
     if match:
         return match.group(1).strip()
     for raw_line in content.splitlines():
@@ -403,35 +1096,7 @@ def extract_doc_title(content):
             return line.strip("《》")
     return ""
 
-def extract_step_options(content):
-    options = []
-    capture = False
-    for raw_line in content.splitlines():
-        line = raw_line.strip()
-        if not line:
-            if capture:
-                capture = False
-            continue
-        if OPTION_HEADING_RE.match(line):
-            capture = True
-            continue
-        if line.startswith("#"):
-            capture = False
-            continue
-        if capture:
-            match = BULLET_RE.match(line) or NUMBERED_RE.match(line)
-            if match:
-                option = match.group(1).strip()
-                if option:
-                    options.append(option)
-            else:
-                capture = False
-    return options
-
-
-def build_step_meta(step, options, doc_title):
-    number = step["number"]
-    title = step["title"]
+def build_step_meta(number, title, options, doc_title, block_summary):
     display_title_text = title
     if doc_title and ("交付物" in title or re.search(r"D\\d+", title, re.IGNORECASE)):
         display_title_text = doc_title
@@ -440,7 +1105,6 @@ def build_step_meta(step, options, doc_title):
         if "可选" in title and "可选" not in display_title_text:
             display_title_text = f"{display_title_text}（可选）"
     display_title = f"STEP {number}｜{display_title_text}"
-    block_summary = summarize_step_block(step.get("content", ""))
     question = block_summary or f"请根据提示词输出 {display_title} 的内容。"
     title_hint = title
     if number == 1 or "澄清" in title_hint or "反问" in title_hint:
@@ -484,52 +1148,645 @@ def load_system_prompt_data(path_override=None):
     if not path:
         raise ValueError("未选择提示词文件")
     try:
-        mtime = os.path.getmtime(path)
+        stat = os.stat(path)
     except OSError as exc:
         raise ValueError(f"系统提示词文件不存在: {path}") from exc
+    # 按路径缓存解析结果，读取不加锁；并发首次解析同一文件时以后写入者为准。
+    version = (stat.st_mtime, stat.st_size)
+    cached = SYSTEM_PROMPT_CACHE.get(path)
+    if cached and cached[0] == version:
+        return cached[1]
+    # 进程内未命中时先查落盘的编译缓存，只有内容变化的文件才重新解析。
+    data = PROMPT_ARTIFACTS.load(path, stat)
     with SYSTEM_PROMPT_LOCK:
-        cache = SYSTEM_PROMPT_CACHE
-        if cache["path"] == path and cache["mtime"] == mtime and cache["data"]:
-            return cache["data"]
-        with open(path, "r", encoding="utf-8") as handle:
-            text = handle.read()
-        steps = parse_step_blocks(text)
-        step_blocks = {}
-        step_meta = []
-        step0_block = ""
-        assumption_step_id = ""
-        for step in steps:
-            if step["number"] == 0:
-                step0_block = step.get("content", "")
+        SYSTEM_PROMPT_CACHE[path] = (version, data)
+    return data
+
+
+class CompiledStep:
+    # 单个步骤的编译结果：元数据、可选描述与占位符集合在解析时一次算好；
+    # 步骤正文只记录在 base_prompt 中的区间，不另存一份副本。
+    __slots__ = ("id", "number", "title", "meta", "options", "placeholders", "source", "start", "end")
+
+    def __init__(self, meta, source, start, end, placeholders):
+        self.id = meta["id"]
+        self.number = meta["number"]
+        self.title = meta["title"]
+        self.meta = meta
+        self.options = tuple(meta.get("options", ()))
+        self.placeholders = frozenset(placeholders)
+        self.source = source
+        self.start = start
+        self.end = end
+
+    @property
+    def block(self):
+        return self.source[self.start:self.end]
+
+
+class CompiledPrompt:
+    # 一个提示词文件的编译结果；/api/steps 的响应体在首次请求时序列化一次后复用，
+    # 预热时解析的大量未被选中的提示词不必为此占用内存。
+    __slots__ = (
+        "base_prompt",
+        "steps",
+        "step_index",
+        "step0_block",
+        "assumption_step_id",
+        "routes",
+        "placeholders",
+        "payload",
+        "etag",
+    )
+
+    def __init__(self, base_prompt, steps, step0_block, assumption_step_id, routes):
+        self.base_prompt = base_prompt
+        self.steps = tuple(steps)
+        self.step_index = {step.id: step for step in self.steps}
+        self.step0_block = step0_block
+        self.assumption_step_id = assumption_step_id
+        self.routes = tuple(routes)
+        self.placeholders = frozenset().union(*(step.placeholders for step in self.steps))
+        self.payload = None
+        self.etag = None
+
+    @property
+    def steps_payload(self):
+        # 并发首次请求时可能重复序列化，结果相同，无需加锁。
+        if self.payload is None:
+            self.payload = json.dumps(
+                {
+                    "steps": [INPUT_STEP_META, *(step.meta for step in self.steps)],
+                    "assumption_step_id": self.assumption_step_id,
+                },
+                ensure_ascii=False,
+            ).encode("utf-8")
+        return self.payload
+
+    @property
+    def steps_etag(self):
+        if self.etag is None:
+            self.etag = build_etag(self.steps_payload)
+        return self.etag
+
+    def to_dict(self):
+        return {
+            "base_prompt": self.base_prompt,
+            "steps": [
+                {
+                    "meta": step.meta,
+                    "span": [step.start, step.end],
+                    "placeholders": sorted(step.placeholders),
+                }
+                for step in self.steps
+            ],
+            "step0_block": self.step0_block,
+            "assumption_step_id": self.assumption_step_id,
+            "routes": list(self.routes),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        base_prompt = data["base_prompt"]
+        steps = [
+            CompiledStep(item["meta"], base_prompt, item["span"][0], item["span"][1], item["placeholders"])
+            for item in data["steps"]
+        ]
+        return cls(base_prompt, steps, data["step0_block"], data["assumption_step_id"], data["routes"])
+
+
+class StepScanner:
+    # 累计一个步骤的摘要、文档标题、可选描述与占位符，规则与逐段解析时一致。
+    __slots__ = (
+        "number",
+        "title",
+        "start",
+        "end",
+        "summary",
+        "doc_title",
+        "doc_hint",
+        "options",
+        "capture",
+        "placeholders",
+    )
+
+    def __init__(self, number, title, start):
+        self.number = number
+        self.title = title
+        self.start = start
+        self.end = start
+        self.summary = ""
+        self.doc_title = ""
+        self.doc_hint = ""
+        self.options = []
+        self.capture = False
+        self.placeholders = set()
+
+    def feed(self, line):
+        # line 已去除首尾空白且非空；摘要、标题只取第一处，命中后不再检查。
+        if "{{" in line:
+            self.placeholders.update(PLACEHOLDER_RE.findall(line))
+        heading = line[0] == "#"
+        if not self.summary and not heading and line.strip("-"):
+            if not (line[:2] == "**" and line[-2:] == "**" and len(line.strip("*")) <= 8):
+                self.summary = line if len(line) <= 120 else line[:120] + "..."
+        if not self.doc_title and "《" in line:
+            match = DOC_TITLE_RE.search(line)
+            if match:
+                self.doc_title = match.group(1).strip()
+        if not self.doc_hint and ("文档" in line or "说明" in line):
+            hint = line.lstrip("#").strip() if heading else line
+            if "文档" in hint or "说明" in hint:
+                self.doc_hint = hint.strip("《》")
+        if heading:
+            self.capture = False
+        elif len(line) <= OPTION_HEADING_MAX_LEN and OPTION_HEADING_RE.match(line):
+            self.capture = True
+        elif self.capture:
+            match = BULLET_RE.match(line) or NUMBERED_RE.match(line)
+            option = match.group(1).strip() if match else ""
+            if option:
+                self.options.append(option)
+            elif not match:
+                self.capture = False
+
+
+def compile_prompt_text(text):
+    # 单遍扫描全文：切分步骤的同时累计各步骤的元数据，不再对每个步骤反复按行拆分。
+    text, routes = parse_prompt_front_matter(text)
+    base_prompt = text.strip()
+    lead = len(text) - len(text.lstrip())
+    scanners = []
+    current = None
+    offset = 0
+    for raw_line in text.split("\n"):
+        line_start = offset
+        offset += len(raw_line) + 1
+        line = raw_line.strip()
+        if not line:
+            if current:
+                current.capture = False
+            continue
+        if line[0] == "#":
+            match = STEP_HEADING_RE.match(line)
+            if match:
+                if current:
+                    current.end = line_start
+                current = StepScanner(int(match.group(1)), match.group(2).strip(), offset)
+                scanners.append(current)
+                continue
+        if current:
+            current.feed(line)
+    if current:
+        current.end = len(text)
+    steps = []
+    step_ids = set()
+    step0_block = ""
+    assumption_step_id = ""
+    for scanner in scanners:
+        # 正文区间去掉首尾空白后换算为 base_prompt 中的偏移。
+        raw = text[scanner.start:scanner.end]
+        start = scanner.start + len(raw) - len(raw.lstrip()) - lead
+        end = max(start, scanner.start + len(raw.rstrip()) - lead)
+        if scanner.number == 0:
+            step0_block = base_prompt[start:end]
+            continue
+        doc_title = scanner.doc_title or scanner.doc_hint or extract_doc_title(scanner.title)
+        meta = build_step_meta(
+            scanner.number, scanner.title, scanner.options, doc_title, scanner.summary
+        )
+        if "可选" in scanner.title:
+            meta["optional"] = True
+            meta["optional_label"] = scanner.title
+        if meta["id"] in step_ids:
+            meta["id"] = f"{meta['id']}_{len(steps)}"
+        step_ids.add(meta["id"])
+        steps.append(CompiledStep(meta, base_prompt, start, end, scanner.placeholders))
+        if not assumption_step_id and (scanner.number == 2 or "假设" in scanner.title):
+            assumption_step_id = meta["id"]
+    return CompiledPrompt(base_prompt, steps, step0_block, assumption_step_id, routes)
+
+
+def decode_prompt_bytes(raw):
+    # 与文本模式 open() 一致：UTF-8 解码并统一换行符。
+    return raw.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+
+
+class PromptArtifactCache:
+    # 编译后提示词的落盘缓存：整个提示词库存为一个 JSON 文件，首次使用时一次读入。
+    # 条目按路径索引，大小与 mtime 都一致时直接使用；仅 mtime 变化时比对内容哈希，
+    # 内容未变则无需重新解析。新增条目延迟合并写回，多个工作进程共用同一文件。
+    def __init__(self, path, flush_delay):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+        self.loading = False
+        self.entries = {}
+        self.file_mtime = None
+        self.timer = None
+        self.stats = {"hits": 0, "rehashed": 0, "compiled": 0, "flushes": 0, "load_ms": 0.0}
+
+    def _read_file(self):
+        try:
+            with open(self.path, "rb") as handle:
+                mtime = os.fstat(handle.fileno()).st_mtime
+                data = json.loads(handle.read())
+        except FileNotFoundError:
+            return None, {}
+        except (OSError, ValueError) as exc:
+            logger.warning("提示词编译缓存读取失败: %s", exc)
+            return None, {}
+        if not isinstance(data, dict) or data.get("version") != PROMPT_PARSER_VERSION:
+            return mtime, {}
+        entries = data.get("entries")
+        return mtime, entries if isinstance(entries, dict) else {}
+
+    def preload(self, wait=True):
+        # 整个缓存文件只在启动时读取一次；读取期间其它线程不等待，直接编译所需的单个文件。
+        with self.lock:
+            if self.loaded.is_set() or self.loading:
+                owner = False
+            else:
+                self.loading = owner = True
+        if not owner:
+            if wait:
+                self.loaded.wait()
+            return
+        start = time.monotonic()
+        mtime, entries = self._read_file()
+        with self.lock:
+            # 加载期间新编译的条目比文件中的更新，保留前者。
+            for key, entry in entries.items():
+                self.entries.setdefault(key, entry)
+            self.file_mtime = mtime
+            self.loading = False
+            self.stats["load_ms"] = round((time.monotonic() - start) * 1000, 1)
+            self.loaded.set()
+        if entries:
+            logger.info(
+                "提示词编译缓存已加载: %s (entries=%d, %.0fms)",
+                self.path,
+                len(entries),
+                self.stats["load_ms"],
+            )
+
+    def _refresh(self):
+        # 调用方需持有 self.lock；其它工作进程写回过缓存文件时合并其条目。
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self.file_mtime:
+            return
+        self.file_mtime, entries = self._read_file()
+        for key, entry in entries.items():
+            self.entries.setdefault(key, entry)
+
+    def _lookup(self, path):
+        self.preload(wait=False)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None and self.loaded.is_set():
+                self._refresh()
+                entry = self.entries.get(path)
+            return entry
+
+    def load(self, path, stat):
+        entry = self._lookup(path)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            prompt = CompiledPrompt.from_dict(entry["prompt"])
+            with self.lock:
+                self.stats["hits"] += 1
+            return prompt
+        with open(path, "rb") as handle:
+            raw = handle.read()
+        digest = hashlib.sha256(raw).hexdigest()
+        if entry and entry["sha256"] == digest:
+            prompt = CompiledPrompt.from_dict(entry["prompt"])
+            counter = "rehashed"
+        else:
+            prompt = compile_prompt_text(decode_prompt_bytes(raw))
+            entry = {"prompt": prompt.to_dict(), "sha256": digest}
+            counter = "compiled"
+            logger.info("系统提示词已解析: %s (steps=%d)", path, len(prompt.steps))
+        entry = dict(entry, size=stat.st_size, mtime=stat.st_mtime)
+        with self.lock:
+            self.entries[path] = entry
+            self.stats[counter] += 1
+            if self.timer is None:
+                self.timer = threading.Timer(self.flush_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        return prompt
+
+    def flush(self):
+        self.preload()
+        with self.lock:
+            # 没有待写回的条目时直接返回；提前调用时取消尚未触发的延迟写回。
+            if self.timer is None:
+                return
+            self.timer.cancel()
+            self.timer = None
+            self._refresh()
+            entries = {key: entry for key, entry in self.entries.items() if os.path.isfile(key)}
+            self.entries = entries
+            payload = {"version": PROMPT_PARSER_VERSION, "entries": entries}
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                temp_path = f"{self.path}.{uuid.uuid4().hex[:8]}.tmp"
+                with open(temp_path, "w", encoding="utf-8") as handle:
+                    json.dump(payload, handle, ensure_ascii=False)
+                os.replace(temp_path, self.path)
+                self.file_mtime = os.path.getmtime(self.path)
+            except OSError as exc:
+                logger.warning("提示词编译缓存写入失败: %s", exc)
+                return
+            self.stats["flushes"] += 1
+        logger.info("提示词编译缓存已写入: %s (entries=%d)", self.path, len(entries))
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.entries)
+        return stats
+
+
+PROMPT_ARTIFACTS = PromptArtifactCache(PROMPT_CACHE_FILE, PROMPT_CACHE_FLUSH_SECONDS)
+
+
+def tokenize_search_text(text):
+    tokens = []
+    for word in SEARCH_TOKEN_RE.findall(text.lower()):
+        if word[0] <= "z" or len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(map(str.__add__, word, word[1:]))
+    return tokens
+
+
+def extract_prompt_title(base_prompt):
+    for raw_line in base_prompt.split("\n", 20)[:20]:
+        line = raw_line.strip().lstrip("#").strip()
+        if line and not line.startswith("---"):
+            return line[:MAX_OPTION_LEN]
+    return ""
+
+
+def build_search_snippet(text, words):
+    lowered = text.lower()
+    position = -1
+    for word in words:
+        # 中文短语整体未出现时退而查找首个双字词。
+        for candidate in (word,) if word[0] <= "z" else (word, word[:2]):
+            found = lowered.find(candidate)
+            if found >= 0 and (position < 0 or found < position):
+                position = found
+                break
+    if position < 0:
+        position = 0
+    start = max(0, position - PROMPT_SEARCH_SNIPPET_CHARS // 4)
+    snippet = " ".join(text[start:start + PROMPT_SEARCH_SNIPPET_CHARS].split())
+    return ("…" if start else "") + snippet
+
+
+class PromptSearchIndex:
+    # 提示词库的内存倒排索引：标题、步骤标题与正文分别加权计入词频，按 BM25 排序。
+    # 倒排表按文档编号顺序存入定长数组；文件变更或删除时旧文档只做标记，失效比例过高时整体压缩。
+    # 常见词的倒排表很长，检索时只遍历其按权重排好的前若干项（首次用到时生成，索引变更后失效），
+    # 再对得分靠前的候选二分查找各词词频重新精确打分，使查询耗时与文档总数基本无关。
+    # 检索不加锁，索引刷新在后台按目录树缓存周期对比文件大小与修改时间增量进行。
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cache_lock = threading.Lock()
+        self.root = None
+        self.checked = 0.0
+        self.docs = {}
+        self.paths = {}
+        self.postings = {}
+        self.norms = {}
+        self.champions = OrderedDict()
+        self.next_id = 0
+        self.total_length = 0
+        self.dead = 0
+        self.stats = {"queries": 0, "indexed": 0, "removed": 0, "compactions": 0, "refresh_ms": 0.0}
+
+    def _add(self, path, version, prompt):
+        title = extract_prompt_title(prompt.base_prompt)
+        name = os.path.splitext(os.path.basename(path))[0]
+        counts = Counter(tokenize_search_text(prompt.base_prompt))
+        for term in tokenize_search_text(f"{name} {title}"):
+            counts[term] += PROMPT_SEARCH_TITLE_WEIGHT
+        for step in prompt.steps:
+            for term in tokenize_search_text(step.title):
+                counts[term] += PROMPT_SEARCH_STEP_WEIGHT
+        doc_id = self.next_id
+        self.next_id += 1
+        postings = self.postings
+        get = postings.get
+        for term, count in counts.items():
+            entry = get(term)
+            if entry is None:
+                entry = postings[term] = (array("I"), array("H"))
+            entry[0].append(doc_id)
+            entry[1].append(count if count <= 0xFFFF else 0xFFFF)
+        length = sum(counts.values())
+        self.docs[doc_id] = (path, title or name, length, prompt)
+        self.paths[path] = (doc_id, version)
+        self.total_length += length
+        self.stats["indexed"] += 1
+
+    def _remove(self, path):
+        doc_id, _ = self.paths.pop(path)
+        doc = self.docs.pop(doc_id)
+        self.total_length -= doc[2]
+        self.dead += 1
+        self.stats["removed"] += 1
+
+    def _compact(self):
+        docs = self.docs
+        postings = {}
+        for term, (ids, counts) in self.postings.items():
+            live_ids = array("I")
+            live_counts = array("H")
+            for doc_id, count in zip(ids, counts):
+                if doc_id in docs:
+                    live_ids.append(doc_id)
+                    live_counts.append(count)
+            if live_ids:
+                postings[term] = (live_ids, live_counts)
+        self.postings = postings
+        self.dead = 0
+        self.stats["compactions"] += 1
+
+    def _reset(self, root):
+        self.root = root
+        self.docs = {}
+        self.paths = {}
+        self.postings = {}
+        self.norms = {}
+        self.champions = OrderedDict()
+        self.total_length = 0
+        self.dead = 0
+
+    def refresh(self, force=False):
+        with self.lock:
+            root = os.path.abspath(get_prompt_root())
+            if not force and root == self.root and time.monotonic() - self.checked < PROMPT_TREE_TTL_SECONDS:
+                return
+            start = time.monotonic()
+            if root != self.root:
+                self._reset(root)
+            changed = 0
+            seen = set()
+            for path in list_prompt_files(get_prompt_tree(force=force)):
+                full_path = os.path.join(root, path)
+                try:
+                    stat = os.stat(full_path)
+                except OSError:
+                    continue
+                seen.add(path)
+                version = (stat.st_mtime, stat.st_size)
+                current = self.paths.get(path)
+                if current and current[1] == version:
+                    continue
+                try:
+                    prompt = load_system_prompt_data(full_path)
+                except (OSError, ValueError) as exc:
+                    logger.warning("提示词索引跳过 %s: %s", path, exc)
+                    continue
+                if current:
+                    self._remove(path)
+                self._add(path, version, prompt)
+                changed += 1
+            for path in [path for path in self.paths if path not in seen]:
+                self._remove(path)
+                changed += 1
+            if changed:
+                if self.dead > len(self.docs) * PROMPT_SEARCH_COMPACT_RATIO:
+                    self._compact()
+                # 文档长度归一化项随平均长度变化，变更后整体重算一次，检索时直接查表。
+                average = self.total_length / max(1, len(self.docs))
+                self.norms = {
+                    doc_id: BM25_K1 * (1 - BM25_B + BM25_B * doc[2] / average)
+                    for doc_id, doc in self.docs.items()
+                }
+                self.champions = OrderedDict()
+            self.checked = time.monotonic()
+            self.stats["refresh_ms"] = round((self.checked - start) * 1000, 1)
+        if changed:
+            logger.info(
+                "提示词索引已更新 changed=%d docs=%d terms=%d (%.0fms)",
+                changed,
+                len(self.docs),
+                len(self.postings),
+                self.stats["refresh_ms"],
+            )
+
+    def _refresh_if_stale(self):
+        if self.root is None or self.root != os.path.abspath(get_prompt_root()):
+            return self.refresh()
+        if time.monotonic() - self.checked >= PROMPT_TREE_TTL_SECONDS and not self.lock.locked():
+            threading.Thread(target=self.refresh, name="prompt-index", daemon=True).start()
+
+    def _champions(self, term):
+        # 返回该词分量最高的若干文档及其 BM25 分量（按分量降序）与完整倒排表，供精排查找。
+        cache = self.champions
+        with self.cache_lock:
+            champions = cache.get(term)
+            if champions is not None:
+                cache.move_to_end(term)
+                return champions
+        entry = self.postings.get(term)
+        if entry is None:
+            return None
+        ids, counts = entry
+        norms = self.norms
+        frequency = min(len(ids), len(norms))
+        idf = math.log(1 + (len(norms) - frequency + 0.5) / (frequency + 0.5)) * (BM25_K1 + 1)
+        weights = [
+            (doc_id, idf * count / (count + norms[doc_id]))
+            for doc_id, count in zip(ids, counts)
+            if doc_id in norms
+        ]
+        if len(weights) > PROMPT_SEARCH_CHAMPIONS:
+            weights = heapq.nlargest(PROMPT_SEARCH_CHAMPIONS, weights, key=lambda item: item[1])
+        else:
+            weights.sort(key=lambda item: item[1], reverse=True)
+        champions = (dict(weights), idf, ids, counts)
+        with self.cache_lock:
+            cache[term] = champions
+            if len(cache) > PROMPT_SEARCH_CHAMPION_CACHE:
+                cache.popitem(last=False)
+        return champions
+
+    def rank(self, terms, limit):
+        norms = self.norms
+        lists = [champions for champions in map(self._champions, terms) if champions]
+        scores = {}
+        for weights, _, _, _ in lists:
+            get = scores.get
+            for doc_id, weight in weights.items():
+                scores[doc_id] = get(doc_id, 0.0) + weight
+        if len(lists) <= 1:
+            return [(doc_id, scores[doc_id]) for doc_id in heapq.nlargest(limit, scores, key=scores.__getitem__)]
+        # 初排只计入了各词前若干项中的分量，精排时二分查找补齐候选在其余词上的得分。
+        rescored = {}
+        for doc_id in heapq.nlargest(max(limit, PROMPT_SEARCH_RESCORE), scores, key=scores.__getitem__):
+            norm = norms.get(doc_id)
+            if norm is None:
                 continue
-            content = step.get("content", "")
-            options = extract_step_options(content)
-            doc_title = extract_doc_title(content)
-            if not doc_title:
-                doc_title = extract_doc_title(step.get("title", ""))
-            meta = build_step_meta(step, options, doc_title)
-            optional = "可选" in step.get("title", "")
-            if optional:
-                meta["optional"] = True
-                meta["optional_label"] = step.get("title", "")
-            step_id = meta["id"]
-            if step_id in step_blocks:
-                step_id = f"{step_id}_{len(step_blocks)}"
-                meta["id"] = step_id
-            step_blocks[step_id] = step.get("content", "")
-            step_meta.append(meta)
-            if not assumption_step_id and (step["number"] == 2 or "假设" in step["title"]):
-                assumption_step_id = step_id
-        data = {
-            "base_prompt": text.strip(),
-            "steps": step_meta,
-            "step_blocks": step_blocks,
-            "step0_block": step0_block,
-            "assumption_step_id": assumption_step_id,
+            score = 0.0
+            for weights, idf, ids, counts in lists:
+                weight = weights.get(doc_id)
+                if weight is None:
+                    index = bisect.bisect_left(ids, doc_id)
+                    if index == len(ids) or ids[index] != doc_id:
+                        continue
+                    count = counts[index]
+                    weight = idf * count / (count + norm)
+                score += weight
+            rescored[doc_id] = score
+        return [(doc_id, rescored[doc_id]) for doc_id in heapq.nlargest(limit, rescored, key=rescored.__getitem__)]
+
+    def search(self, text, limit):
+        self._refresh_if_stale()
+        words = SEARCH_TOKEN_RE.findall(text.lower())
+        terms = list(dict.fromkeys(tokenize_search_text(text)))
+        ranked = self.rank(terms, limit)
+        results = []
+        for doc_id, score in ranked:
+            doc = self.docs.get(doc_id)
+            if doc is None:
+                continue
+            path, title, _, prompt = doc
+            results.append(
+                {
+                    "path": path,
+                    "title": title,
+                    "score": round(score, 3),
+                    "steps": [
+                        step.title
+                        for step in prompt.steps
+                        if any(term in step.title.lower() for term in terms)
+                    ],
+                    "snippet": build_search_snippet(prompt.base_prompt, words),
+                }
+            )
+        self.stats["queries"] += 1
+        return {"results": results}
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            "docs": len(self.docs),
+            "terms": len(self.postings),
+            "postings": sum(len(ids) for ids, _ in self.postings.values()),
+            "dead": self.dead,
         }
-        SYSTEM_PROMPT_CACHE.update({"path": path, "mtime": mtime, "data": data})
-        logger.info("系统提示词已加载: %s (steps=%d)", path, len(step_meta))
-        return data
+
+
+PROMPT_SEARCH = PromptSearchIndex()
 
 
 def load_user_prompt_text():
@@ -572,13 +1829,50 @@ def normalize_for_compare(text):
 
 
 def redact_for_log(text):
+    # 规则顺序与逐条替换保持一致；替换不会引入新的 "@"、数字或更长的连续字符段，
+    # 因此每条规则前的廉价判断都是命中的必要条件，跳过不会改变结果。
+    aligned = text.encode("ascii", "replace")
     redacted = text
-    redacted = BEARER_RE.sub("Bearer ***", redacted)
-    redacted = KEY_RE.sub("sk-***", redacted)
-    redacted = EMAIL_RE.sub("***@***", redacted)
-    redacted = PHONE_RE.sub("***", redacted)
-    redacted = TOKEN_RE.sub("***", redacted)
-    return redacted
+    changed = False
+    if b"bearer" in aligned.lower():
+        redacted = BEARER_RE.sub("Bearer ***", redacted)
+        changed = True
+    if "sk-" in redacted:
+        redacted = KEY_RE.sub("sk-***", redacted)
+        changed = True
+    if "@" in redacted:
+        redacted = EMAIL_RE.sub("***@***", redacted)
+        changed = True
+    if PHONE_HINT_RE.search(redacted):
+        redacted = PHONE_RE.sub("***", redacted)
+        changed = True
+    if changed:
+        aligned = redacted.encode("ascii", "replace")
+    runs = aligned.translate(REDACT_RUN_TABLE)
+    start = runs.find(REDACT_TOKEN_RUN)
+    if start < 0:
+        return redacted
+    # TOKEN_RE 只会命中长度>=20 的连续字符段，带上左右各一个字符（供 \b 判断）逐段替换。
+    parts = []
+    last = 0
+    total = len(redacted)
+    while start >= 0:
+        end = runs.find(b" ", start)
+        if end < 0:
+            end = total
+        left = max(start - 1, 0)
+        right = min(end + 1, total)
+        window = redacted[left:right]
+        replaced = TOKEN_RE.sub("***", window)
+        if replaced != window:
+            parts.append(redacted[last:start])
+            parts.append(replaced[start - left:len(replaced) - (right - end)])
+            last = end
+        start = runs.find(REDACT_TOKEN_RUN, end)
+    if not parts:
+        return redacted
+    parts.append(redacted[last:])
+    return "".join(parts)
 
 
 def build_prompt_preview(prompt, limit=80):
@@ -623,7 +1917,7 @@ def normalize_state(raw_state):
             if not isinstance(entries, list):
                 continue
             normalized_entries = []
-            for entry in entries[-MAX_HISTORY_ITEMS:]:
+            for entry in entries[-STEP_HISTORY_RECENT:]:
                 if not isinstance(entry, dict):
                     continue
                 item = {
@@ -708,6 +2002,16 @@ def normalize_image_config(raw_config):
     return config
 
 
+def merge_image_config(raw_config):
+    config_override = normalize_image_config(raw_config)
+    base_config = get_effective_image_config()
+    return {
+        "api_key": config_override.get("api_key") or base_config.get("api_key", ""),
+        "model": config_override.get("model") or base_config.get("model", ""),
+        "base_url": config_override.get("base_url") or base_config.get("base_url", ""),
+    }
+
+
 def get_llm_config():
     config = get_effective_config()
     api_key = config.get("api_key", "")
@@ -728,119 +2032,861 @@ def get_llm_config():
     return api_key, model, base_url, log_llm
 
 
-def format_llm_messages(messages):
-    parts = []
-    for index, message in enumerate(messages or [], start=1):
-        if not isinstance(message, dict):
-            continue
-        role = normalize_text(str(message.get("role", "")))
-        content = message.get("content", "")
-        content = normalize_text(str(content)) if content is not None else ""
-        parts.append(f"[{index}] role={role}\n{content}")
-    return "\n\n".join(parts).strip()
+class UpstreamResponseTooLarge(ValueError):
+    pass
 
 
-def log_llm_full_input(messages, tag, trace_id):
-    formatted = format_llm_messages(messages)
-    if formatted:
-        logger.info("LLM完整输入 tag=%s trace=%s\n%s", tag, trace_id, formatted)
+def read_json_response(response, max_bytes):
+    # 分块读取上游响应并按需增量解压 gzip，解压后的字节数超过上限时立即中止，
+    # 避免失控的超大响应被完整缓冲后才在 normalize_text 中截断丢弃。
+    # 上游响应是单个 JSON 对象，标准库无法边读边解析，读完（且未超限）后整体解析一次。
+    encoding = (response.headers.get("Content-Encoding") or "").strip().lower()
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if encoding == "gzip" else None
+    declared = (response.headers.get("Content-Length") or "").strip()
+    if decompressor is None and declared.isdigit() and int(declared) > max_bytes:
+        raise UpstreamResponseTooLarge(f"上游响应超过上限: {declared} bytes")
+    body = bytearray()
+    while True:
+        chunk = response.read(RESPONSE_CHUNK_BYTES)
+        if not chunk:
+            break
+        if decompressor is not None:
+            # max_length 限制单次解压输出，防止高压缩比的响应瞬间膨胀。
+            chunk = decompressor.decompress(chunk, max_bytes - len(body) + 1)
+        body.extend(chunk)
+        if len(body) > max_bytes:
+            raise UpstreamResponseTooLarge(f"上游响应超过上限: >{max_bytes} bytes")
+    if decompressor is not None:
+        body.extend(decompressor.flush())
+        if len(body) > max_bytes:
+            raise UpstreamResponseTooLarge(f"上游响应超过上限: >{max_bytes} bytes")
+    return json.loads(body)
+
+
+class UpstreamAborted(Exception):
+    pass
+
+
+class CallCancellation:
+    # 一次客户端请求内所有上游调用共用的取消标记：取消时中止进行中的请求，
+    # 尚未发出的调用与重试不再发出。
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.requests = set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def attach(self, request):
+        with self.lock:
+            self.requests.add(request)
+            cancelled = self.event.is_set()
+        if cancelled:
+            request.abort()
+
+    def detach(self, request):
+        with self.lock:
+            self.requests.discard(request)
+
+    def cancel(self):
+        with self.lock:
+            self.event.set()
+            requests = list(self.requests)
+        for request in requests:
+            request.abort()
+
+    def wait(self, seconds):
+        return self.event.wait(seconds)
+
+
+class ClientDisconnectMonitor:
+    # 单个后台线程监视所有正在等待上游结果的客户端连接：连接可读且读到 EOF（对端关闭或半关闭）
+    # 或连接出错时取消对应调用。请求体已读完，正常情况下等待期间客户端不会再发数据。
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.watched = {}
+        self.pid = None
+
+    def watch(self, sock, cancel):
+        with self.lock:
+            self.watched[sock] = cancel
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                threading.Thread(target=self._run, name="client-monitor", daemon=True).start()
+        self.wakeup.set()
+
+    def unwatch(self, sock):
+        with self.lock:
+            self.watched.pop(sock, None)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                watched = list(self.watched)
+            if not watched:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            with selectors.DefaultSelector() as selector:
+                for sock in watched:
+                    try:
+                        selector.register(sock, selectors.EVENT_READ)
+                    except (ValueError, OSError):
+                        continue
+                ready = selector.select(self.interval) if selector.get_map() else []
+            for key, _ in ready:
+                try:
+                    data = key.fileobj.recv(1, socket.MSG_PEEK)
+                except OSError:
+                    data = b""
+                with self.lock:
+                    cancel = self.watched.pop(key.fileobj, None)
+                if cancel is None or data:
+                    # 客户端提前发来下一请求等数据时无法据此判断连接状态，不再监视。
+                    continue
+                LLM_CANCEL_STATS.record_disconnect()
+                cancel.cancel()
 
 
-def log_llm_full_output(content, tag, trace_id):
-    text = normalize_text(str(content)) if content is not None else ""
-    logger.info("LLM完整输出 tag=%s trace=%s\n%s", tag, trace_id, text)
+CLIENT_MONITOR = ClientDisconnectMonitor(CLIENT_POLL_SECONDS)
 
 
-def call_llm(messages, temperature, tag="", trace_id=""):
-    api_key, model, base_url, log_llm = get_llm_config()
-    payload = {
-        "model": model,
-        "messages": messages,
-        "temperature": temperature,
-    }
-    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}",
-    }
+class RequestTracker:
+    # 按处理线程登记进行中的请求，供 /api/debug/profile 列出各请求的 trace、阶段与已耗时；
+    # 非请求线程（预取、摘要等后台任务）调用 update 时不登记。
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = {}
 
-    msg_count = len(messages)
-    msg_chars = sum(len(str(item.get("content", ""))) for item in messages if isinstance(item, dict))
-    logger.info(
-        "LLM请求开始 tag=%s trace=%s model=%s msgs=%d chars=%d temp=%.2f",
-        tag,
-        trace_id,
-        model,
-        msg_count,
-        msg_chars,
-        temperature,
-    )
+    def begin(self, method, path, client):
+        with self.lock:
+            self.active[threading.get_ident()] = {
+                "method": method,
+                "path": path,
+                "client": client,
+                "trace_id": "",
+                "stage": "handler",
+                "started": time.monotonic(),
+            }
 
-    if log_llm:
-        log_llm_full_input(messages, tag, trace_id)
+    def update(self, **fields):
+        entry = self.active.get(threading.get_ident())
+        if entry is not None:
+            entry.update(fields)
+
+    def end(self):
+        with self.lock:
+            self.active.pop(threading.get_ident(), None)
+
+    def idents(self):
+        with self.lock:
+            return set(self.active)
+
+    def snapshot(self, exclude=None):
+        now = time.monotonic()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        with self.lock:
+            entries = [
+                (ident, dict(entry)) for ident, entry in self.active.items() if ident != exclude
+            ]
+        result = []
+        for ident, entry in entries:
+            started = entry.pop("started")
+            entry["age_ms"] = round((now - started) * 1000)
+            entry["thread"] = names.get(ident, str(ident))
+            result.append(entry)
+        result.sort(key=lambda item: item["age_ms"], reverse=True)
+        return result
 
-    for attempt in range(RETRY_COUNT):
-        attempt_start = time.monotonic()
-        request = urllib.request.Request(base_url, data=data, headers=headers, method="POST")
-        try:
-            with urllib.request.urlopen(request, timeout=TIMEOUT_SECONDS) as response:
-                body = response.read().decode("utf-8")
-            result = json.loads(body)
-            content = (
-                result.get("choices", [{}])[0]
-                .get("message", {})
-                .get("content", "")
+
+REQUEST_TRACKER = RequestTracker()
+
+
+def upstream_connection_key(parsed):
+    proxy = urllib.request.getproxies().get(parsed.scheme, "")
+    if proxy and urllib.request.proxy_bypass(parsed.hostname or ""):
+        proxy = ""
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    return parsed.scheme, parsed.hostname, port, proxy
+
+
+def create_upstream_connection(parsed, timeout):
+    connection_class = (
+        http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+    )
+    extra = {"context": UPSTREAM_SSL_CONTEXT} if parsed.scheme == "https" else {}
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    proxy = urllib.request.getproxies().get(parsed.scheme, "")
+    if not proxy or urllib.request.proxy_bypass(parsed.hostname or ""):
+        return connection_class(parsed.hostname, port, timeout=timeout, **extra)
+    proxy_url = urllib.parse.urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+    proxy_class = (
+        http.client.HTTPSConnection if proxy_url.scheme == "https" else http.client.HTTPConnection
+    )
+    if proxy_class is http.client.HTTPConnection and parsed.scheme == "https":
+        # 通过 HTTP 代理 CONNECT 隧道访问 HTTPS 上游。
+        proxy_class = http.client.HTTPSConnection
+    connection = proxy_class(
+        proxy_url.hostname,
+        proxy_url.port or 8080,
+        timeout=timeout,
+        **({"context": UPSTREAM_SSL_CONTEXT} if proxy_class is http.client.HTTPSConnection else {}),
+    )
+    tunnel_headers = {}
+    if proxy_url.username:
+        credentials = f"{urllib.parse.unquote(proxy_url.username)}:{urllib.parse.unquote(proxy_url.password or '')}"
+        tunnel_headers["Proxy-Authorization"] = (
+            "Basic " + base64.b64encode(credentials.encode("utf-8")).decode("ascii")
+        )
+    connection.set_tunnel(parsed.hostname, port, headers=tunnel_headers)
+    return connection
+
+
+class UpstreamConnectionPool:
+    # 上游 keep-alive 连接池：按 (协议, 主机, 端口, 代理) 复用已完成握手的连接，
+    # 空闲超过 UPSTREAM_IDLE_SECONDS 的连接丢弃，避免拿到已被对端关闭的连接。
+    def __init__(self, max_idle, idle_seconds):
+        self.max_idle = max_idle
+        self.idle_seconds = idle_seconds
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.stats = {"created": 0, "reused": 0, "stale": 0, "warmed": 0}
+
+    def acquire(self, key):
+        expired = []
+        connection = None
+        now = time.monotonic()
+        with self.lock:
+            connections = self.idle.get(key, [])
+            while connections:
+                candidate, released_at = connections.pop()
+                if now - released_at <= self.idle_seconds:
+                    connection = candidate
+                    self.stats["reused"] += 1
+                    break
+                expired.append(candidate)
+            if connection is None:
+                self.stats["created"] += 1
+        for item in expired:
+            item.close()
+        return connection
+
+    def release(self, key, connection, warmed=False):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append((connection, time.monotonic()))
+                if warmed:
+                    self.stats["warmed"] += 1
+                return
+        connection.close()
+
+    def prewarm(self, url, count, timeout):
+        # 预先完成 TCP/TLS 握手并放入空闲连接，首个真实请求可直接复用。
+        parsed = urllib.parse.urlsplit(url)
+        key = upstream_connection_key(parsed)
+        for _ in range(count):
+            connection = create_upstream_connection(parsed, timeout)
+            connection.connect()
+            self.release(key, connection, warmed=True)
+        return key
+
+    def record_stale(self):
+        with self.lock:
+            self.stats["stale"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["idle"] = {
+                f"{scheme}://{host}:{port}": len(items)
+                for (scheme, host, port, _), items in self.idle.items()
+            }
+        return stats
+
+
+UPSTREAM_CONNECTIONS = UpstreamConnectionPool(UPSTREAM_POOL_MAX_IDLE, UPSTREAM_IDLE_SECONDS)
+
+
+class UpstreamRequest:
+    # 单次上游 POST 请求；持有底层连接，可由其他线程调用 abort() 立即中止。
+    def __init__(self, url, data, headers, timeout):
+        self.url = url
+        self.data = data
+        self.headers = headers
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.connection = None
+        self.aborted = False
+
+    def abort(self):
+        # 在锁内关闭 socket：请求完成后连接会先解除关联再放回连接池，
+        # 不会误关已被其他请求复用的连接。
+        with self.lock:
+            self.aborted = True
+            sock = getattr(self.connection, "sock", None)
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def _attach(self, connection):
+        with self.lock:
+            if self.aborted:
+                connection.close()
+                raise UpstreamAborted("上游请求已取消")
+            self.connection = connection
+
+    def execute(self, max_bytes):
+        parsed = urllib.parse.urlsplit(self.url)
+        path = parsed.path or "/"
+        if parsed.query:
+            path = f"{path}?{parsed.query}"
+        key = upstream_connection_key(parsed)
+        connection = UPSTREAM_CONNECTIONS.acquire(key)
+        reused = connection is not None
+        keep = False
+        try:
+            while True:
+                if connection is None:
+                    connection = create_upstream_connection(parsed, self.timeout)
+                elif connection.sock is not None:
+                    connection.sock.settimeout(self.timeout)
+                self._attach(connection)
+                try:
+                    if connection.sock is None:
+                        connection.connect()
+                        # 建连期间 socket 尚不存在，abort() 无法关闭，连上后再检查一次，避免仍发出请求。
+                        self._attach(connection)
+                    connection.request("POST", path, body=self.data, headers=self.headers)
+                    response = connection.getresponse()
+                    break
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    if not reused or self.aborted:
+                        raise
+                    # 复用的空闲连接可能已被上游关闭，换新连接重试一次。
+                    UPSTREAM_CONNECTIONS.record_stale()
+                    connection.close()
+                    connection = None
+                    reused = False
+            if not 200 <= response.status < 300:
+                raise urllib.error.HTTPError(
+                    self.url, response.status, response.reason, response.headers, None
+                )
+            result = read_json_response(response, max_bytes)
+            keep = not response.will_close
+            return result
+        except (OSError, http.client.HTTPException) as exc:
+            if self.aborted:
+                raise UpstreamAborted("上游请求已取消") from exc
+            if isinstance(exc, (urllib.error.URLError, TimeoutError)):
+                raise
+            raise urllib.error.URLError(exc) from exc
+        finally:
+            with self.lock:
+                self.connection = None
+                keep = keep and not self.aborted
+            if connection is not None:
+                if keep:
+                    UPSTREAM_CONNECTIONS.release(key, connection)
+                else:
+                    connection.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class HedgePolicy:
+    # 对冲请求策略：按 (tag, model) 记录最近的成功耗时，超过 p90 仍未返回时
+    # 再发一份相同请求；令牌桶限制对冲带来的额外请求比例。
+    def __init__(self, enabled, max_ratio, min_samples, min_ms):
+        self.enabled = enabled
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self.min_ms = min_ms
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.budget = 0.0
+        self.stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "budget_denied": 0}
+
+    def observe(self, key, elapsed_ms):
+        with self.lock:
+            window = self.latencies.get(key)
+            if window is None:
+                window = self.latencies[key] = deque(maxlen=LATENCY_WINDOW)
+            window.append(elapsed_ms)
+
+    def threshold(self, key):
+        # 返回对冲等待秒数；样本不足时返回 None，不做对冲。
+        with self.lock:
+            samples = list(self.latencies.get(key, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return max(percentile(samples, LLM_HEDGE_PERCENTILE), self.min_ms) / 1000
+
+    def start_request(self):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.budget = min(self.budget + self.max_ratio, LLM_HEDGE_BURST)
+
+    def acquire(self):
+        with self.lock:
+            if self.budget >= 1:
+                self.budget -= 1
+                self.stats["hedged"] += 1
+                return True
+            self.stats["budget_denied"] += 1
+            return False
+
+    def record_win(self):
+        with self.lock:
+            self.stats["hedge_wins"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            windows = {key: list(values) for key, values in self.latencies.items()}
+        stats["enabled"] = self.enabled
+        stats["max_ratio"] = self.max_ratio
+        stats["hedge_rate"] = round(stats["hedged"] / stats["requests"], 4) if stats["requests"] else 0.0
+        stats["win_rate"] = round(stats["hedge_wins"] / stats["hedged"], 4) if stats["hedged"] else 0.0
+        stats["thresholds_ms"] = {
+            f"{tag}|{model}": round(percentile(values, LLM_HEDGE_PERCENTILE))
+            for (tag, model), values in windows.items()
+            if len(values) >= self.min_samples
+        }
+        return stats
+
+
+LLM_HEDGE = HedgePolicy(
+    LLM_HEDGE_ENABLED, LLM_HEDGE_MAX_RATIO, LLM_HEDGE_MIN_SAMPLES, LLM_HEDGE_MIN_MS
+)
+
+
+class UpstreamEndpoint:
+    def __init__(self, name, base_url, api_key, weight):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.weight = weight
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def headers(self):
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}",
+            "Accept-Encoding": "gzip",
+            "User-Agent": UPSTREAM_USER_AGENT,
+        }
+
+
+class EndpointPool:
+    # 上游端点池：按 (未完成请求数 + 1) / 权重 选最空闲的健康端点；
+    # 连续失败达到阈值的端点熔断一段时间，冷却后重新参与选择。
+    def __init__(self, breaker=True):
+        self.breaker = breaker
+        self.lock = threading.Lock()
+        self.endpoints = []
+        self.signature = None
+        self.version = None
+
+    def sync(self, specs, version=None):
+        with self.lock:
+            if version is not None and version == self.version:
+                return
+        signature = tuple(
+            (item["name"], item["base_url"], item["api_key"], item["weight"]) for item in specs
+        )
+        with self.lock:
+            self.version = version
+            if signature == self.signature:
+                return
+            existing = {(item.base_url, item.api_key): item for item in self.endpoints}
+            endpoints = []
+            for name, base_url, api_key, weight in signature:
+                endpoint = existing.get((base_url, api_key))
+                if endpoint is None:
+                    endpoint = UpstreamEndpoint(name, base_url, api_key, weight)
+                endpoint.name = name
+                endpoint.weight = weight
+                endpoints.append(endpoint)
+            self.endpoints = endpoints
+            self.signature = signature
+
+    def contains(self, base_url, api_key):
+        with self.lock:
+            return any(
+                item.base_url == base_url and item.api_key == api_key for item in self.endpoints
             )
-            content = normalize_text(content, MAX_OUTPUT_LEN)
-            if not content:
-                raise ValueError("模型返回内容为空")
-            elapsed_ms = (time.monotonic() - attempt_start) * 1000
-            logger.info(
-                "LLM请求成功 tag=%s trace=%s attempt=%d elapsed_ms=%.0f resp_chars=%d",
-                tag,
-                trace_id,
-                attempt + 1,
-                elapsed_ms,
-                len(content),
+
+    def select(self, name=""):
+        # 指定名称时只用同名端点；名称不存在则退回全部端点。
+        if name:
+            named = [item for item in self.endpoints if item.name == name]
+            if named:
+                return named
+        return list(self.endpoints)
+
+    def has_untried(self, tried, name=""):
+        now = time.monotonic()
+        with self.lock:
+            return any(
+                item not in tried and item.down_until <= now for item in self.select(name)
             )
-            if log_llm:
-                log_llm_full_output(content, tag, trace_id)
-            return content
-        except urllib.error.HTTPError as exc:
-            retryable = exc.code in {429, 500, 502, 503, 504}
-            elapsed_ms = (time.monotonic() - attempt_start) * 1000
-            logger.warning(
-                "LLM请求HTTP错误 tag=%s trace=%s attempt=%d status=%s elapsed_ms=%.0f",
-                tag,
-                trace_id,
-                attempt + 1,
-                exc.code,
-                elapsed_ms,
+
+    def acquire(self, exclude=(), name=""):
+        now = time.monotonic()
+        with self.lock:
+            endpoints = self.select(name)
+            candidates = [item for item in endpoints if item not in exclude]
+            candidates = candidates or endpoints
+            healthy = [item for item in candidates if item.down_until <= now]
+            if not healthy:
+                # 全部熔断时选最早恢复的端点，避免直接拒绝请求。
+                healthy = [min(candidates, key=lambda item: item.down_until)]
+            endpoint = min(
+                healthy,
+                key=lambda item: ((item.outstanding + 1) / item.weight, random.random()),
             )
-            if retryable and attempt < RETRY_COUNT - 1:
-                time.sleep(1.5 ** attempt)
-                continue
-            raise
-        except (urllib.error.URLError, TimeoutError, ValueError, json.JSONDecodeError):
-            elapsed_ms = (time.monotonic() - attempt_start) * 1000
-            logger.warning(
-                "LLM请求失败 tag=%s trace=%s attempt=%d elapsed_ms=%.0f",
-                tag,
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint, elapsed_ms=None, failed=False):
+        with self.lock:
+            endpoint.outstanding -= 1
+            if not failed:
+                endpoint.consecutive_failures = 0
+                endpoint.down_until = 0.0
+                if elapsed_ms is not None:
+                    endpoint.latencies.append(elapsed_ms)
+                return
+            endpoint.errors += 1
+            endpoint.consecutive_failures += 1
+            if not self.breaker or endpoint.consecutive_failures < LLM_ENDPOINT_FAILURE_THRESHOLD:
+                return
+            endpoint.down_until = time.monotonic() + LLM_ENDPOINT_COOLDOWN_S
+            failures = endpoint.consecutive_failures
+        logger.warning(
+            "LLM端点暂停使用 endpoint=%s failures=%d cooldown_s=%d",
+            endpoint.name,
+            failures,
+            LLM_ENDPOINT_COOLDOWN_S,
+        )
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            endpoints = [
+                (item, list(item.latencies), item.outstanding, item.requests, item.errors,
+                 item.down_until)
+                for item in self.endpoints
+            ]
+        stats = []
+        for item, latencies, outstanding, requests, errors, down_until in endpoints:
+            stats.append(
+                {
+                    "name": item.name,
+                    "base_url": item.base_url,
+                    "weight": item.weight,
+                    "outstanding": outstanding,
+                    "requests": requests,
+                    "errors": errors,
+                    "error_rate": round(errors / requests, 4) if requests else 0.0,
+                    "healthy": down_until <= now,
+                    "cooldown_s": max(0, round(down_until - now)),
+                    "p50_ms": round(percentile(latencies, 0.5)) if latencies else None,
+                    "p90_ms": round(percentile(latencies, 0.9)) if latencies else None,
+                }
+            )
+        return stats
+
+
+LLM_POOL = EndpointPool()
+
+
+def get_llm_pool(base_url, api_key):
+    # 配置了端点列表时，默认配置与列表内端点的请求走共享端点池；
+    # 其余（如对话中临时填写的配置）使用单端点的临时池，不计入统计也不熔断。
+    snapshot = get_config_snapshot()
+    config = snapshot.values
+    default = (config.get("base_url", "") or DEFAULT_BASE_URL, config.get("api_key", ""))
+    specs = config.get("endpoints") or [
+        {"name": "default", "base_url": default[0], "api_key": default[1], "weight": 1.0}
+    ]
+    LLM_POOL.sync(specs, snapshot.version)
+    if (base_url, api_key) == default or LLM_POOL.contains(base_url, api_key):
+        return LLM_POOL
+    pool = EndpointPool(breaker=False)
+    pool.sync([{"name": "override", "base_url": base_url, "api_key": api_key, "weight": 1.0}])
+    return pool
+
+
+def is_endpoint_failure(exc):
+    if isinstance(exc, urllib.error.HTTPError):
+        return exc.code in {401, 403, 429} or exc.code >= 500
+    return isinstance(exc, (urllib.error.URLError, TimeoutError, ValueError))
+
+
+def execute_llm_request(pool, data, key, trace_id="", tried=None, endpoint_name="", cancel=None):
+    # tried 收集本次调用已用过的端点，重试与对冲都优先换到其他端点。
+    tried = tried if tried is not None else set()
+    LLM_HEDGE.start_request()
+    threshold = LLM_HEDGE.threshold(key) if LLM_HEDGE.enabled else None
+    results = queue.Queue()
+    requests = []
+
+    def run(request, endpoint, index):
+        start = time.monotonic()
+        try:
+            result = request.execute(LLM_RESPONSE_MAX_BYTES)
+        except UpstreamAborted as exc:
+            pool.release(endpoint)
+            results.put((index, endpoint, None, exc))
+        except Exception as exc:
+            pool.release(endpoint, failed=is_endpoint_failure(exc))
+            results.put((index, endpoint, None, exc))
+        else:
+            pool.release(endpoint, (time.monotonic() - start) * 1000)
+            results.put((index, endpoint, result, None))
+
+    def launch():
+        endpoint = pool.acquire(exclude=tried, name=endpoint_name)
+        tried.add(endpoint)
+        request = UpstreamRequest(endpoint.base_url, data, endpoint.headers(), TIMEOUT_SECONDS)
+        requests.append(request)
+        if cancel is not None:
+            cancel.attach(request)
+        if threshold is None:
+            run(request, endpoint, 0)
+            return
+        threading.Thread(
+            target=run,
+            args=(request, endpoint, len(requests) - 1),
+            name=f"llm-{trace_id or 'call'}-{len(requests)}",
+            daemon=True,
+        ).start()
+
+    launch()
+    received = []
+    try:
+        received.append(results.get(timeout=threshold))
+    except queue.Empty:
+        if LLM_HEDGE.acquire():
+            logger.info(
+                "LLM对冲请求发出 tag=%s trace=%s threshold_ms=%.0f",
+                key[0],
                 trace_id,
-                attempt + 1,
-                elapsed_ms,
+                threshold * 1000,
             )
-            if attempt < RETRY_COUNT - 1:
-                time.sleep(1.5 ** attempt)
-                continue
-            raise
+            launch()
+    # 取最先成功的结果；先返回的失败且另一路仍在进行时继续等待。
+    while not received or (received[-1][3] is not None and len(received) < len(requests)):
+        received.append(results.get())
+    index, endpoint, result, error = received[-1]
+    for request in requests:
+        request.abort()
+        if cancel is not None:
+            cancel.detach(request)
+    if error is not None:
+        raise error
+    if index == 1:
+        LLM_HEDGE.record_win()
+        logger.info(
+            "LLM对冲请求胜出 tag=%s trace=%s endpoint=%s", key[0], trace_id, endpoint.name
+        )
+    return result, endpoint
+
+
+def format_transcript_messages(messages):
+    formatted = []
+    for message in messages or []:
+        if not isinstance(message, dict):
+            continue
+        role = normalize_text(str(message.get("role", "")))
+        content = message.get("content", "")
+        content = normalize_text(str(content)) if content is not None else ""
+        formatted.append({"role": role, "content": redact_for_log(content)})
+    return formatted
+
+
+def record_llm_transcript(
+    messages, content, tag, trace_id, model, latency_ms, attempts, usage=None, error=""
+):
+    record = {
+        "trace_id": trace_id,
+        "tag": tag,
+        "model": model,
+        "ts": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "messages": format_transcript_messages(messages),
+        "output": redact_for_log(normalize_text(str(content))) if content else "",
+        "latency_ms": round(latency_ms),
+        "attempts": attempts,
+        "usage": usage if isinstance(usage, dict) else None,
+    }
+    if error:
+        record["error"] = error
+    try:
+        TRANSCRIPT_STORE.append(record)
+    except OSError:
+        logger.exception("LLM完整记录写入失败 tag=%s trace=%s", tag, trace_id)
+
+
+def match_llm_route(tag, prompt_routes=None):
+    # 配置中的规则优先于提示词头信息中的规则，各自按顺序取第一条匹配。
+    rules = list(get_effective_config().get("routes") or []) + list(prompt_routes or [])
+    tag = (tag or "").upper()
+    for rule in rules:
+        if fnmatch.fnmatchcase(tag, rule["match"]):
+            return rule
+    return None
+
 
+class RouteStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def record(self, route, model, elapsed_ms, failed=False):
+        with self.lock:
+            entry = self.routes.get((route, model))
+            if entry is None:
+                entry = self.routes[(route, model)] = {
+                    "calls": 0,
+                    "errors": 0,
+                    "latencies": deque(maxlen=LATENCY_WINDOW),
+                }
+            entry["calls"] += 1
+            if failed:
+                entry["errors"] += 1
+            else:
+                entry["latencies"].append(elapsed_ms)
+
+    def snapshot(self):
+        with self.lock:
+            entries = [
+                (route, model, entry["calls"], entry["errors"], list(entry["latencies"]))
+                for (route, model), entry in self.routes.items()
+            ]
+        return [
+            {
+                "route": route,
+                "model": model,
+                "calls": calls,
+                "errors": errors,
+                "p50_ms": round(percentile(latencies, 0.5)) if latencies else None,
+                "p90_ms": round(percentile(latencies, 0.9)) if latencies else None,
+            }
+            for route, model, calls, errors, latencies in entries
+        ]
+
+
+LLM_ROUTE_STATS = RouteStats()
+
+
+class LLMCancelStats:
+    # 客户端断开导致的上游调用取消计数。节省的 token 按同一标签近期成功调用的平均用量估算：
+    # 进行中被中止的调用只计输出部分（输入通常已计费），未发出的调用或重试计输入与输出。
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.usage = {}
+        self.stats = {"client_disconnects": 0, "aborted_calls": 0, "skipped_calls": 0, "tokens_saved_est": 0}
+
+    def observe(self, tag, prompt_chars, output_chars, usage):
+        usage = usage if isinstance(usage, dict) else {}
+        prompt_tokens = usage.get("prompt_tokens")
+        completion_tokens = usage.get("completion_tokens")
+        if not isinstance(prompt_tokens, int) or not isinstance(completion_tokens, int):
+            prompt_tokens = prompt_chars * LLM_TOKENS_PER_CHAR
+            completion_tokens = output_chars * LLM_TOKENS_PER_CHAR
+        ratio = prompt_tokens / max(1, prompt_chars)
+        with self.lock:
+            entry = self.usage.get(tag)
+            if entry is None:
+                self.usage[tag] = [ratio, completion_tokens]
+                return
+            entry[0] += (ratio - entry[0]) * LLM_USAGE_EMA_ALPHA
+            entry[1] += (completion_tokens - entry[1]) * LLM_USAGE_EMA_ALPHA
+
+    def record_disconnect(self):
+        with self.lock:
+            self.stats["client_disconnects"] += 1
+
+    def record(self, tag, prompt_chars, in_flight):
+        with self.lock:
+            ratio, completion = self.usage.get(tag, (LLM_TOKENS_PER_CHAR, LLM_COMPLETION_TOKENS_ESTIMATE))
+            saved = completion if in_flight else prompt_chars * ratio + completion
+            self.stats["aborted_calls" if in_flight else "skipped_calls"] += 1
+            self.stats["tokens_saved_est"] += round(saved)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+LLM_CANCEL_STATS = LLMCancelStats()
+
+
+def wait_before_retry(seconds, cancel):
+    # 退避等待期间客户端断开时立即结束等待，由调用方在下一轮开始前放弃重试。
+    REQUEST_TRACKER.update(stage="backoff")
+    if cancel is None:
+        time.sleep(seconds)
+    else:
+        cancel.wait(seconds)
 
-def call_llm_with_config(messages, temperature, config, tag="", trace_id=""):
+
+def call_llm(messages, temperature, tag="", trace_id="", routes=None, cancel=None):
+    api_key, model, base_url, log_llm = get_llm_config()
+    config = {
+        "api_key": api_key,
+        "model": model,
+        "base_url": base_url,
+        "log_llm": log_llm,
+    }
+    route = match_llm_route(tag, routes)
+    route_name = "default"
+    if route:
+        route_name = route["match"]
+        config["model"] = route["model"] or model
+        config["endpoint"] = route["endpoint"]
+    start = time.monotonic()
+    try:
+        content = call_llm_with_config(
+            messages, temperature, config, tag=tag, trace_id=trace_id, cancel=cancel
+        )
+    except UpstreamAborted:
+        raise
+    except Exception:
+        LLM_ROUTE_STATS.record(
+            route_name, config["model"], (time.monotonic() - start) * 1000, failed=True
+        )
+        raise
+    LLM_ROUTE_STATS.record(route_name, config["model"], (time.monotonic() - start) * 1000)
+    return content
+
+
+def call_llm_with_config(messages, temperature, config, tag="", trace_id="", cancel=None):
     api_key = config.get("api_key", "")
     model = config.get("model", "") or DEFAULT_MODEL
     base_url = config.get("base_url", "") or DEFAULT_BASE_URL
     log_llm = bool(config.get("log_llm"))
+    endpoint_name = config.get("endpoint", "")
     if not api_key:
         raise ValueError("缺少环境变量 API_KEY")
     if not base_url.startswith("https://"):
@@ -851,10 +2897,7 @@ def call_llm_with_config(messages, temperature, config, tag="", trace_id=""):
         "temperature": temperature,
     }
     data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}",
-    }
+    pool = get_llm_pool(base_url, api_key)
 
     msg_count = len(messages)
     msg_chars = sum(len(str(item.get("content", ""))) for item in messages if isinstance(item, dict))
@@ -868,16 +2911,25 @@ def call_llm_with_config(messages, temperature, config, tag="", trace_id=""):
         temperature,
     )
 
-    if log_llm:
-        log_llm_full_input(messages, tag, trace_id)
-
+    call_start = time.monotonic()
+    tried = set()
     for attempt in range(RETRY_COUNT):
+        if cancel is not None and cancel.cancelled:
+            LLM_CANCEL_STATS.record(tag, msg_chars, in_flight=False)
+            logger.info("LLM请求取消 tag=%s trace=%s attempt=%d 客户端已断开，不再发出", tag, trace_id, attempt + 1)
+            raise UpstreamAborted("客户端已断开")
+        REQUEST_TRACKER.update(trace_id=trace_id, stage=f"llm {tag} attempt={attempt + 1}")
         attempt_start = time.monotonic()
-        request = urllib.request.Request(base_url, data=data, headers=headers, method="POST")
         try:
-            with urllib.request.urlopen(request, timeout=TIMEOUT_SECONDS) as response:
-                body = response.read().decode("utf-8")
-            result = json.loads(body)
+            result, endpoint = execute_llm_request(
+                pool,
+                data,
+                (tag, model),
+                trace_id=trace_id,
+                tried=tried,
+                endpoint_name=endpoint_name,
+                cancel=cancel,
+            )
             content = (
                 result.get("choices", [{}])[0]
                 .get("message", {})
@@ -887,19 +2939,45 @@ def call_llm_with_config(messages, temperature, config, tag="", trace_id=""):
             if not content:
                 raise ValueError("模型返回内容为空")
             elapsed_ms = (time.monotonic() - attempt_start) * 1000
+            LLM_HEDGE.observe((tag, model), elapsed_ms)
+            LLM_CANCEL_STATS.observe(tag, msg_chars, len(content), result.get("usage"))
             logger.info(
-                "LLM请求成功 tag=%s trace=%s attempt=%d elapsed_ms=%.0f resp_chars=%d",
+                "LLM请求成功 tag=%s trace=%s attempt=%d elapsed_ms=%.0f resp_chars=%d endpoint=%s",
                 tag,
                 trace_id,
                 attempt + 1,
                 elapsed_ms,
                 len(content),
+                endpoint.name,
             )
             if log_llm:
-                log_llm_full_output(content, tag, trace_id)
+                record_llm_transcript(
+                    messages,
+                    content,
+                    tag,
+                    trace_id,
+                    model,
+                    (time.monotonic() - call_start) * 1000,
+                    attempt + 1,
+                    usage=result.get("usage"),
+                )
+            REQUEST_TRACKER.update(stage="handler")
             return content
+        except UpstreamAborted:
+            LLM_CANCEL_STATS.record(tag, msg_chars, in_flight=True)
+            logger.info(
+                "LLM请求取消 tag=%s trace=%s attempt=%d elapsed_ms=%.0f 客户端已断开，已中止上游请求",
+                tag,
+                trace_id,
+                attempt + 1,
+                (time.monotonic() - attempt_start) * 1000,
+            )
+            raise
         except urllib.error.HTTPError as exc:
-            retryable = exc.code in {429, 500, 502, 503, 504}
+            # 鉴权失败只针对单个端点，有其他端点时同样切换重试。
+            retryable = exc.code in {429, 500, 502, 503, 504} or (
+                exc.code in {401, 403} and pool.has_untried(tried, endpoint_name)
+            )
             elapsed_ms = (time.monotonic() - attempt_start) * 1000
             logger.warning(
                 "LLM请求HTTP错误 tag=%s trace=%s attempt=%d status=%s elapsed_ms=%.0f",
@@ -910,10 +2988,22 @@ def call_llm_with_config(messages, temperature, config, tag="", trace_id=""):
                 elapsed_ms,
             )
             if retryable and attempt < RETRY_COUNT - 1:
-                time.sleep(1.5 ** attempt)
+                if not pool.has_untried(tried, endpoint_name):
+                    wait_before_retry(1.5 ** attempt, cancel)
                 continue
+            if log_llm:
+                record_llm_transcript(
+                    messages,
+                    "",
+                    tag,
+                    trace_id,
+                    model,
+                    (time.monotonic() - call_start) * 1000,
+                    attempt + 1,
+                    error=f"HTTP {exc.code}",
+                )
             raise
-        except (urllib.error.URLError, TimeoutError, ValueError, json.JSONDecodeError):
+        except (urllib.error.URLError, TimeoutError, ValueError, json.JSONDecodeError) as exc:
             elapsed_ms = (time.monotonic() - attempt_start) * 1000
             logger.warning(
                 "LLM请求失败 tag=%s trace=%s attempt=%d elapsed_ms=%.0f",
@@ -922,9 +3012,21 @@ def call_llm_with_config(messages, temperature, config, tag="", trace_id=""):
                 attempt + 1,
                 elapsed_ms,
             )
-            if attempt < RETRY_COUNT - 1:
-                time.sleep(1.5 ** attempt)
+            if attempt < RETRY_COUNT - 1 and not isinstance(exc, UpstreamResponseTooLarge):
+                if not pool.has_untried(tried, endpoint_name):
+                    wait_before_retry(1.5 ** attempt, cancel)
                 continue
+            if log_llm:
+                record_llm_transcript(
+                    messages,
+                    "",
+                    tag,
+                    trace_id,
+                    model,
+                    (time.monotonic() - call_start) * 1000,
+                    attempt + 1,
+                    error=type(exc).__name__,
+                )
             raise
 
 
@@ -935,11 +3037,13 @@ def build_image_url(base_url):
     return f"{cleaned}{DEFAULT_IMAGE_ENDPOINT}"
 
 
-def build_image_payload(prompt, model, base_url):
+def build_image_payload(prompt, model, base_url, seed=None):
     payload = {"model": model, "prompt": prompt}
     if "volces" in (base_url or "").lower():
         payload["size"] = "2K"
         payload["watermark"] = False
+    if seed is not None:
+        payload["seed"] = seed
     return payload
 
 
@@ -969,22 +3073,28 @@ def summarize_image_result(result, images):
     return summary
 
 
-def call_image_generation(prompt, config, trace_id=""):
-    api_key = config.get("api_key", "")
-    model = config.get("model", "")
-    base_url = config.get("base_url", "")
-    if not api_key:
+def check_image_config(config):
+    if not config.get("api_key", ""):
         raise ValueError("缺少环境变量 IMG_API_KEY")
-    if not base_url.startswith("https://"):
+    if not config.get("base_url", "").startswith("https://"):
         raise ValueError("IMG_BASE_URL 必须使用 https://")
-    if not model:
+    if not config.get("model", ""):
         raise ValueError("缺少 IMG_MODEL")
+
+
+def call_image_generation(prompt, config, trace_id="", seed=None):
+    check_image_config(config)
+    api_key = config.get("api_key", "")
+    model = config.get("model", "")
+    base_url = config.get("base_url", "")
     url = build_image_url(base_url)
-    payload = build_image_payload(prompt, model, base_url)
+    payload = build_image_payload(prompt, model, base_url, seed=seed)
     data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {api_key}",
+        "Accept-Encoding": "gzip",
+        "User-Agent": UPSTREAM_USER_AGENT,
     }
     provider = "volces" if "volces" in base_url.lower() else "generic"
     parsed_url = urllib.parse.urlparse(url)
@@ -1001,12 +3111,11 @@ def call_image_generation(prompt, config, trace_id=""):
         prompt_preview,
     )
     for attempt in range(RETRY_COUNT):
+        REQUEST_TRACKER.update(trace_id=trace_id, stage=f"image attempt={attempt + 1}")
         attempt_start = time.monotonic()
-        request = urllib.request.Request(url, data=data, headers=headers, method="POST")
+        request = UpstreamRequest(url, data, headers, TIMEOUT_SECONDS)
         try:
-            with urllib.request.urlopen(request, timeout=TIMEOUT_SECONDS) as response:
-                body = response.read().decode("utf-8")
-            result = json.loads(body)
+            result = request.execute(IMAGE_RESPONSE_MAX_BYTES)
             elapsed_ms = (time.monotonic() - attempt_start) * 1000
             logger.info(
                 "生图请求成功 trace=%s attempt=%d elapsed_ms=%.0f",
@@ -1029,7 +3138,7 @@ def call_image_generation(prompt, config, trace_id=""):
                 time.sleep(1.5 ** attempt)
                 continue
             raise
-        except (urllib.error.URLError, TimeoutError, ValueError, json.JSONDecodeError):
+        except (urllib.error.URLError, TimeoutError, ValueError, json.JSONDecodeError) as exc:
             elapsed_ms = (time.monotonic() - attempt_start) * 1000
             logger.warning(
                 "生图请求失败 trace=%s attempt=%d elapsed_ms=%.0f",
@@ -1037,12 +3146,204 @@ def call_image_generation(prompt, config, trace_id=""):
                 attempt + 1,
                 elapsed_ms,
             )
-            if attempt < RETRY_COUNT - 1:
+            if attempt < RETRY_COUNT - 1 and not isinstance(exc, UpstreamResponseTooLarge):
                 time.sleep(1.5 ** attempt)
                 continue
             raise
 
 
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "").strip() or os.path.join(DATA_DIR, "images")
+IMAGE_STORE_MAX_BYTES = get_env_int("IMAGE_STORE_MAX_MB", default=512) * 1024 * 1024
+IMAGE_SHA_RE = re.compile(r"^[0-9a-f]{64}$")
+IMAGE_CONTENT_TYPES = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "jpg": "image/jpeg",
+    "webp": "image/webp",
+    "gif": "image/gif",
+}
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class ImageStore:
+    # 按内容 sha256 寻址的图片目录：同一张图只落盘一次，总大小超过上限时
+    # 按最近访问时间（文件 mtime）淘汰最旧的图片。
+    # 多进程模式下传入共享缓存，淘汰前在其写锁内重新扫描目录，按磁盘实际总量计算上限。
+    def __init__(self, directory, max_bytes, shared=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.entries = None
+        self.total = 0
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        self.total = 0
+        try:
+            iterator = os.scandir(self.directory)
+        except OSError:
+            return
+        with iterator:
+            for entry in iterator:
+                sha, _, ext = entry.name.partition(".")
+                if not IMAGE_SHA_RE.match(sha) or ext not in IMAGE_CONTENT_TYPES:
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                self.entries[sha] = {
+                    "name": entry.name,
+                    "size": stat.st_size,
+                    "atime": stat.st_mtime,
+                }
+                self.total += stat.st_size
+
+    def _adopt(self, sha):
+        # 多进程模式下其它工作进程落盘的图片不在本进程索引中，未命中时按需从磁盘补录。
+        if not IMAGE_SHA_RE.match(sha):
+            return False
+        for ext in IMAGE_CONTENT_TYPES:
+            name = f"{sha}.{ext}"
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            self.entries[sha] = {"name": name, "size": stat.st_size, "atime": stat.st_mtime}
+            self.total += stat.st_size
+            return True
+        return False
+
+    def _forget(self, sha):
+        entry = self.entries.pop(sha)
+        self.total -= entry["size"]
+
+    def _touch(self, sha):
+        entry = self.entries[sha]
+        entry["atime"] = time.time()
+        try:
+            os.utime(os.path.join(self.directory, entry["name"]))
+        except OSError:
+            pass
+
+    def _rescan_evict(self, keep):
+        self.entries = None
+        self._load()
+        self._evict(keep)
+
+    def _evict(self, keep):
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            sha = min(
+                (key for key in self.entries if key != keep),
+                key=lambda key: self.entries[key]["atime"],
+            )
+            entry = self.entries.pop(sha)
+            self.total -= entry["size"]
+            try:
+                os.remove(os.path.join(self.directory, entry["name"]))
+            except OSError:
+                pass
+            logger.info("图片缓存已淘汰: %s (bytes=%d)", sha, entry["size"])
+
+    def put(self, data, image_format):
+        sha = hashlib.sha256(data).hexdigest()
+        ext = image_format if image_format in IMAGE_CONTENT_TYPES else "png"
+        with self.lock:
+            self._load()
+            if sha in self.entries:
+                self._touch(sha)
+                return sha
+            os.makedirs(self.directory, exist_ok=True)
+            name = f"{sha}.{ext}"
+            path = os.path.join(self.directory, name)
+            temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+            with open(temp_path, "wb") as handle:
+                handle.write(data)
+            os.replace(temp_path, path)
+            self.entries[sha] = {"name": name, "size": len(data), "atime": time.time()}
+            self.total += len(data)
+            if self.shared is None:
+                self._evict(sha)
+            else:
+                self.shared.exclusive("图片淘汰", lambda: self._rescan_evict(sha))
+        return sha
+
+    def has(self, sha):
+        # 索引中的图片可能已被其它工作进程淘汰，确认文件仍在，否则移出索引。
+        with self.lock:
+            self._load()
+            entry = self.entries.get(sha)
+            if entry is not None:
+                if os.path.exists(os.path.join(self.directory, entry["name"])):
+                    return True
+                self._forget(sha)
+            return self._adopt(sha)
+
+    def open(self, sha):
+        # 返回 (文件句柄, 大小, Content-Type)；句柄由调用方关闭。
+        with self.lock:
+            self._load()
+            if sha not in self.entries and not self._adopt(sha):
+                return None
+            self._touch(sha)
+            entry = self.entries[sha]
+            ext = entry["name"].partition(".")[2]
+            try:
+                handle = open(os.path.join(self.directory, entry["name"]), "rb")
+            except OSError:
+                self._forget(sha)
+                return None
+        return handle, entry["size"], IMAGE_CONTENT_TYPES[ext]
+
+
+IMAGE_STORE = ImageStore(
+    IMAGE_STORE_DIR, IMAGE_STORE_MAX_BYTES, SHARED_CACHE if WORKERS > 1 else None
+)
+
+
+def parse_byte_range(header, size):
+    # 仅支持单个区间；无法识别的 Range 按整体返回，越界时抛出 ValueError。
+    match = RANGE_RE.match((header or "").strip())
+    if not match:
+        return None
+    first, last = match.group(1), match.group(2)
+    if not first and not last:
+        return None
+    if not first:
+        length = int(last)
+        if length <= 0:
+            raise ValueError("Range 无效")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("Range 无效")
+    return start, end
+
+
+def store_b64_image(value, image_format):
+    try:
+        data = base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        logger.warning("图片 base64 解码失败，按原样返回")
+        return None
+    try:
+        sha = IMAGE_STORE.put(data, image_format)
+    except OSError:
+        logger.exception("图片写入缓存目录失败，按原样返回")
+        return None
+    return {
+        "type": "url",
+        "value": f"/api/images/{sha}",
+        "format": image_format,
+        "sha": sha,
+        "bytes": len(data),
+    }
+
+
 def parse_image_response(result):
     images = []
     if isinstance(result, dict):
@@ -1061,16 +3362,382 @@ def parse_image_response(result):
                         }
                     )
                 elif item.get("b64_json"):
+                    value = str(item.get("b64_json"))
+                    stored = store_b64_image(value, output_format)
                     images.append(
-                        {
+                        stored
+                        or {
                             "type": "b64",
-                            "value": str(item.get("b64_json")),
+                            "value": value,
                             "format": output_format,
                         }
                     )
     return images
 
 
+IMAGE_CACHE_DB_FILE = os.path.join(DATA_DIR, "image_cache.db")
+IMAGE_CACHE_MAX_ENTRIES = get_env_int("IMAGE_CACHE_MAX_ENTRIES", default=500)
+IMAGE_CACHE_NAMESPACE = "image_result"
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+class ImageResultCache:
+    # 生图结果缓存：键为规范化提示词、模型、接口地址与请求参数的哈希，
+    # 值只引用 ImageStore 中的图片；索引存放在 SQLite 键值表中（多进程模式下为各工作进程共用的共享缓存），
+    # 按最近使用限制条数。
+    def __init__(self, store, max_entries):
+        self.store = store
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "forced": 0, "stores": 0}
+
+    def get(self, key):
+        entry = self.store.get(IMAGE_CACHE_NAMESPACE, key, touch=True)
+        if entry and all(IMAGE_STORE.has(item.get("sha", "")) for item in entry["images"]):
+            with self.lock:
+                self.stats["hits"] += 1
+            return [dict(item) for item in entry["images"]]
+        if entry:
+            self.store.delete(IMAGE_CACHE_NAMESPACE, key)
+        with self.lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key, images):
+        # 只缓存已落盘的图片；上游返回的临时 URL 会过期，不做缓存。
+        if not images or not all(item.get("sha") for item in images):
+            return
+        self.store.put(
+            IMAGE_CACHE_NAMESPACE,
+            key,
+            {"images": images, "ts": time.strftime("%Y-%m-%d %H:%M:%S")},
+            max_entries=self.max_entries,
+        )
+        with self.lock:
+            self.stats["stores"] += 1
+
+    def record_forced(self):
+        with self.lock:
+            self.stats["forced"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        entries = self.store.count(IMAGE_CACHE_NAMESPACE)
+        lookups = stats["hits"] + stats["misses"]
+        stats["entries"] = entries
+        stats["max_entries"] = self.max_entries
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+# 单进程模式下索引单独持久化，不写入多进程共享缓存。
+IMAGE_RESULT_CACHE = ImageResultCache(
+    SHARED_CACHE if WORKERS > 1 else SharedCache(IMAGE_CACHE_DB_FILE),
+    IMAGE_CACHE_MAX_ENTRIES,
+)
+
+
+def build_image_cache_key(prompt, config, seed=None, slot=None):
+    normalized = WHITESPACE_RE.sub(" ", normalize_text(prompt)).strip()
+    model = config.get("model", "")
+    base_url = (config.get("base_url", "") or "").rstrip("/")
+    payload = build_image_payload(normalized, model, base_url, seed=seed)
+    options = {key: value for key, value in payload.items() if key not in {"model", "prompt"}}
+    raw = json.dumps(
+        {
+            "prompt": normalized,
+            "model": model,
+            "base_url": base_url,
+            "options": options,
+            "slot": slot,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def generate_images(prompt, config, trace_id="", seed=None, slot=None, force=False):
+    # 返回 (图片列表, 响应摘要, 是否命中缓存)；force 为真时跳过缓存读取但仍写入新结果。
+    key = build_image_cache_key(prompt, config, seed=seed, slot=slot)
+    if force:
+        IMAGE_RESULT_CACHE.record_forced()
+    else:
+        cached = IMAGE_RESULT_CACHE.get(key)
+        if cached:
+            logger.info("生图缓存命中 trace=%s key=%s images=%d", trace_id, key[:12], len(cached))
+            return cached, None, True
+    result = call_image_generation(prompt, config, trace_id=trace_id, seed=seed)
+    images = parse_image_response(result)
+    summary = summarize_image_result(result, images)
+    IMAGE_RESULT_CACHE.put(key, images)
+    return images, summary, False
+
+
+IMAGE_JOB_WORKERS = get_env_int("IMAGE_JOB_WORKERS", default=4)
+IMAGE_JOB_MAX_PENDING = get_env_int("IMAGE_JOB_MAX_PENDING", default=32)
+IMAGE_JOB_TTL_SECONDS = get_env_int("IMAGE_JOB_TTL_S", default=3600)
+MAX_IMAGE_VARIANTS = 8
+MAX_IMAGE_JOBS = 200
+IMAGE_JOB_POLL_SECONDS = 0.5
+IMAGE_JOB_CONDITION = threading.Condition()
+IMAGE_JOBS = {}
+IMAGE_JOB_EXECUTOR = ThreadPoolExecutor(
+    max_workers=IMAGE_JOB_WORKERS, thread_name_prefix="image-job"
+)
+
+
+def build_image_variants(payload):
+    prompts = payload.get("prompts")
+    variants = []
+    if isinstance(prompts, list):
+        for item in prompts[:MAX_IMAGE_VARIANTS]:
+            prompt = normalize_text(str(item), MAX_CONTEXT_LEN)
+            if prompt:
+                variants.append({"prompt": prompt, "seed": None, "slot": None})
+    else:
+        prompt = normalize_text(payload.get("prompt", ""), MAX_CONTEXT_LEN)
+        if not prompt:
+            return []
+        seeds = payload.get("seeds")
+        if isinstance(seeds, list) and seeds:
+            for seed in seeds[:MAX_IMAGE_VARIANTS]:
+                if isinstance(seed, bool) or not isinstance(seed, int):
+                    raise ValueError("seeds 必须为整数列表")
+                variants.append({"prompt": prompt, "seed": seed, "slot": None})
+        else:
+            try:
+                count = int(payload.get("count", 1) or 1)
+            except (TypeError, ValueError) as exc:
+                raise ValueError("count 必须为整数") from exc
+            count = max(1, min(count, MAX_IMAGE_VARIANTS))
+            variants = [
+                {"prompt": prompt, "seed": None, "slot": index if count > 1 else None}
+                for index in range(count)
+            ]
+    return variants
+
+
+def summarize_image_job(job):
+    variants = []
+    for variant in job["variants"]:
+        variants.append(
+            {
+                "index": variant["index"],
+                "seed": variant["seed"],
+                "status": variant["status"],
+                "cached": variant["cached"],
+                "images": list(variant["images"]),
+                "error": variant["error"],
+                "elapsed_ms": variant["elapsed_ms"],
+            }
+        )
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "created": job["created"],
+        "total": len(job["variants"]),
+        "completed": job["completed"],
+        "failed": job["failed"],
+        "variants": variants,
+    }
+
+
+def purge_image_jobs(now):
+    # 调用方需持有 IMAGE_JOB_CONDITION；只清理已结束的任务。
+    finished = [
+        job
+        for job in IMAGE_JOBS.values()
+        if job["status"] in {"done", "failed"}
+    ]
+    finished.sort(key=lambda job: job["updated"])
+    excess = len(IMAGE_JOBS) - MAX_IMAGE_JOBS
+    for job in finished:
+        if excess <= 0 and now - job["updated"] < IMAGE_JOB_TTL_SECONDS:
+            break
+        del IMAGE_JOBS[job["id"]]
+        excess -= 1
+
+
+def update_image_job_status(job):
+    # 调用方需持有 IMAGE_JOB_CONDITION。
+    finished = job["completed"] + job["failed"]
+    if finished == len(job["variants"]):
+        job["status"] = "done" if job["completed"] else "failed"
+    elif finished or any(item["status"] == "running" for item in job["variants"]):
+        job["status"] = "running"
+    job["updated"] = time.time()
+    job["version"] += 1
+    IMAGE_JOB_CONDITION.notify_all()
+    publish_image_job(job)
+
+
+def publish_image_job(job):
+    # 多进程模式下轮询请求可能落到其它工作进程，任务快照同步写入共享缓存。
+    if WORKERS > 1:
+        SHARED_CACHE.put(
+            "image_job",
+            job["id"],
+            {"version": job["version"], "job": summarize_image_job(job)},
+            ttl=IMAGE_JOB_TTL_SECONDS,
+        )
+
+
+def run_image_variant(job_id, index, config):
+    with IMAGE_JOB_CONDITION:
+        job = IMAGE_JOBS.get(job_id)
+        if not job:
+            return
+        variant = job["variants"][index]
+        variant["status"] = "running"
+        update_image_job_status(job)
+        prompt = variant["prompt"]
+        seed = variant["seed"]
+        slot = variant["slot"]
+        force = job["force"]
+    start = time.monotonic()
+    images = []
+    cached = False
+    error = ""
+    try:
+        images, summary, cached = generate_images(
+            prompt,
+            config,
+            trace_id=f"{job_id}-{index}",
+            seed=seed,
+            slot=slot,
+            force=force,
+        )
+        if summary:
+            logger.info("生图任务响应摘要 job=%s variant=%d summary=%s", job_id, index, summary)
+    except ValueError as exc:
+        error = str(exc)
+    except Exception:
+        logger.exception("生图任务异常 job=%s variant=%d", job_id, index)
+        error = "生图调用失败，请检查配置或稍后重试"
+    with IMAGE_JOB_CONDITION:
+        job = IMAGE_JOBS.get(job_id)
+        if not job:
+            return
+        variant = job["variants"][index]
+        variant["elapsed_ms"] = round((time.monotonic() - start) * 1000)
+        variant["images"] = images
+        variant["cached"] = cached
+        if error or not images:
+            variant["status"] = "failed"
+            variant["error"] = error or "未返回图片数据。"
+            job["failed"] += 1
+        else:
+            variant["status"] = "done"
+            job["completed"] += 1
+        update_image_job_status(job)
+        logger.info(
+            "生图任务进度 job=%s variant=%d status=%s done=%d failed=%d total=%d",
+            job_id,
+            index,
+            variant["status"],
+            job["completed"],
+            job["failed"],
+            len(job["variants"]),
+        )
+
+
+def submit_image_job(variants, config, force=False):
+    now = time.time()
+    with IMAGE_JOB_CONDITION:
+        purge_image_jobs(now)
+        pending = sum(
+            1
+            for job in IMAGE_JOBS.values()
+            for item in job["variants"]
+            if item["status"] in {"queued", "running"}
+        )
+        if pending + len(variants) > IMAGE_JOB_MAX_PENDING:
+            raise OverflowError("生图任务过多，请稍后重试")
+        job_id = uuid.uuid4().hex[:12]
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "created": now,
+            "updated": now,
+            "version": 0,
+            "completed": 0,
+            "failed": 0,
+            "force": force,
+            "variants": [
+                {
+                    "index": index,
+                    "prompt": variant["prompt"],
+                    "seed": variant["seed"],
+                    "slot": variant["slot"],
+                    "status": "queued",
+                    "cached": False,
+                    "images": [],
+                    "error": "",
+                    "elapsed_ms": None,
+                }
+                for index, variant in enumerate(variants)
+            ],
+        }
+        IMAGE_JOBS[job_id] = job
+        snapshot = summarize_image_job(job)
+        publish_image_job(job)
+    for index in range(len(variants)):
+        IMAGE_JOB_EXECUTOR.submit(run_image_variant, job_id, index, dict(config))
+    logger.info(
+        "生图任务已提交 job=%s variants=%d pending=%d",
+        job_id,
+        len(variants),
+        pending + len(variants),
+    )
+    return snapshot
+
+
+def get_image_job(job_id):
+    with IMAGE_JOB_CONDITION:
+        job = IMAGE_JOBS.get(job_id)
+        if job:
+            return summarize_image_job(job)
+    if WORKERS > 1:
+        shared = SHARED_CACHE.get("image_job", job_id)
+        return shared["job"] if shared else None
+    return None
+
+
+def wait_shared_image_job(job_id, version, deadline):
+    # 任务由其它工作进程执行时只能轮询共享缓存。
+    while True:
+        shared = SHARED_CACHE.get("image_job", job_id)
+        if not shared:
+            return None, version
+        remaining = deadline - time.monotonic()
+        if shared["version"] != version or remaining <= 0:
+            return shared["job"], shared["version"]
+        time.sleep(min(IMAGE_JOB_POLL_SECONDS, remaining))
+
+
+def wait_image_job(job_id, version, timeout):
+    # 阻塞到任务版本号变化或超时，返回 (快照, 版本号)；任务不存在时快照为 None。
+    deadline = time.monotonic() + timeout
+    if WORKERS > 1:
+        with IMAGE_JOB_CONDITION:
+            local = job_id in IMAGE_JOBS
+        if not local:
+            return wait_shared_image_job(job_id, version, deadline)
+    with IMAGE_JOB_CONDITION:
+        while True:
+            job = IMAGE_JOBS.get(job_id)
+            if not job:
+                return None, version
+            if job["version"] != version:
+                return summarize_image_job(job), job["version"]
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return summarize_image_job(job), version
+            IMAGE_JOB_CONDITION.wait(remaining)
+
+
 def build_facts_user_prompt(requirement, step0_block, user_prompt_template):
     default_instructions = (
         "任务：仅提取用户明确写出的事实，禁止推断或补全。\n"
@@ -1106,26 +3773,40 @@ def build_facts_user_prompt(requirement, step0_block, user_prompt_template):
     return "\n\n".join(parts)
 
 
-def ensure_facts(state, prompt_data, user_prompt_template, trace_id=""):
+def ensure_facts(state, prompt_data, user_prompt_template, trace_id="", cancel=None):
     facts = state.get("facts", "")
     if facts:
         return facts, False
     requirement = state.get("requirement", "")
     if not requirement:
         return "", False
-    system = prompt_data.get("base_prompt", "")
-    user = build_facts_user_prompt(
-        requirement, prompt_data.get("step0_block", ""), user_prompt_template
-    )
+    system = prompt_data.base_prompt
+    user = build_facts_user_prompt(requirement, prompt_data.step0_block, user_prompt_template)
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user},
+    ]
+    routes = prompt_data.routes
+    # 多进程模式下，同一需求、提示词与模型的事实提取结果在各工作进程间共享复用。
+    key = ""
+    if WORKERS > 1 and FACTS_CACHE_TTL_SECONDS > 0:
+        key = build_llm_request_key(messages, 0.1, "STEP0_FACTS", routes)
+        cached = SHARED_CACHE.get("facts", key)
+        if cached:
+            logger.info("事实提取命中共享缓存 trace=%s", trace_id)
+            return cached, True
     facts = call_llm(
-        [
-            {"role": "system", "content": system},
-            {"role": "user", "content": user},
-        ],
+        messages,
         temperature=0.1,
         tag="STEP0_FACTS",
         trace_id=trace_id,
+        routes=routes,
+        cancel=cancel,
     )
+    if key and facts:
+        SHARED_CACHE.put(
+            "facts", key, facts, ttl=FACTS_CACHE_TTL_SECONDS, max_entries=FACTS_CACHE_MAX_ENTRIES
+        )
     return facts, True
 
 
@@ -1136,17 +3817,17 @@ def build_context_for_step(state, steps, current_step_id):
         parts.append(f"内部事实提取（系统态）：\n{facts}")
     history = state.get("step_history", {})
     for step in steps:
-        step_id = step["id"]
+        step_id = step.id
         if step_id == current_step_id:
             break
         entries = history.get(step_id, []) if isinstance(history, dict) else []
         if not entries:
             output = state.get("step_outputs", {}).get(step_id, "")
             if output:
-                parts.append(f"{step['title']} 输出：\n{output}")
+                parts.append(f"{step.title} 输出：\n{output}")
             user_input = state.get("step_inputs", {}).get(step_id, "")
             if user_input:
-                parts.append(f"{step['title']} 用户补充：\n{user_input}")
+                parts.append(f"{step.title} 用户补充：\n{user_input}")
         if entries:
             slice_entries = entries[-MAX_HISTORY_IN_CONTEXT:]
             history_lines = []
@@ -1163,17 +3844,16 @@ def build_context_for_step(state, steps, current_step_id):
                 if output_text:
                     history_lines.append(f"{prefix} 输出：{output_text}")
             if history_lines:
-                parts.append(f"{step['title']} 历史记录：\n" + "\n".join(history_lines))
+                parts.append(f"{step.title} 历史记录：\n" + "\n".join(history_lines))
         options = state.get("step_options", {}).get(step_id, [])
         if options:
             options_text = "\n".join(f"- {item}" for item in options)
-            parts.append(f"{step['title']} 可选描述选择：\n{options_text}")
+            parts.append(f"{step.title} 可选描述选择：\n{options_text}")
     return "\n\n".join(parts)
 
 
 def build_step_user_prompt(
-    step_meta,
-    step_block,
+    step,
     context,
     user_input,
     assumptions,
@@ -1196,12 +3876,12 @@ def build_step_user_prompt(
         "facts": facts,
         "options": options_text,
         "current_output": current_output,
-        "step_title": step_meta.get("title", ""),
-        "step_id": step_meta.get("id", ""),
-        "step_number": str(step_meta.get("number", "")),
-        "step_question": step_meta.get("question", ""),
+        "step_title": step.title,
+        "step_id": step.id,
+        "step_number": str(step.number),
+        "step_question": step.meta.get("question", ""),
     }
-    rendered_block = render_template(step_block, template_values)
+    rendered_block = render_template(step.block, template_values)
     template_values["step_block"] = rendered_block
     template_values["step_instruction"] = rendered_block
     rendered_template = render_template(user_prompt_template, template_values)
@@ -1220,17 +3900,17 @@ def build_step_user_prompt(
     )
     template_has_current_output = (
         "{{current_output}}" in user_prompt_template
-        or "{{current_output}}" in step_block
+        or "current_output" in step.placeholders
     )
-    has_context = template_has_context or "{{context}}" in step_block
-    has_input = template_has_input or "{{input}}" in step_block
-    has_assumptions = template_has_assumptions or "{{assumptions}}" in step_block
-    has_options = template_has_options or "{{options}}" in step_block
+    has_context = template_has_context or "context" in step.placeholders
+    has_input = template_has_input or "input" in step.placeholders
+    has_assumptions = template_has_assumptions or "assumptions" in step.placeholders
+    has_options = template_has_options or "options" in step.placeholders
     parts = []
     if rendered_template:
         parts.append(rendered_template)
     if not template_has_step_title:
-        parts.append(f"当前执行：{step_meta['title']}")
+        parts.append(f"当前执行：{step.title}")
     if mode == "append":
         parts.append("当前为追加思考模式：请基于已有结果补充，不要重复已有内容。")
         parts.append("必须新增至少1条不同内容；如无法新增，请仅输出：无新增内容。")
@@ -1255,7 +3935,7 @@ def build_step_user_prompt(
 
 
 def get_assumptions_text(state, prompt_data):
-    step_id = prompt_data.get("assumption_step_id")
+    step_id = prompt_data.assumption_step_id
     if not step_id:
         return ""
     return (
@@ -1264,27 +3944,16 @@ def get_assumptions_text(state, prompt_data):
     )
 
 
-def generate_step_output(
-    step_id,
-    state,
-    prompt_data,
-    user_prompt_template,
-    current_output,
-    mode,
-    trace_id="",
-):
-    steps = prompt_data.get("steps", [])
-    step_meta = next((step for step in steps if step["id"] == step_id), None)
-    if not step_meta:
+def build_step_request(step_id, state, prompt_data, user_prompt_template, current_output, mode):
+    step = prompt_data.step_index.get(step_id)
+    if not step:
         raise ValueError("步骤无效")
-    context = build_context_for_step(state, steps, step_id)
+    context = build_context_for_step(state, prompt_data.steps, step_id)
     user_input = state.get("step_inputs", {}).get(step_id, "")
     assumptions = get_assumptions_text(state, prompt_data)
     selected_options = state.get("step_options", {}).get(step_id, [])
-    step_block = prompt_data.get("step_blocks", {}).get(step_id, "")
     user = build_step_user_prompt(
-        step_meta,
-        step_block,
+        step,
         context,
         user_input,
         assumptions,
@@ -1295,30 +3964,1234 @@ def generate_step_output(
         current_output,
         mode,
     )
-    system = prompt_data.get("base_prompt", "")
-    temperature = 0.2 if step_meta["number"] in {1, 2} else 0.3
-    return call_llm(
+    system = prompt_data.base_prompt
+    temperature = 0.2 if step.number in {1, 2} else 0.3
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user},
+    ]
+    return messages, temperature, f"STEP{step.number}_OUTPUT"
+
+
+def generate_step_output(
+    step_id,
+    state,
+    prompt_data,
+    user_prompt_template,
+    current_output,
+    mode,
+    trace_id="",
+    cancel=None,
+    prefetch=False,
+):
+    messages, temperature, tag = build_step_request(
+        step_id, state, prompt_data, user_prompt_template, current_output, mode
+    )
+    routes = prompt_data.routes
+    # 未开启预取的请求不查预取缓存：多进程模式下省去一次共享缓存写入，也不计入命中率。
+    if prefetch and mode != "append":
+        key = build_llm_request_key(messages, temperature, tag, routes)
+        content = STEP_PREFETCH.take(key, cancel)
+        if content is not None:
+            logger.info("步骤预取命中 trace=%s step=%s", trace_id, step_id)
+            return content
+    return call_llm(messages, temperature=temperature, tag=tag, trace_id=trace_id, routes=routes, cancel=cancel)
+
+
+STEP_PREFETCH_ENABLED = parse_bool(os.getenv("STEP_PREFETCH", "").strip()) is True
+STEP_PREFETCH_TTL_SECONDS = get_env_int("STEP_PREFETCH_TTL_S", default=300)
+STEP_PREFETCH_WORKERS = 2
+STEP_PREFETCH_MAX_ENTRIES = 64
+# 等待进行中的预取时按此间隔检查客户端是否已断开。
+STEP_PREFETCH_POLL_SECONDS = 0.1
+
+
+class StepPrefetchCache:
+    # 预取结果按下一次请求的完整内容（模型、路由、消息）取指纹，一次性使用；
+    # 状态一旦变化指纹就对不上，条目到期后丢弃。
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.stats = {"scheduled": 0, "hits": 0, "misses": 0, "expired": 0, "failed": 0}
+
+    def _purge(self, now):
+        for key in [
+            key
+            for key, entry in self.entries.items()
+            if entry["event"].is_set() and entry["expires"] <= now
+        ]:
+            del self.entries[key]
+            self.stats["expired"] += 1
+
+    def reserve(self, key):
+        with self.lock:
+            self._purge(time.monotonic())
+            if key in self.entries or len(self.entries) >= self.max_entries:
+                return False
+            self.entries[key] = {"event": threading.Event(), "content": None, "expires": 0.0}
+            self.stats["scheduled"] += 1
+            return True
+
+    def complete(self, key, content):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry["content"] = content
+            entry["expires"] = time.monotonic() + self.ttl
+            entry["event"].set()
+        # 多进程模式下下一次请求可能落到其它工作进程，结果同时写入共享缓存。
+        if WORKERS > 1:
+            SHARED_CACHE.put("prefetch", key, content, ttl=self.ttl)
+
+    def fail(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            self.stats["failed"] += 1
+        if entry is not None:
+            entry["event"].set()
+
+    def take(self, key, cancel=None):
+        with self.lock:
+            self._purge(time.monotonic())
+            entry = self.entries.get(key)
+        if entry is None:
+            content = SHARED_CACHE.pop("prefetch", key) if WORKERS > 1 else None
+            with self.lock:
+                self.stats["hits" if content else "misses"] += 1
+            return content
+        # 预取仍在进行时分段等待其完成，避免重复调用；客户端断开时立即放弃，
+        # 条目保留给之后的请求。
+        deadline = time.monotonic() + TIMEOUT_SECONDS * RETRY_COUNT
+        while not entry["event"].is_set():
+            if cancel is not None and cancel.cancelled:
+                return None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            entry["event"].wait(min(STEP_PREFETCH_POLL_SECONDS, remaining))
+        with self.lock:
+            if entry["content"] is None or self.entries.get(key) is not entry:
+                self.stats["misses"] += 1
+                return None
+            del self.entries[key]
+            self.stats["hits"] += 1
+        if WORKERS > 1:
+            SHARED_CACHE.delete("prefetch", key)
+        return entry["content"]
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["pending"] = sum(1 for entry in self.entries.values() if not entry["event"].is_set())
+            stats["ready"] = len(self.entries) - stats["pending"]
+        stats["enabled"] = STEP_PREFETCH_ENABLED
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+STEP_PREFETCH = StepPrefetchCache(STEP_PREFETCH_TTL_SECONDS, STEP_PREFETCH_MAX_ENTRIES)
+STEP_PREFETCH_EXECUTOR = ThreadPoolExecutor(
+    max_workers=STEP_PREFETCH_WORKERS, thread_name_prefix="step-prefetch"
+)
+
+
+def build_llm_request_key(messages, temperature, tag, routes):
+    config = get_effective_config()
+    material = json.dumps(
         [
-            {"role": "system", "content": system},
-            {"role": "user", "content": user},
+            config.get("model", ""),
+            config.get("base_url", ""),
+            match_llm_route(tag, routes),
+            tag,
+            temperature,
+            messages,
         ],
-        temperature=temperature,
-        tag=f"STEP{step_meta['number']}_OUTPUT",
-        trace_id=trace_id,
+        ensure_ascii=False,
     )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def step_needs_user_input(step):
+    # 澄清、假设类步骤通常要等用户作答，带可选描述的步骤要等用户勾选。
+    if step.number in {1, 2} or any(word in step.title for word in ("澄清", "反问", "假设")):
+        return True
+    return bool(step.options)
+
+
+def find_prefetch_step(step_id, state, prompt_data):
+    steps = prompt_data.steps
+    for index, step in enumerate(steps):
+        if step.id != step_id:
+            continue
+        if index + 1 >= len(steps) or step_needs_user_input(step):
+            return None
+        next_step = steps[index + 1]
+        if step_needs_user_input(next_step) or next_step.meta.get("optional"):
+            return None
+        if state.get("step_inputs", {}).get(next_step.id):
+            return None
+        if state.get("step_outputs", {}).get(next_step.id):
+            return None
+        return next_step
+    return None
+
+
+def run_step_prefetch(key, messages, temperature, tag, routes, trace_id):
+    try:
+        content = call_llm(messages, temperature=temperature, tag=tag, trace_id=trace_id, routes=routes)
+    except Exception as exc:
+        STEP_PREFETCH.fail(key)
+        logger.warning("步骤预取失败 trace=%s tag=%s error=%s", trace_id, tag, type(exc).__name__)
+        return
+    STEP_PREFETCH.complete(key, content)
+    logger.info("步骤预取完成 trace=%s tag=%s resp_chars=%d", trace_id, tag, len(content))
+
+
+def schedule_step_prefetch(step_id, state, prompt_data, user_prompt_template, output, trace_id=""):
+    # 以本步骤完成后客户端将回传的状态预测下一步请求并在后台生成。
+    next_step = find_prefetch_step(step_id, state, prompt_data)
+    if not next_step:
+        return ""
+    predicted = dict(state)
+    predicted["step_outputs"] = dict(state.get("step_outputs", {}))
+    predicted["step_outputs"][step_id] = output
+    predicted = normalize_state(predicted)
+    messages, temperature, tag = build_step_request(
+        next_step.id, predicted, prompt_data, user_prompt_template, "", "generate"
+    )
+    routes = prompt_data.routes
+    key = build_llm_request_key(messages, temperature, tag, routes)
+    if not STEP_PREFETCH.reserve(key):
+        return ""
+    prefetch_trace = uuid.uuid4().hex[:12]
+    logger.info(
+        "步骤预取开始 trace=%s from=%s step=%s prefetch_trace=%s",
+        trace_id,
+        step_id,
+        next_step.id,
+        prefetch_trace,
+    )
+    STEP_PREFETCH_EXECUTOR.submit(
+        run_step_prefetch, key, messages, temperature, tag, routes, prefetch_trace
+    )
+    return next_step.id
+
+
+STEP_ARCHIVE_ENABLED = parse_bool(os.getenv("STEP_ARCHIVE", "").strip()) is not False
+STEP_ARCHIVE_FILE = os.path.join(DATA_DIR, "history.db")
+STEP_ARCHIVE_RETENTION_DAYS = get_env_int("STEP_ARCHIVE_DAYS", default=90)
+STEP_ARCHIVE_QUEUE_SIZE = 1000
+STEP_ARCHIVE_BATCH = 100
+STEP_ARCHIVE_PURGE_SECONDS = 3600
+STEP_ARCHIVE_PAGE_MAX = 50
+# 开启归档后客户端只需携带最近几条历史，更早的记录从归档分页读取。
+STEP_HISTORY_RECENT = min(
+    MAX_HISTORY_ITEMS, max(1, get_env_int("STEP_HISTORY_RECENT", default=MAX_HISTORY_ITEMS))
+)
+SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+FTS_MIN_QUERY_CHARS = 3
+# 归档中步骤编号的数值排序键；step 列为文本，直接排序会把 step_10 排在 step_2 之前。
+STEP_ORDER_SQL = "(CASE WHEN step GLOB 'step_[0-9]*' THEN CAST(substr(step, 6) AS INTEGER) END)"
+
+
+class StepArchive:
+    # 步骤输出归档：请求线程只入队，后台线程批量写入 SQLite（WAL）；
+    # 按会话、步骤与自增 id 建索引，用 id 游标分页，全文检索使用 FTS5 trigram 分词以支持中文子串。
+    def __init__(self, path, retention_days):
+        self.path = path
+        self.retention_days = retention_days
+        self.queue = queue.Queue(maxsize=STEP_ARCHIVE_QUEUE_SIZE)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.writer_pid = None
+        self.fts = True
+        self.stats = {"queued": 0, "written": 0, "dropped": 0, "errors": 0}
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None and self.local.pid == os.getpid():
+            return connection
+        connection = connect_sqlite(self.path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS step_history ("
+            "id INTEGER PRIMARY KEY, session TEXT NOT NULL, step TEXT NOT NULL, "
+            "ts REAL NOT NULL, mode TEXT NOT NULL, input TEXT NOT NULL, output TEXT NOT NULL, "
+            "trace_id TEXT NOT NULL, prompt TEXT NOT NULL)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS step_history_session ON step_history (session, id)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS step_history_step ON step_history (session, step, id)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS step_history_ts ON step_history (ts)")
+        try:
+            connection.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS step_history_fts USING fts5("
+                "input, output, content='step_history', content_rowid='id', tokenize='trigram')"
+            )
+            connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS step_history_ai AFTER INSERT ON step_history BEGIN "
+                "INSERT INTO step_history_fts (rowid, input, output) "
+                "VALUES (new.id, new.input, new.output); END"
+            )
+            connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS step_history_ad AFTER DELETE ON step_history BEGIN "
+                "INSERT INTO step_history_fts (step_history_fts, rowid, input, output) "
+                "VALUES ('delete', old.id, old.input, old.output); END"
+            )
+        except sqlite3.OperationalError as exc:
+            # SQLite 未编译 FTS5 或版本过旧不支持 trigram 时退化为 LIKE 检索。
+            if self.fts:
+                logger.warning("步骤归档全文索引不可用，检索退化为逐行匹配: %s", exc)
+            self.fts = False
+        self.local.connection = connection
+        self.local.pid = os.getpid()
+        return connection
+
+    def record(self, session_id, step_id, entry, trace_id="", prompt=""):
+        with self.lock:
+            # fork 出的工作进程不继承写入线程，按进程号各自启动。
+            if self.writer_pid != os.getpid():
+                self.writer_pid = os.getpid()
+                threading.Thread(target=self._run_writer, name="step-archive", daemon=True).start()
+        row = (
+            session_id,
+            step_id,
+            time.time(),
+            entry.get("mode", ""),
+            entry.get("input", ""),
+            entry.get("output", ""),
+            trace_id,
+            prompt,
+        )
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            with self.lock:
+                self.stats["dropped"] += 1
+            logger.warning("步骤归档队列已满，丢弃 session=%s step=%s", session_id, step_id)
+            return
+        with self.lock:
+            self.stats["queued"] += 1
+
+    def _run_writer(self):
+        last_purge = 0.0
+        while True:
+            rows = [self.queue.get()]
+            while len(rows) < STEP_ARCHIVE_BATCH:
+                try:
+                    rows.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                connection = self._connection()
+                connection.execute("BEGIN IMMEDIATE")
+                try:
+                    connection.executemany(
+                        "INSERT INTO step_history "
+                        "(session, step, ts, mode, input, output, trace_id, prompt) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        rows,
+                    )
+                    connection.execute("COMMIT")
+                finally:
+                    if connection.in_transaction:
+                        connection.execute("ROLLBACK")
+                with self.lock:
+                    self.stats["written"] += len(rows)
+                if self.retention_days > 0 and time.monotonic() - last_purge >= STEP_ARCHIVE_PURGE_SECONDS:
+                    last_purge = time.monotonic()
+                    self._purge(connection)
+            except sqlite3.Error as exc:
+                with self.lock:
+                    self.stats["errors"] += 1
+                logger.warning("步骤归档写入失败 rows=%d error=%s", len(rows), exc)
+
+    def _purge(self, connection):
+        cutoff = time.time() - self.retention_days * 86400
+        removed = connection.execute("DELETE FROM step_history WHERE ts < ?", (cutoff,)).rowcount
+        if removed:
+            logger.info("步骤归档已清理过期记录 rows=%d days=%d", removed, self.retention_days)
+
+    def _filters(self, session_id, step_id, before):
+        clauses = ["h.session = ?"]
+        params = [session_id]
+        if step_id:
+            clauses.append("h.step = ?")
+            params.append(step_id)
+        if before:
+            clauses.append("h.id < ?")
+            params.append(before)
+        return clauses, params
+
+    def _page(self, rows, limit):
+        items = []
+        for row in rows:
+            item = {
+                "id": row[0],
+                "step_id": row[1],
+                "ts": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row[2])),
+                "mode": row[3],
+                "input": row[4],
+                "output": row[5],
+            }
+            if len(row) > 6:
+                item["snippet"] = row[6]
+            items.append(item)
+        next_before = items[-1]["id"] if len(items) == limit else None
+        return {"items": items, "next_before": next_before}
+
+    def fetch(self, session_id, step_id="", before=0, limit=20):
+        clauses, params = self._filters(session_id, step_id, before)
+        rows = self._connection().execute(
+            "SELECT h.id, h.step, h.ts, h.mode, h.input, h.output FROM step_history h "
+            f"WHERE {' AND '.join(clauses)} ORDER BY h.id DESC LIMIT ?",
+            (*params, limit),
+        ).fetchall()
+        return self._page(rows, limit)
+
+    def search(self, session_id, text, step_id="", before=0, limit=20):
+        connection = self._connection()
+        clauses, params = self._filters(session_id, step_id, before)
+        if self.fts and len(text) >= FTS_MIN_QUERY_CHARS:
+            phrase = '"' + text.replace('"', '""') + '"'
+            rows = connection.execute(
+                "SELECT h.id, h.step, h.ts, h.mode, h.input, h.output, "
+                "snippet(step_history_fts, -1, '[', ']', '…', 24) "
+                "FROM step_history_fts JOIN step_history h ON h.id = step_history_fts.rowid "
+                f"WHERE step_history_fts MATCH ? AND {' AND '.join(clauses)} "
+                "ORDER BY h.id DESC LIMIT ?",
+                (phrase, *params, limit),
+            ).fetchall()
+            return self._page(rows, limit)
+        # trigram 至少需要 3 个字符，更短的关键词在会话范围内逐行匹配。
+        pattern = "%" + re.sub(r"([\\%_])", r"\\\1", text) + "%"
+        clauses.append("(h.input LIKE ? ESCAPE '\\' OR h.output LIKE ? ESCAPE '\\')")
+        rows = connection.execute(
+            "SELECT h.id, h.step, h.ts, h.mode, h.input, h.output FROM step_history h "
+            f"WHERE {' AND '.join(clauses)} ORDER BY h.id DESC LIMIT ?",
+            (*params, pattern, pattern, limit),
+        ).fetchall()
+        return self._page(rows, limit)
+
+    def has_session(self, session_id):
+        return (
+            self._connection()
+            .execute("SELECT 1 FROM step_history WHERE session = ? LIMIT 1", (session_id,))
+            .fetchone()
+            is not None
+        )
+
+    def iterate_session(self, session_id):
+        # 按步骤、时间顺序逐行返回 (step, ts, mode, input, output)，游标惰性读取，不一次性载入。
+        # 非 step_<n> 形式的步骤排在最后。
+        return self._connection().execute(
+            "SELECT step, ts, mode, input, output FROM step_history WHERE session = ? "
+            f"ORDER BY {STEP_ORDER_SQL} IS NULL, {STEP_ORDER_SQL}, step, id",
+            (session_id,),
+        )
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["enabled"] = STEP_ARCHIVE_ENABLED
+        stats["pending"] = self.queue.qsize()
+        return stats
+
+
+STEP_ARCHIVE = StepArchive(STEP_ARCHIVE_FILE, STEP_ARCHIVE_RETENTION_DAYS)
+
+
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_MAX_SESSIONS = 100
+
+
+class ChunkedWriter:
+    # zipfile 的输出目标：攒满一块后按 HTTP chunked 编码写出（HTTP/1.0 客户端直接写出、以断开连接结束），
+    # 不提供 tell/seek，zipfile 会按不可寻址流写入数据描述符，整个压缩包无需在内存中缓冲。
+    def __init__(self, wfile, chunked):
+        self.wfile = wfile
+        self.chunked = chunked
+        self.buffer = bytearray()
+        self.sent = 0
+        self.aborted = False
+
+    def write(self, data):
+        if self.aborted:
+            return len(data)
+        self.buffer += data
+        if len(self.buffer) >= EXPORT_CHUNK_BYTES:
+            self._emit()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _emit(self):
+        if not self.buffer:
+            return
+        if self.chunked:
+            self.wfile.write(b"%x\r\n" % len(self.buffer))
+            self.wfile.write(self.buffer)
+            self.wfile.write(b"\r\n")
+        else:
+            self.wfile.write(self.buffer)
+        self.sent += len(self.buffer)
+        self.buffer.clear()
+
+    def abort(self):
+        # 出错后丢弃后续写入：chunked 响应缺少结束块，客户端据此判断下载不完整。
+        self.aborted = True
+        self.buffer.clear()
+
+    def finish(self):
+        self._emit()
+        if self.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def load_export_step_names():
+    # 步骤标识 -> 压缩包内文件名（序号 + 步骤元信息中的 download_name），提示词不可用时退化为步骤标识。
+    try:
+        prompt_data = load_system_prompt_data()
+    except ValueError:
+        return {}
+    return {step.id: f"{step.number:02d}-{step.meta['download_name']}" for step in prompt_data.steps}
+
+
+def export_file_name(names, step_id):
+    return names.get(step_id) or safe_filename(step_id)
+
+
+def format_history_entry(ts, mode, entry_input, entry_output):
+    return (
+        f"## {ts} · {mode or '-'}\n\n### 输入\n\n{entry_input or '（无）'}\n\n"
+        f"### 输出\n\n{entry_output or '（无）'}\n\n"
+    )
+
+
+def write_export_state(archive, prefix, state, names):
+    if state.get("requirement") or state.get("facts"):
+        archive.writestr(
+            f"{prefix}00-原始需求.md",
+            f"# 原始需求\n\n{state.get('requirement', '')}\n\n"
+            f"## 已确认事实\n\n{state.get('facts') or '（无）'}\n",
+        )
+    for step_id, output in state.get("step_outputs", {}).items():
+        if output:
+            archive.writestr(f"{prefix}{export_file_name(names, step_id)}", output + "\n")
+    for step_id, entries in state.get("step_history", {}).items():
+        with archive.open(f"{prefix}history/{export_file_name(names, step_id)}", "w") as handle:
+            for entry in entries:
+                handle.write(
+                    format_history_entry(
+                        entry.get("ts", ""), entry.get("mode", ""), entry["input"], entry["output"]
+                    ).encode("utf-8")
+                )
+
+
+def write_export_archive_session(archive, prefix, session_id, names, outputs=True):
+    # 单次遍历归档游标：同一步骤的历史逐条写入同一个压缩条目，步骤切换时再写出该步骤最后一次输出，
+    # 内存中只保留当前步骤的最后一条输出。
+    handle = None
+    current = None
+    latest = ""
+    for step_id, ts, mode, entry_input, entry_output in STEP_ARCHIVE.iterate_session(session_id):
+        if step_id != current:
+            if handle is not None:
+                handle.close()
+                if outputs and latest:
+                    archive.writestr(f"{prefix}{export_file_name(names, current)}", latest + "\n")
+            current = step_id
+            latest = ""
+            handle = archive.open(f"{prefix}history/{export_file_name(names, step_id)}", "w")
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+        handle.write(format_history_entry(stamp, mode, entry_input, entry_output).encode("utf-8"))
+        latest = entry_output or latest
+    if handle is not None:
+        handle.close()
+        if outputs and latest:
+            archive.writestr(f"{prefix}{export_file_name(names, current)}", latest + "\n")
+
+
+CHAT_STORE_FILE = os.path.join(DATA_DIR, "chat.db")
+CHAT_RETENTION_DAYS = get_env_int("CHAT_RETENTION_DAYS", default=30)
+CHAT_PURGE_SECONDS = 3600
+# 未折叠进摘要的轮次超过该 token 预算时触发压缩，压缩后保留约一半预算的最近轮次。
+CHAT_HISTORY_TOKENS = max(1000, get_env_int("CHAT_HISTORY_TOKENS", default=6000))
+CHAT_RECENT_TOKENS = CHAT_HISTORY_TOKENS // 2
+CHAT_SUMMARY_MAX_CHARS = 2000
+# 摘要滞后时，超出预算的较早轮次截断后附在系统提示中，最多占预算的四分之一。
+CHAT_BACKLOG_TURN_CHARS = 300
+CHAT_BACKLOG_SHARE = 4
+# 同一会话连续摘要失败达到该次数后按错误级别记录。
+CHAT_SUMMARY_ALERT_FAILURES = 3
+CHAT_TRANSCRIPT_LIMIT = 100
+CHAT_SUMMARY_WORKERS = 2
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) * LLM_TOKENS_PER_CHAR)
+
+
+class ChatStore:
+    # 服务端保存的对话：轮次只追加不修改，序号在事务内分配，多个工作进程共用一个 SQLite 文件。
+    # 较早的轮次超出 token 预算后折叠进滚动摘要，摘要与其覆盖到的轮次序号一起保存，
+    # 组装上游请求时只读取摘要与其后的轮次。
+    def __init__(self, path, retention_days):
+        self.path = path
+        self.retention_days = retention_days
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.purged = 0.0
+        self.failures = {}
+        self.stats = {
+            "conversations": 0,
+            "turns": 0,
+            "summaries": 0,
+            "summary_conflicts": 0,
+            "summary_failures": 0,
+        }
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None and self.local.pid == os.getpid():
+            return connection
+        connection = connect_sqlite(self.path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS chat_conversation ("
+            "id TEXT PRIMARY KEY, created REAL NOT NULL, updated REAL NOT NULL, "
+            "prompt TEXT NOT NULL, summary TEXT NOT NULL, summary_upto INTEGER NOT NULL, "
+            "next_seq INTEGER NOT NULL)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS chat_conversation_updated ON chat_conversation (updated)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS chat_turn ("
+            "conversation TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, "
+            "content TEXT NOT NULL, tokens INTEGER NOT NULL, ts REAL NOT NULL, "
+            "PRIMARY KEY (conversation, seq)) WITHOUT ROWID"
+        )
+        self.local.connection = connection
+        self.local.pid = os.getpid()
+        return connection
+
+    def _transact(self, func):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(connection)
+            connection.execute("COMMIT")
+        finally:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+        return result
+
+    def _count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    def create(self, prompt="", turns=()):
+        conversation_id = uuid.uuid4().hex
+        now = time.time()
+
+        def insert(connection):
+            connection.execute(
+                "INSERT INTO chat_conversation VALUES (?, ?, ?, ?, '', 0, 1)",
+                (conversation_id, now, now, prompt),
+            )
+
+        self._transact(insert)
+        self._count("conversations")
+        if turns:
+            self.append(conversation_id, turns)
+        self._purge()
+        return conversation_id
+
+    def append(self, conversation_id, turns):
+        # turns 为 (role, content) 列表；会话不存在时返回 None。
+        now = time.time()
+
+        def insert(connection):
+            row = connection.execute(
+                "SELECT next_seq FROM chat_conversation WHERE id = ?", (conversation_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            seq = row[0]
+            connection.executemany(
+                "INSERT INTO chat_turn VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (conversation_id, seq + index, role, content, estimate_tokens(content), now)
+                    for index, (role, content) in enumerate(turns)
+                ],
+            )
+            connection.execute(
+                "UPDATE chat_conversation SET next_seq = ?, updated = ? WHERE id = ?",
+                (seq + len(turns), now, conversation_id),
+            )
+            return seq + len(turns) - 1
+
+        last = self._transact(insert)
+        if last is not None:
+            self._count("turns", len(turns))
+        return last
+
+    def load(self, conversation_id):
+        # 返回摘要及其后尚未折叠的轮次 [(seq, role, content, tokens)]；会话不存在时返回 None。
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT summary, summary_upto FROM chat_conversation WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        turns = connection.execute(
+            "SELECT seq, role, content, tokens FROM chat_turn "
+            "WHERE conversation = ? AND seq > ? ORDER BY seq",
+            (conversation_id, row[1]),
+        ).fetchall()
+        return {"summary": row[0], "summary_upto": row[1], "turns": turns}
+
+    def save_summary(self, conversation_id, expected_upto, summary, upto):
+        # 以原摘要位置为条件更新，多个进程同时压缩同一会话时只有先完成的生效。
+        def update(connection):
+            return connection.execute(
+                "UPDATE chat_conversation SET summary = ?, summary_upto = ? "
+                "WHERE id = ? AND summary_upto = ?",
+                (summary, upto, conversation_id, expected_upto),
+            ).rowcount
+
+        saved = self._transact(update) == 1
+        self._count("summaries" if saved else "summary_conflicts")
+        with self.lock:
+            self.failures.pop(conversation_id, None)
+        return saved
+
+    def record_summary_failure(self, conversation_id):
+        # 返回该会话的连续失败次数；成功保存摘要后清零。只保留最近的若干会话。
+        with self.lock:
+            self.stats["summary_failures"] += 1
+            count = self.failures.pop(conversation_id, 0) + 1
+            self.failures[conversation_id] = count
+            while len(self.failures) > 1000:
+                self.failures.pop(next(iter(self.failures)))
+            return count
+
+    def transcript(self, conversation_id, limit):
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT created, updated, prompt, summary, summary_upto, next_seq "
+            "FROM chat_conversation WHERE id = ?",
+            (conversation_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        turns = connection.execute(
+            "SELECT seq, role, content, ts FROM chat_turn WHERE conversation = ? "
+            "ORDER BY seq DESC LIMIT ?",
+            (conversation_id, limit),
+        ).fetchall()
+        return {
+            "conversation_id": conversation_id,
+            "created": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row[0])),
+            "updated": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row[1])),
+            "prompt": row[2],
+            "summary": row[3],
+            "summary_upto": row[4],
+            "total_turns": row[5] - 1,
+            "turns": [
+                {
+                    "seq": seq,
+                    "role": role,
+                    "content": content,
+                    "ts": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)),
+                }
+                for seq, role, content, ts in reversed(turns)
+            ],
+        }
+
+    def _purge(self):
+        if self.retention_days <= 0 or time.monotonic() - self.purged < CHAT_PURGE_SECONDS:
+            return
+        self.purged = time.monotonic()
+        cutoff = time.time() - self.retention_days * 86400
+
+        def purge(connection):
+            connection.execute(
+                "DELETE FROM chat_turn WHERE conversation IN "
+                "(SELECT id FROM chat_conversation WHERE updated < ?)",
+                (cutoff,),
+            )
+            return connection.execute(
+                "DELETE FROM chat_conversation WHERE updated < ?", (cutoff,)
+            ).rowcount
+
+        try:
+            removed = self._transact(purge)
+        except sqlite3.Error as exc:
+            logger.warning("对话记录清理失败: %s", exc)
+            return
+        if removed:
+            logger.info("对话记录已清理过期会话 conversations=%d days=%d", removed, self.retention_days)
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["summary_failing"] = sum(
+                1 for count in self.failures.values() if count >= CHAT_SUMMARY_ALERT_FAILURES
+            )
+        return stats
+
+
+CHAT_STORE = ChatStore(CHAT_STORE_FILE, CHAT_RETENTION_DAYS)
+CHAT_SUMMARY_EXECUTOR = ThreadPoolExecutor(
+    max_workers=CHAT_SUMMARY_WORKERS, thread_name_prefix="chat-summary"
+)
+CHAT_COMPACTING = set()
+CHAT_COMPACTING_LOCK = threading.Lock()
+
+
+def build_chat_messages(system_prompt, summary, turns, budget):
+    # 从最新的轮次往前取，累计不超过 token 预算（至少保留最新一轮）。
+    # 摘要滞后时，尚未折叠进摘要、又超出预算的较早轮次从最早的开始截断后附在系统提示中，
+    # 超出节选预算的部分标注省略轮数；返回 (消息列表, 节选轮数, 省略轮数)。
+    kept = []
+    used = 0
+    for _, role, content, tokens in reversed(turns):
+        if kept and used + tokens > budget:
+            break
+        kept.append({"role": role, "content": content})
+        used += tokens
+    kept.reverse()
+    if summary:
+        system_prompt = f"{system_prompt}\n\n【此前对话摘要】\n{summary}"
+    backlog = turns[: len(turns) - len(kept)]
+    lines = []
+    used = 0
+    for _, role, content, _ in backlog:
+        if len(content) > CHAT_BACKLOG_TURN_CHARS:
+            content = f"{content[:CHAT_BACKLOG_TURN_CHARS]}…"
+        line = f"{'用户' if role == 'user' else '助手'}：{content}"
+        tokens = estimate_tokens(line)
+        if lines and used + tokens > budget // CHAT_BACKLOG_SHARE:
+            break
+        lines.append(line)
+        used += tokens
+    excerpted = len(lines)
+    omitted = len(backlog) - excerpted
+    if lines:
+        if omitted:
+            lines.append(f"……（其后另有 {omitted} 轮较早对话尚未整理，已省略）")
+        system_prompt = (
+            f"{system_prompt}\n\n【较早对话节选（尚未整理进摘要，内容已截断）】\n" + "\n".join(lines)
+        )
+    return [{"role": "system", "content": system_prompt}] + kept, excerpted, omitted
+
+
+def build_chat_summary_messages(summary, turns):
+    lines = []
+    for _, role, content, _ in turns:
+        lines.append(f"{'用户' if role == 'user' else '助手'}：{content}")
+    user = (
+        f"请把下面的对话压缩成一份摘要，供后续对话继续使用。保留用户的目标与约束、已确认的结论、"
+        f"关键数据与名称、尚未解决的问题；不要编造，不要评价，控制在 {CHAT_SUMMARY_MAX_CHARS // 2} 字以内。\n\n"
+        f"【已有摘要】\n{summary or '（无）'}\n\n【新增对话】\n" + "\n\n".join(lines)
+    )
+    return [
+        {"role": "system", "content": "你是对话记录压缩助手，只输出摘要正文。"},
+        {"role": "user", "content": user},
+    ]
+
+
+def compact_chat_conversation(conversation_id, config, trace_id=""):
+    try:
+        state = CHAT_STORE.load(conversation_id)
+        if state is None:
+            return
+        turns = state["turns"]
+        remaining = sum(turn[3] for turn in turns)
+        if remaining <= CHAT_HISTORY_TOKENS:
+            return
+        # 从最早的轮次开始折叠，直到剩余轮次回到预算的一半以内；最新一问一答始终保留原文。
+        fold = 0
+        while fold < len(turns) - 2 and remaining > CHAT_RECENT_TOKENS:
+            remaining -= turns[fold][3]
+            fold += 1
+        if fold and fold < len(turns) - 2 and turns[fold - 1][1] == "user":
+            remaining -= turns[fold][3]
+            fold += 1
+        if not fold:
+            return
+        summary = call_llm_with_config(
+            build_chat_summary_messages(state["summary"], turns[:fold]),
+            temperature=0.1,
+            config=config,
+            tag="CHAT_SUMMARY",
+            trace_id=trace_id,
+        )
+        summary = normalize_text(summary, CHAT_SUMMARY_MAX_CHARS)
+        if CHAT_STORE.save_summary(conversation_id, state["summary_upto"], summary, turns[fold - 1][0]):
+            logger.info(
+                "对话摘要已更新 conversation=%s trace=%s folded=%d upto=%d remaining_tokens=%d summary_chars=%d",
+                conversation_id,
+                trace_id,
+                fold,
+                turns[fold - 1][0],
+                remaining,
+                len(summary),
+            )
+    except Exception as exc:
+        # 下一轮对话会重新触发压缩；连续失败时摘要一直滞后，按错误级别记录便于告警。
+        failures = CHAT_STORE.record_summary_failure(conversation_id)
+        logger.log(
+            logging.ERROR if failures >= CHAT_SUMMARY_ALERT_FAILURES else logging.WARNING,
+            "对话摘要失败 conversation=%s trace=%s failures=%d error=%s",
+            conversation_id,
+            trace_id,
+            failures,
+            type(exc).__name__,
+        )
+    finally:
+        with CHAT_COMPACTING_LOCK:
+            CHAT_COMPACTING.discard(conversation_id)
+
+
+def schedule_chat_compaction(conversation_id, config, trace_id=""):
+    with CHAT_COMPACTING_LOCK:
+        if conversation_id in CHAT_COMPACTING:
+            return
+        CHAT_COMPACTING.add(conversation_id)
+    CHAT_SUMMARY_EXECUTOR.submit(compact_chat_conversation, conversation_id, config, trace_id)
+
+
+WARMUP_STATE = {"ready": not WARMUP_ENABLED, "started": None, "finished": None, "report": {}}
+PROCESS_STARTED = time.time()
+
+
+def get_warmup_upstream_urls():
+    config = get_effective_config()
+    urls = [item["base_url"] for item in config.get("endpoints", ())]
+    if not urls and config.get("api_key"):
+        urls.append(config.get("base_url", "") or DEFAULT_BASE_URL)
+    image_config = get_effective_image_config()
+    if image_config.get("api_key") and image_config.get("base_url"):
+        urls.append(build_image_url(image_config["base_url"]))
+    return urls
+
+
+def warm_upstream_connection(url):
+    scheme, host, port, _ = UPSTREAM_CONNECTIONS.prewarm(
+        url, UPSTREAM_WARM_CONNECTIONS, TIMEOUT_SECONDS
+    )
+    return f"{scheme}://{host}:{port}"
+
+
+def warm_prompt(path):
+    full_path = resolve_prompt_path(path)
+    data = load_system_prompt_data(full_path)
+    return len(data.steps)
+
+
+def run_warmup():
+    # 启动预热：并行解析全部提示词、建立目录树缓存，并预先建立到上游的连接；
+    # 完成前 /readyz 返回 503，负载均衡据此只把流量转给已预热的实例。
+    WARMUP_STATE["started"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    report = {"errors": []}
+    start = time.monotonic()
+    stage = time.monotonic()
+    PROMPT_ARTIFACTS.preload()
+    report["prompt_cache_ms"] = round((time.monotonic() - stage) * 1000, 1)
+    stage = time.monotonic()
+    tree = get_prompt_tree(force=True)
+    paths = list_prompt_files(tree)
+    report["tree_ms"] = round((time.monotonic() - stage) * 1000, 1)
+    stage = time.monotonic()
+    parsed = 0
+    with ThreadPoolExecutor(max_workers=min(8, len(paths) or 1)) as executor:
+        futures = {path: executor.submit(warm_prompt, path) for path in paths}
+        for path, future in futures.items():
+            try:
+                future.result()
+                parsed += 1
+            except Exception as exc:
+                report["errors"].append(f"prompt {path}: {exc}")
+    PROMPT_ARTIFACTS.flush()
+    report["prompts"] = parsed
+    report["prompts_ms"] = round((time.monotonic() - stage) * 1000, 1)
+    stage = time.monotonic()
+    hosts = []
+    urls = list(dict.fromkeys(get_warmup_upstream_urls()))
+    with ThreadPoolExecutor(max_workers=min(8, len(urls) or 1)) as executor:
+        futures = {url: executor.submit(warm_upstream_connection, url) for url in urls}
+        for url, future in futures.items():
+            try:
+                hosts.append(future.result())
+            except Exception as exc:
+                report["errors"].append(f"upstream {urllib.parse.urlsplit(url).hostname}: {exc}")
+    report["upstreams"] = hosts
+    report["upstreams_ms"] = round((time.monotonic() - stage) * 1000, 1)
+    report["total_ms"] = round((time.monotonic() - start) * 1000, 1)
+    WARMUP_STATE["report"] = report
+    WARMUP_STATE["finished"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    WARMUP_STATE["ready"] = True
+    logger.info(
+        "启动预热完成 total_ms=%.0f prompts=%d upstreams=%d errors=%d",
+        report["total_ms"],
+        parsed,
+        len(hosts),
+        len(report["errors"]),
+    )
+    # 检索索引在就绪后构建，不推迟 /readyz；构建完成前的首次检索会等待其完成。
+    try:
+        PROMPT_SEARCH.refresh(force=True)
+    except Exception:
+        logger.exception("提示词索引构建失败")
+
+
+DEBUG_PROFILE_LOCK = threading.Lock()
+THREAD_NAME_DIGITS_RE = re.compile(r"[-_]?\d+")
+
+
+def describe_code(code, cache):
+    label = cache.get(code)
+    if label is None:
+        label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        cache[code] = label
+    return label
+
+
+def sample_thread_stacks(seconds, interval, all_threads):
+    # 采样式分析：定时读取各线程当前栈，按线程类别 + 调用链聚合为 flamegraph 可用的折叠栈。
+    # 默认只采样正在处理请求的线程；all_threads 为真时包含预取、摘要等后台线程。
+    own = threading.get_ident()
+    stacks = Counter()
+    labels = {}
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        handlers = None if all_threads else REQUEST_TRACKER.idents()
+        for ident, frame in sys._current_frames().items():
+            if ident == own or (handlers is not None and ident not in handlers):
+                continue
+            chain = []
+            while frame is not None:
+                chain.append(describe_code(frame.f_code, labels))
+                frame = frame.f_back
+            chain.append(THREAD_NAME_DIGITS_RE.sub("", names.get(ident, "thread")) or "thread")
+            stacks[";".join(reversed(chain))] += 1
+        samples += 1
+        time.sleep(interval)
+    return samples, stacks
+
+
+def diff_tracemalloc(before, after, top):
+    # 排除 tracemalloc 自身与采样器的分配，只留下业务代码的分配点。
+    ignored = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ]
+    for func in (describe_code, sample_thread_stacks):
+        for line in {line for _, _, line in func.__code__.co_lines() if line}:
+            ignored.append(tracemalloc.Filter(False, __file__, line))
+    stats = after.filter_traces(ignored).compare_to(before.filter_traces(ignored), "lineno")
+    return {
+        "size_diff_kb": round(sum(item.size_diff for item in stats) / 1024, 1),
+        "top": [
+            {
+                "site": f"{item.traceback[0].filename}:{item.traceback[0].lineno}",
+                "size_diff_kb": round(item.size_diff / 1024, 1),
+                "size_kb": round(item.size / 1024, 1),
+                "count_diff": item.count_diff,
+            }
+            for item in stats[:top]
+        ],
+    }
+
+
+def run_debug_profile(seconds, interval, top, all_threads):
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        inflight = REQUEST_TRACKER.snapshot(exclude=threading.get_ident())
+        samples, stacks = sample_thread_stacks(seconds, interval, all_threads)
+        allocations = diff_tracemalloc(before, tracemalloc.take_snapshot(), top)
+    finally:
+        # 仅停止由本次分析开启的 tracemalloc，避免长期承担分配跟踪的开销。
+        if started_tracing:
+            tracemalloc.stop()
+    collapsed = "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+    return {
+        "pid": os.getpid(),
+        "worker": WORKER_INDEX,
+        "seconds": seconds,
+        "interval_ms": round(interval * 1000),
+        "samples": samples,
+        "threads": "all" if all_threads else "handlers",
+        "collapsed": collapsed,
+        "tracemalloc": allocations,
+        "inflight": inflight,
+    }
+
+
+def collect_metrics():
+    return {
+        "hedge": LLM_HEDGE.snapshot(),
+        "endpoints": LLM_POOL.snapshot(),
+        "routes": LLM_ROUTE_STATS.snapshot(),
+        "prefetch": STEP_PREFETCH.snapshot(),
+        "upstream_connections": UPSTREAM_CONNECTIONS.snapshot(),
+        "shared_cache": SHARED_CACHE.snapshot(),
+        "step_archive": STEP_ARCHIVE.snapshot(),
+        "prompt_cache": PROMPT_ARTIFACTS.snapshot(),
+        "prompt_search": PROMPT_SEARCH.snapshot(),
+        "llm_cancel": LLM_CANCEL_STATS.snapshot(),
+        "chat": CHAT_STORE.snapshot(),
+        "worker": {"index": WORKER_INDEX, "pid": os.getpid(), "workers": WORKERS},
+    }
 
 
 class RequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 长连接：每个响应都以 Content-Length 或 chunked 结束块定界，无法定界的响应
+    # （SSE、HTTP/1.0 下的导出）显式关闭连接。
+    protocol_version = "HTTP/1.1"
+    # 响应头与响应体分两次写出，关闭 Nagle 避免长连接上的第二次写入等待延迟确认。
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.requests_served = 0
+
+    def handle_one_request(self):
+        self.request_ok = False
+        self.body_remaining = 0
+        # 只在等待下一个请求时计空闲超时；请求处理期间（等待模型、推送进度）不限时。
+        self.connection.settimeout(HTTP_KEEPALIVE_TIMEOUT_SECONDS)
+        try:
+            super().handle_one_request()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端在空闲等待或响应途中断开，长连接下属于常见情况，直接结束该连接。
+            self.close_connection = True
+        finally:
+            REQUEST_TRACKER.end()
+        # 未读完的请求体会被当作下一个请求解析，只能关闭连接。
+        if self.body_remaining:
+            self.close_connection = True
+
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            self.send_error(411, "Length Required")
+            return False
+        try:
+            self.body_remaining = max(0, int(self.headers.get("Content-Length") or 0))
+        except ValueError:
+            self.send_error(400, "Bad Content-Length")
+            return False
+        self.connection.settimeout(None)
+        self.request_ok = True
+        self.requests_served += 1
+        REQUEST_TRACKER.begin(
+            self.command, urllib.parse.urlparse(self.path).path, self.client_address[0]
+        )
+        return True
+
+    def end_headers(self):
+        if not self.close_connection:
+            if self.body_remaining or self.requests_served >= HTTP_KEEPALIVE_MAX_REQUESTS:
+                self.send_header("Connection", "close")
+            else:
+                if self.request_version == "HTTP/1.0":
+                    self.send_header("Connection", "keep-alive")
+                self.send_header(
+                    "Keep-Alive",
+                    f"timeout={HTTP_KEEPALIVE_TIMEOUT_SECONDS}, "
+                    f"max={HTTP_KEEPALIVE_MAX_REQUESTS - self.requests_served}",
+                )
+        super().end_headers()
+
+    def send_error(self, code, message=None, explain=None):
+        # 基类实现总是附带 Connection: close；请求已完整解析且没有未读请求体时保持连接可复用。
+        if self.close_connection or not getattr(self, "request_ok", False) or self.body_remaining:
+            return super().send_error(code, message, explain)
+        short, long = self.responses.get(code, ("???", "???"))
+        message = short if message is None else message
+        explain = long if explain is None else explain
+        self.log_error("code %d, message %s", code, message)
+        body = (
+            self.error_message_format
+            % {
+                "code": code,
+                "message": html.escape(message, quote=False),
+                "explain": html.escape(explain, quote=False),
+            }
+        ).encode("utf-8", "replace")
+        self.send_response(code, message)
+        self.send_header("Content-Type", self.error_content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_GET(self):
         path = urllib.parse.urlparse(self.path).path
         if path == "/api/prompts":
             return self.handle_prompts()
+        if path == "/api/prompts/search":
+            return self.handle_prompt_search()
         if path == "/api/image_config":
             return self.handle_image_config_get()
         if path == "/api/steps":
             return self.handle_steps()
         if path == "/api/config":
             return self.handle_config_get()
+        if path == "/healthz":
+            return self.send_json(
+                {"status": "ok", "uptime_s": round(time.time() - PROCESS_STARTED)}
+            )
+        if path == "/readyz":
+            return self.send_json(
+                {
+                    "ready": WARMUP_STATE["ready"],
+                    "started": WARMUP_STATE["started"],
+                    "finished": WARMUP_STATE["finished"],
+                    "warmup": WARMUP_STATE["report"],
+                },
+                status=200 if WARMUP_STATE["ready"] else 503,
+            )
+        if path == "/api/metrics":
+            return self.send_json(collect_metrics())
+        if path == "/api/debug/profile":
+            return self.handle_debug_profile()
+        if path == "/api/image_cache":
+            return self.send_json(IMAGE_RESULT_CACHE.snapshot())
+        if path == "/api/transcripts":
+            return self.handle_transcript_get()
+        if path == "/api/chat":
+            return self.handle_chat_get()
+        if path == "/api/history":
+            return self.handle_history_get()
+        if path == "/api/history/search":
+            return self.handle_history_get(search=True)
+        if path == "/api/export":
+            return self.handle_export_get()
+        if path.startswith("/api/images/"):
+            return self.handle_image_file(path[len("/api/images/"):])
+        if path.startswith("/api/image_jobs/"):
+            job_path = path[len("/api/image_jobs/"):]
+            if job_path.endswith("/events"):
+                return self.handle_image_job_events(job_path[: -len("/events")])
+            return self.handle_image_job_get(job_path)
         if path in {"", "/"}:
             return self.serve_file("index.html", "text/html; charset=utf-8")
         if path == "/app.js":
@@ -1334,43 +5207,230 @@ class RequestHandler(BaseHTTPRequestHandler):
             return self.handle_config_set()
         if self.path == "/api/image_generate":
             return self.handle_image_generate()
+        if self.path == "/api/image_jobs":
+            return self.handle_image_job_submit()
         if self.path == "/api/chat":
             return self.handle_chat()
         if self.path == "/api/run_step":
             return self.handle_run_step()
+        if self.path == "/api/export":
+            return self.handle_export_post()
         self.send_error(404, "Not Found")
 
     def handle_steps(self):
         try:
             prompt_data = load_system_prompt_data()
-            steps = [
-                {
-                    "id": "input",
-                    "title": "需求输入",
-                    "question": "请粘贴或输入原始需求描述。",
-                    "input_label": "原始需求描述",
-                    "input_placeholder": "请尽量完整描述业务背景、目标与边界。",
-                    "output_visible": False,
-                    "generate": False,
-                }
-            ]
-            steps.extend(prompt_data.get("steps", []))
-            response = {
-                "steps": steps,
-                "assumption_step_id": prompt_data.get("assumption_step_id", ""),
-            }
-            return self.send_json(response)
+            return self.send_cached_json(prompt_data.steps_payload, prompt_data.steps_etag)
         except ValueError as exc:
             logger.warning("步骤配置加载失败: %s", exc)
             return self.send_json({"error": str(exc)}, status=500)
 
     def handle_config_get(self):
         try:
-            config = get_effective_config()
-            return self.send_json(config)
+            body, etag = get_config_snapshot().public_payload
+            # 配置响应含 api_key，不进入浏览器缓存；轮询方自行携带 If-None-Match 即可得到 304。
+            return self.send_cached_json(body, etag, cache_control="no-store")
         except ValueError as exc:
             return self.send_json({"error": str(exc)}, status=400)
 
+    def handle_transcript_get(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        trace_id = normalize_text((query.get("trace_id") or [""])[0], 64)
+        if not trace_id:
+            return self.send_json({"error": "缺少 trace_id"}, status=400)
+        try:
+            records = TRANSCRIPT_STORE.get(trace_id)
+        except Exception:
+            logger.exception("LLM完整记录查询异常 trace=%s", trace_id)
+            return self.send_json({"error": "记录查询失败"}, status=500)
+        if not records:
+            return self.send_json({"error": "未找到对应记录"}, status=404)
+        return self.send_json({"trace_id": trace_id, "records": records})
+
+    def handle_export_get(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        session_ids = list(dict.fromkeys(item.strip() for item in query.get("session_id", [])))
+        if not session_ids or not all(SESSION_ID_RE.match(item) for item in session_ids):
+            return self.send_json({"error": "会话标识无效"}, status=400)
+        if len(session_ids) > EXPORT_MAX_SESSIONS:
+            return self.send_json(
+                {"error": f"单次最多导出 {EXPORT_MAX_SESSIONS} 个会话"}, status=400
+            )
+        if not STEP_ARCHIVE_ENABLED:
+            return self.send_json({"error": "步骤归档未开启"}, status=404)
+        try:
+            session_ids = [item for item in session_ids if STEP_ARCHIVE.has_session(item)]
+        except sqlite3.Error:
+            logger.exception("导出查询异常")
+            return self.send_json({"error": "记录查询失败"}, status=500)
+        if not session_ids:
+            return self.send_json({"error": "未找到归档记录"}, status=404)
+        names = load_export_step_names()
+        # 多个会话时每个会话一个目录，单个会话直接放在压缩包根目录。
+        prefix = (lambda item: f"{item}/") if len(session_ids) > 1 else (lambda item: "")
+
+        def write(archive):
+            for session_id in session_ids:
+                write_export_archive_session(archive, prefix(session_id), session_id, names)
+
+        return self.stream_export(write, len(session_ids))
+
+    def handle_export_post(self):
+        try:
+            payload = self.read_json()
+        except ValueError as exc:
+            return self.send_json({"error": str(exc)}, status=400)
+        state = normalize_state(payload.get("state", {}))
+        session_id = str(payload.get("session_id") or "").strip()
+        if session_id and not SESSION_ID_RE.match(session_id):
+            return self.send_json({"error": "会话标识无效"}, status=400)
+        # 带会话标识且归档中有记录时，历史改用归档中的完整记录，而非客户端携带的最近几条。
+        archived = False
+        if session_id and STEP_ARCHIVE_ENABLED:
+            try:
+                archived = STEP_ARCHIVE.has_session(session_id)
+            except sqlite3.Error:
+                logger.exception("导出查询异常 session=%s", session_id)
+        if archived:
+            state["step_history"] = {}
+        has_content = (
+            state["requirement"] or any(state["step_outputs"].values()) or state["step_history"]
+        )
+        if not (has_content or archived):
+            return self.send_json({"error": "没有可导出的内容"}, status=400)
+        names = load_export_step_names()
+
+        def write(archive):
+            write_export_state(archive, "", state, names)
+            if archived:
+                write_export_archive_session(archive, "", session_id, names, outputs=False)
+
+        return self.stream_export(write, 1)
+
+    def stream_export(self, write, sessions):
+        # HTTP/1.0 客户端不支持 chunked，改为不带长度、以关闭连接结束。
+        chunked = self.request_version == "HTTP/1.1"
+        filename = time.strftime("export-%Y%m%d-%H%M%S.zip")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Disposition", f'attachment; filename="{filename}"')
+        self.send_header("Cache-Control", "no-store")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        writer = ChunkedWriter(self.wfile, chunked)
+        archive = zipfile.ZipFile(writer, "w", compression=zipfile.ZIP_DEFLATED)
+        start = time.monotonic()
+        try:
+            write(archive)
+            archive.close()
+            writer.finish()
+        except (BrokenPipeError, ConnectionResetError):
+            writer.abort()
+            archive.fp = None
+            self.close_connection = True
+            logger.info("导出中止 客户端已断开 sessions=%d sent=%d", sessions, writer.sent)
+            return
+        except Exception:
+            writer.abort()
+            archive.fp = None
+            self.close_connection = True
+            logger.exception("导出异常 sessions=%d sent=%d", sessions, writer.sent)
+            return
+        logger.info(
+            "导出完成 sessions=%d files=%d bytes=%d elapsed_ms=%.0f",
+            sessions,
+            len(archive.filelist),
+            writer.sent,
+            (time.monotonic() - start) * 1000,
+        )
+
+    def handle_debug_profile(self):
+        token = os.getenv("DEBUG_TOKEN", "").strip()
+        if not token:
+            return self.send_error(404, "Not Found")
+        # 只接受本机直连：经反向代理转发的请求即使来自回环地址也拒绝。
+        try:
+            local = ipaddress.ip_address(self.client_address[0]).is_loopback
+        except ValueError:
+            local = False
+        if not local or self.headers.get("X-Forwarded-For") or self.headers.get("X-Real-IP"):
+            logger.warning("调试分析拒绝访问 client=%s", self.client_address[0])
+            return self.send_json({"error": "仅允许本机访问"}, status=403)
+        supplied = self.headers.get("Authorization", "")
+        supplied = supplied[7:].strip() if supplied.startswith("Bearer ") else ""
+        if not hmac.compare_digest(supplied.encode("utf-8"), token.encode("utf-8")):
+            logger.warning("调试分析鉴权失败 client=%s", self.client_address[0])
+            return self.send_json({"error": "鉴权失败"}, status=401)
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        try:
+            seconds = float((query.get("seconds") or ["5"])[0] or 5)
+            interval_ms = float((query.get("interval_ms") or [str(DEBUG_PROFILE_INTERVAL_MS)])[0])
+            top = int((query.get("top") or ["20"])[0] or 20)
+        except ValueError:
+            return self.send_json({"error": "分析参数无效"}, status=400)
+        seconds = min(DEBUG_PROFILE_MAX_SECONDS, max(0.1, seconds))
+        interval = min(1.0, max(0.001, interval_ms / 1000))
+        top = min(DEBUG_PROFILE_TOP_MAX, max(1, top))
+        all_threads = (query.get("threads") or [""])[0] == "all"
+        if not DEBUG_PROFILE_LOCK.acquire(blocking=False):
+            return self.send_json({"error": "已有分析任务在进行"}, status=409)
+        try:
+            logger.info(
+                "调试分析开始 seconds=%.1f interval_ms=%.0f threads=%s",
+                seconds,
+                interval * 1000,
+                "all" if all_threads else "handlers",
+            )
+            result = run_debug_profile(seconds, interval, top, all_threads)
+        finally:
+            DEBUG_PROFILE_LOCK.release()
+        logger.info(
+            "调试分析完成 samples=%d inflight=%d alloc_kb=%.1f",
+            result["samples"],
+            len(result["inflight"]),
+            result["tracemalloc"]["size_diff_kb"],
+        )
+        if (query.get("format") or [""])[0] == "collapsed":
+            body = (result["collapsed"] + "\n").encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        return self.send_json(result)
+
+    def handle_history_get(self, search=False):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        session_id = (query.get("session_id") or [""])[0].strip()
+        if not SESSION_ID_RE.match(session_id):
+            return self.send_json({"error": "会话标识无效"}, status=400)
+        step_id = normalize_text((query.get("step_id") or [""])[0], 64)
+        text = normalize_text((query.get("q") or [""])[0], MAX_OPTION_LEN)
+        if search and not text:
+            return self.send_json({"error": "缺少检索关键词"}, status=400)
+        try:
+            before = max(0, int((query.get("before") or ["0"])[0] or 0))
+            limit = int((query.get("limit") or ["20"])[0] or 20)
+        except ValueError:
+            return self.send_json({"error": "分页参数无效"}, status=400)
+        limit = min(STEP_ARCHIVE_PAGE_MAX, max(1, limit))
+        if not STEP_ARCHIVE_ENABLED:
+            return self.send_json({"error": "步骤归档未开启"}, status=404)
+        try:
+            if search:
+                page = STEP_ARCHIVE.search(session_id, text, step_id=step_id, before=before, limit=limit)
+            else:
+                page = STEP_ARCHIVE.fetch(session_id, step_id=step_id, before=before, limit=limit)
+        except sqlite3.Error:
+            logger.exception("步骤归档查询异常 session=%s", session_id)
+            return self.send_json({"error": "归档查询失败"}, status=500)
+        page["session_id"] = session_id
+        return self.send_json(page)
+
     def handle_image_config_get(self):
         config = get_effective_image_config()
         return self.send_json(config)
@@ -1380,26 +5440,49 @@ class RequestHandler(BaseHTTPRequestHandler):
             root = get_prompt_root()
             if not os.path.isdir(root):
                 return self.send_json({"error": "prompt 目录不存在"}, status=400)
-            tree = build_prompt_tree(root)
+            tree = get_prompt_tree()
             selected = normalize_prompt_path(get_effective_config().get("prompt_path", ""))
             return self.send_json({"tree": tree, "selected": selected})
         except Exception:
             logger.exception("提示词列表加载失败")
             return self.send_json({"error": "提示词列表加载失败"}, status=500)
 
+    def handle_prompt_search(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        text = normalize_text((query.get("q") or [""])[0], MAX_OPTION_LEN)
+        if not tokenize_search_text(text):
+            return self.send_json({"error": "缺少检索关键词"}, status=400)
+        try:
+            limit = int((query.get("limit") or ["20"])[0] or 20)
+        except ValueError:
+            return self.send_json({"error": "分页参数无效"}, status=400)
+        limit = min(PROMPT_SEARCH_LIMIT_MAX, max(1, limit))
+        if not os.path.isdir(get_prompt_root()):
+            return self.send_json({"error": "prompt 目录不存在"}, status=400)
+        try:
+            start = time.perf_counter()
+            result = PROMPT_SEARCH.search(text, limit)
+        except Exception:
+            logger.exception("提示词检索失败 q=%s", text)
+            return self.send_json({"error": "提示词检索失败"}, status=500)
+        result["query"] = text
+        result["took_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        return self.send_json(result)
+
     def handle_config_set(self):
         try:
             payload = self.read_json()
             update_runtime_config(payload)
             config = get_effective_config()
             logger.info(
-                "配置已更新 api_key_set=%s model=%s base_url=%s log_llm=%s",
+                "配置已更新 api_key_set=%s model=%s base_url=%s log_llm=%s endpoints=%d",
                 bool(config.get("api_key")),
                 config.get("model", ""),
                 config.get("base_url", ""),
                 bool(config.get("log_llm")),
+                len(config.get("endpoints", [])),
             )
-            return self.send_json(config)
+            return self.send_json(public_config(config))
         except ValueError as exc:
             logger.warning("配置更新失败: %s", exc)
             return self.send_json({"error": str(exc)}, status=400)
@@ -1418,6 +5501,10 @@ class RequestHandler(BaseHTTPRequestHandler):
                 mode = "regenerate"
             run_input = normalize_text(payload.get("run_input", ""), MAX_CONTEXT_LEN)
             state = normalize_state(payload.get("state", {}))
+            session_id = str(payload.get("session_id") or "").strip()
+            if session_id and not SESSION_ID_RE.match(session_id):
+                return self.send_json({"error": "会话标识无效"}, status=400)
+            session_id = session_id or uuid.uuid4().hex
             trace_id = uuid.uuid4().hex[:12]
             step_input_len = len(state.get("step_inputs", {}).get(step_id, ""))
             output_count = sum(1 for value in state.get("step_outputs", {}).values() if value)
@@ -1438,17 +5525,21 @@ class RequestHandler(BaseHTTPRequestHandler):
                 return self.send_json({"error": "请先填写原始需求描述"}, status=400)
             prompt_data = load_system_prompt_data()
             user_prompt = load_user_prompt_text()
-            valid_steps = {step["id"] for step in prompt_data.get("steps", [])}
-            if step_id not in valid_steps:
+            if step_id not in prompt_data.step_index:
                 return self.send_json({"error": "步骤无效"}, status=400)
             if mode == "append" and not state.get("step_outputs", {}).get(step_id, ""):
                 return self.send_json({"error": "请先生成本步骤内容，再进行追加思考"}, status=400)
+            # 等待模型期间客户端断开（关闭页面等）时中止上游请求与后续重试，释放处理线程。
+            cancel = self.watch_disconnect()
             facts, updated = ensure_facts(
-                state, prompt_data, user_prompt, trace_id=trace_id
+                state, prompt_data, user_prompt, trace_id=trace_id, cancel=cancel
             )
             if facts:
                 state["facts"] = facts
             current_output = state.get("step_outputs", {}).get(step_id, "")
+            prefetch = parse_bool(payload.get("prefetch")) if "prefetch" in payload else None
+            if prefetch is None:
+                prefetch = STEP_PREFETCH_ENABLED
             output = generate_step_output(
                 step_id,
                 state,
@@ -1457,7 +5548,10 @@ class RequestHandler(BaseHTTPRequestHandler):
                 current_output,
                 mode,
                 trace_id=trace_id,
+                cancel=cancel,
+                prefetch=prefetch,
             )
+            self.unwatch_disconnect()
             if mode == "append" and current_output:
                 existing_norm = normalize_for_compare(current_output)
                 output_norm = normalize_for_compare(output)
@@ -1476,13 +5570,28 @@ class RequestHandler(BaseHTTPRequestHandler):
             if not isinstance(existing, list):
                 existing = []
             existing.append(entry)
-            if len(existing) > MAX_HISTORY_ITEMS:
-                existing = existing[-MAX_HISTORY_ITEMS:]
+            if len(existing) > STEP_HISTORY_RECENT:
+                existing = existing[-STEP_HISTORY_RECENT:]
             history[step_id] = existing
             state["step_history"] = history
-            response = {"output": output, "step_history": history}
+            if STEP_ARCHIVE_ENABLED:
+                STEP_ARCHIVE.record(
+                    session_id,
+                    step_id,
+                    entry,
+                    trace_id=trace_id,
+                    prompt=get_effective_config().get("prompt_path", "")
+                    or os.path.basename(get_system_prompt_path() or ""),
+                )
+            response = {"output": output, "step_history": history, "session_id": session_id}
             if updated:
                 response["facts"] = facts
+            if prefetch and mode != "append":
+                prefetch_step = schedule_step_prefetch(
+                    step_id, state, prompt_data, user_prompt, output, trace_id=trace_id
+                )
+                if prefetch_step:
+                    response["prefetch_step"] = prefetch_step
             logger.info(
                 "步骤请求完成 trace=%s step=%s mode=%s output_len=%d facts_updated=%s",
                 trace_id,
@@ -1492,19 +5601,37 @@ class RequestHandler(BaseHTTPRequestHandler):
                 updated,
             )
             return self.send_json(response)
+        except UpstreamAborted:
+            logger.info("步骤请求取消 trace=%s 客户端已断开", trace_id)
+            self.close_connection = True
         except ValueError as exc:
             logger.warning("步骤请求校验失败: %s", exc)
             return self.send_json({"error": str(exc)}, status=400)
         except Exception:
             logger.exception("步骤请求异常")
             return self.send_json({"error": "模型调用失败，请检查配置或稍后重试"}, status=500)
+        finally:
+            self.unwatch_disconnect()
 
     def handle_chat(self):
+        trace_id = ""
         try:
             payload = self.read_json()
-            messages = normalize_messages(payload.get("messages", []))
-            if not messages:
-                return self.send_json({"error": "对话内容为空"}, status=400)
+            # 带 message 或 conversation_id 时由服务端保存历史，客户端每轮只发送新的一条用户消息；
+            # 否则沿用客户端提交完整 messages 的方式。
+            server_side = "message" in payload or "conversation_id" in payload
+            conversation_id = ""
+            if server_side:
+                message = normalize_text(payload.get("message", ""), MAX_CONTEXT_LEN)
+                if not message:
+                    return self.send_json({"error": "对话内容为空"}, status=400)
+                conversation_id = str(payload.get("conversation_id") or "").strip()
+                if conversation_id and not SESSION_ID_RE.match(conversation_id):
+                    return self.send_json({"error": "对话标识无效"}, status=400)
+            else:
+                messages = normalize_messages(payload.get("messages", []))
+                if not messages:
+                    return self.send_json({"error": "对话内容为空"}, status=400)
             config_override = normalize_chat_config(payload.get("config", {}))
             base_config = get_effective_config()
             chat_config = {
@@ -1520,35 +5647,92 @@ class RequestHandler(BaseHTTPRequestHandler):
             if not prompt_full:
                 return self.send_json({"error": "未选择提示词文件"}, status=400)
             prompt_data = load_system_prompt_data(prompt_full)
-            system_prompt = prompt_data.get("base_prompt", "")
+            system_prompt = prompt_data.base_prompt
             if not system_prompt:
                 return self.send_json({"error": "系统提示词为空"}, status=500)
             trace_id = uuid.uuid4().hex[:12]
+            excerpted = omitted = 0
+            if server_side:
+                if not conversation_id:
+                    history = [
+                        (item["role"], item["content"])
+                        for item in normalize_messages(payload.get("history", []))
+                    ]
+                    conversation_id = CHAT_STORE.create(prompt_path, history)
+                state = CHAT_STORE.load(conversation_id)
+                if state is None:
+                    return self.send_json({"error": "对话不存在或已过期"}, status=404)
+                turns = state["turns"] + [(0, "user", message, estimate_tokens(message))]
+                llm_messages, excerpted, omitted = build_chat_messages(
+                    system_prompt, state["summary"], turns, CHAT_HISTORY_TOKENS
+                )
+            else:
+                llm_messages = [{"role": "system", "content": system_prompt}] + messages
             logger.info(
-                "对话请求开始 trace=%s msgs=%d chars=%d",
+                "对话请求开始 trace=%s conversation=%s msgs=%d chars=%d excerpted=%d omitted=%d",
                 trace_id,
-                len(messages),
-                sum(len(item.get("content", "")) for item in messages),
+                conversation_id or "-",
+                len(llm_messages) - 1,
+                sum(len(item["content"]) for item in llm_messages[1:]),
+                excerpted,
+                omitted,
             )
+            cancel = self.watch_disconnect()
             reply = call_llm_with_config(
-                [{"role": "system", "content": system_prompt}] + messages,
+                llm_messages,
                 temperature=0.3,
                 config=chat_config,
                 tag="CHAT",
                 trace_id=trace_id,
+                cancel=cancel,
             )
+            self.unwatch_disconnect()
             logger.info(
                 "对话请求完成 trace=%s reply_len=%d",
                 trace_id,
                 len(reply or ""),
             )
-            return self.send_json({"reply": reply})
+            if not server_side:
+                return self.send_json({"reply": reply})
+            # 一问一答在模型成功返回后一起追加，失败或取消的轮次不进入历史。
+            reply_text = normalize_text(reply, MAX_CONTEXT_LEN) or "（空回复）"
+            if CHAT_STORE.append(conversation_id, [("user", message), ("assistant", reply_text)]) is None:
+                return self.send_json({"error": "对话不存在或已过期"}, status=404)
+            pending = sum(turn[3] for turn in turns) + estimate_tokens(reply_text)
+            if pending > CHAT_HISTORY_TOKENS:
+                schedule_chat_compaction(conversation_id, chat_config, trace_id)
+            return self.send_json({"reply": reply, "conversation_id": conversation_id})
+        except UpstreamAborted:
+            logger.info("对话请求取消 trace=%s 客户端已断开", trace_id)
+            self.close_connection = True
         except ValueError as exc:
             logger.warning("对话请求校验失败: %s", exc)
             return self.send_json({"error": str(exc)}, status=400)
         except Exception:
             logger.exception("对话请求异常")
             return self.send_json({"error": "模型调用失败，请检查配置或稍后重试"}, status=500)
+        finally:
+            self.unwatch_disconnect()
+
+    def handle_chat_get(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        conversation_id = (query.get("conversation_id") or [""])[0].strip()
+        if not SESSION_ID_RE.match(conversation_id):
+            return self.send_json({"error": "对话标识无效"}, status=400)
+        try:
+            limit = int((query.get("limit") or [str(CHAT_TRANSCRIPT_LIMIT)])[0] or CHAT_TRANSCRIPT_LIMIT)
+        except ValueError:
+            return self.send_json({"error": "分页参数无效"}, status=400)
+        try:
+            transcript = CHAT_STORE.transcript(
+                conversation_id, min(CHAT_TRANSCRIPT_LIMIT, max(1, limit))
+            )
+        except Exception:
+            logger.exception("对话记录查询异常 conversation=%s", conversation_id)
+            return self.send_json({"error": "记录查询失败"}, status=500)
+        if transcript is None:
+            return self.send_json({"error": "对话不存在或已过期"}, status=404)
+        return self.send_json(transcript)
 
     def handle_image_generate(self):
         try:
@@ -1556,24 +5740,20 @@ class RequestHandler(BaseHTTPRequestHandler):
             prompt = normalize_text(payload.get("prompt", ""), MAX_CONTEXT_LEN)
             if not prompt:
                 return self.send_json({"error": "提示词为空"}, status=400)
-            config_override = normalize_image_config(payload.get("config", {}))
-            base_config = get_effective_image_config()
-            image_config = {
-                "api_key": config_override.get("api_key") or base_config.get("api_key", ""),
-                "model": config_override.get("model") or base_config.get("model", ""),
-                "base_url": config_override.get("base_url") or base_config.get("base_url", ""),
-            }
+            image_config = merge_image_config(payload.get("config", {}))
+            force = parse_bool(payload.get("force")) is True
             trace_id = uuid.uuid4().hex[:12]
-            result = call_image_generation(prompt, image_config, trace_id=trace_id)
-            images = parse_image_response(result)
-            summary = summarize_image_result(result, images)
-            logger.info("生图响应摘要 trace=%s summary=%s", trace_id, summary)
+            images, summary, cached = generate_images(
+                prompt, image_config, trace_id=trace_id, force=force
+            )
+            if summary:
+                logger.info("生图响应摘要 trace=%s summary=%s", trace_id, summary)
             reply = (
                 f"已生成 {len(images)} 张图片。"
                 if images
                 else "未返回图片数据。"
             )
-            return self.send_json({"reply": reply, "images": images})
+            return self.send_json({"reply": reply, "images": images, "cached": cached})
         except ValueError as exc:
             logger.warning("生图请求校验失败: %s", exc)
             return self.send_json({"error": str(exc)}, status=400)
@@ -1581,6 +5761,107 @@ class RequestHandler(BaseHTTPRequestHandler):
             logger.exception("生图请求异常")
             return self.send_json({"error": "生图调用失败，请检查配置或稍后重试"}, status=500)
 
+    def handle_image_job_submit(self):
+        try:
+            payload = self.read_json()
+            variants = build_image_variants(payload)
+            if not variants:
+                return self.send_json({"error": "提示词为空"}, status=400)
+            image_config = merge_image_config(payload.get("config", {}))
+            check_image_config(image_config)
+            force = parse_bool(payload.get("force")) is True
+            job = submit_image_job(variants, image_config, force=force)
+            return self.send_json(job, status=202)
+        except OverflowError as exc:
+            logger.warning("生图任务提交被拒绝: %s", exc)
+            return self.send_json({"error": str(exc)}, status=429)
+        except ValueError as exc:
+            logger.warning("生图任务校验失败: %s", exc)
+            return self.send_json({"error": str(exc)}, status=400)
+        except Exception:
+            logger.exception("生图任务提交异常")
+            return self.send_json({"error": "生图任务提交失败"}, status=500)
+
+    def handle_image_job_get(self, job_id):
+        job = get_image_job(job_id)
+        if not job:
+            return self.send_json({"error": "生图任务不存在或已过期"}, status=404)
+        return self.send_json(job)
+
+    def handle_image_job_events(self, job_id):
+        # 以 Server-Sent Events 推送任务进度，任务结束后关闭连接。
+        job, version = wait_image_job(job_id, None, 0)
+        if not job:
+            return self.send_json({"error": "生图任务不存在或已过期"}, status=404)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            while job:
+                body = json.dumps(job, ensure_ascii=False)
+                self.wfile.write(f"event: progress\ndata: {body}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                if job["status"] in {"done", "failed"}:
+                    break
+                previous = version
+                job, version = wait_image_job(job_id, version, 15)
+                while job and version == previous:
+                    self.wfile.write(b": keepalive\n\n")
+                    self.wfile.flush()
+                    job, version = wait_image_job(job_id, version, 15)
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info("生图任务进度连接已断开 job=%s", job_id)
+
+    def handle_image_file(self, sha):
+        if not IMAGE_SHA_RE.match(sha):
+            self.send_error(404, "Not Found")
+            return
+        etag = f'"{sha}"'
+        cache_control = "public, max-age=31536000, immutable"
+        if etag_matches(self.headers.get("If-None-Match"), etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", cache_control)
+            self.end_headers()
+            return
+        opened = IMAGE_STORE.open(sha)
+        if not opened:
+            self.send_error(404, "Not Found")
+            return
+        handle, size, content_type = opened
+        with handle:
+            try:
+                byte_range = parse_byte_range(self.headers.get("Range"), size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            start, end = byte_range or (0, size - 1)
+            length = end - start + 1 if size else 0
+            self.send_response(206 if byte_range else 200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Cache-Control", cache_control)
+            self.send_header("ETag", etag)
+            self.send_header("Accept-Ranges", "bytes")
+            if byte_range:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.send_header("Content-Length", str(length))
+            self.end_headers()
+            handle.seek(start)
+            remaining = length
+            while remaining > 0:
+                chunk = handle.read(min(64 * 1024, remaining))
+                if not chunk:
+                    # 文件比声明的长度短，响应已无法正确定界。
+                    self.close_connection = True
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
     def serve_file(self, filename, content_type):
         path = os.path.join(WEB_DIR, filename)
         if not os.path.isfile(path):
@@ -1602,6 +5883,7 @@ class RequestHandler(BaseHTTPRequestHandler):
         if length > MAX_BODY_BYTES:
             raise ValueError("请求体过大")
         raw = self.rfile.read(length)
+        self.body_remaining = 0
         try:
             payload = json.loads(raw.decode("utf-8"))
         except json.JSONDecodeError as exc:
@@ -1610,8 +5892,19 @@ class RequestHandler(BaseHTTPRequestHandler):
             raise ValueError("JSON 必须为对象")
         return payload
 
+    def watch_disconnect(self):
+        cancel = CallCancellation()
+        CLIENT_MONITOR.watch(self.connection, cancel)
+        return cancel
+
+    def unwatch_disconnect(self):
+        CLIENT_MONITOR.unwatch(self.connection)
+
     def send_json(self, payload, status=200):
         body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_json_body(body, status)
+
+    def send_json_body(self, body, status=200):
         self.send_response(status)
         self.send_header("Content-Type", "application/json; charset=utf-8")
         self.send_header("Cache-Control", "no-store")
@@ -1619,14 +5912,176 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(body)
 
+    def send_cached_json(self, body, etag, cache_control="no-cache"):
+        # 预先编码的响应：客户端带回相同 ETag 时返回 304，不再传输响应体。
+        # no-cache 表示可缓存但每次须向服务端确认，浏览器会自动带上 If-None-Match。
+        if etag_matches(self.headers.get("If-None-Match"), etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", cache_control)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Cache-Control", cache_control)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def log_message(self, format, *args):
+        if urllib.parse.urlparse(getattr(self, "path", "")).path in {"/healthz", "/readyz"}:
+            return
+        # 长连接空闲超时属于正常关闭，不记录。
+        if format.startswith("Request timed out"):
+            return
         logger.info("HTTP %s - %s", self.address_string(), format % args)
 
 
+class ReusePortHTTPServer(ThreadingHTTPServer):
+    # 多个工作进程各自监听同一端口，由内核在进程间分配新连接。
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+def start_background_threads():
+    threading.Thread(
+        target=watch_env_files,
+        args=(ENV_RELOAD_INTERVAL_SECONDS,),
+        name="env-watcher",
+        daemon=True,
+    ).start()
+    if WARMUP_ENABLED:
+        threading.Thread(target=run_warmup, name="warmup", daemon=True).start()
+
+
+def use_watched_log_file():
+    # 多进程共用同一个日志文件时由主进程统一轮转，工作进程发现文件被改名后自动重新打开。
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if not isinstance(handler, RotatingFileHandler):
+            continue
+        watched = WatchedFileHandler(LOG_FILE, encoding="utf-8")
+        watched.setLevel(handler.level)
+        watched.setFormatter(handler.formatter)
+        root.removeHandler(handler)
+        handler.close()
+        root.addHandler(watched)
+
+
+def rotate_log_file():
+    try:
+        if os.path.getsize(LOG_FILE) < LOG_MAX_BYTES:
+            return
+    except OSError:
+        return
+    for index in range(LOG_BACKUP_COUNT - 1, 0, -1):
+        source = f"{LOG_FILE}.{index}"
+        if os.path.exists(source):
+            os.replace(source, f"{LOG_FILE}.{index + 1}")
+    os.replace(LOG_FILE, f"{LOG_FILE}.1")
+
+
+def run_worker(index, host, port):
+    global WORKER_INDEX
+    WORKER_INDEX = index
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    code = 0
+    try:
+        sync_runtime_config()
+        rebuild_config_snapshot()
+        server = ReusePortHTTPServer((host, port), RequestHandler)
+        start_background_threads()
+        logger.info("工作进程启动 worker=%d pid=%d", index, os.getpid())
+        server.serve_forever()
+    except Exception:
+        logger.exception("工作进程异常退出 worker=%d", index)
+        code = 1
+    finally:
+        logging.shutdown()
+        os._exit(code)
+
+
+def run_supervisor(host, port, count):
+    # 预先 fork 多个工作进程，监听同一端口；工作进程异常退出时按退避间隔重新拉起。
+    use_watched_log_file()
+    SHARED_CACHE.delete("config")
+    SHARED_CACHE.delete("image_job")
+    SHARED_CACHE.delete("prefetch")
+    SHARED_CACHE.close()
+    workers = {}
+    restarts = {}
+    stopping = []
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(index, host, port)
+        workers[pid] = (index, time.monotonic())
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(count):
+        spawn(index)
+    print(f"服务已启动: http://{host}:{port} (workers={count})")
+    logger.info("服务启动 host=%s port=%s workers=%d pid=%d", host, port, count, os.getpid())
+    pending = []
+    while workers or (pending and not stopping):
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid, status = 0, 0
+        if pid in workers:
+            index, started = workers.pop(pid)
+            if stopping:
+                continue
+            # 启动后很快退出（如端口被占用）时逐次加倍等待，避免频繁重启。
+            if time.monotonic() - started >= WORKER_STABLE_SECONDS:
+                restarts[index] = 1
+            else:
+                restarts[index] = min(restarts.get(index, 0.5) * 2, WORKER_RESTART_MAX_DELAY_SECONDS)
+            logger.warning(
+                "工作进程退出 worker=%d pid=%d code=%s restart_in=%.0fs",
+                index,
+                pid,
+                os.waitstatus_to_exitcode(status),
+                restarts[index],
+            )
+            pending.append((time.monotonic() + restarts[index], index))
+            continue
+        now = time.monotonic()
+        for item in [item for item in pending if item[0] <= now]:
+            pending.remove(item)
+            if not stopping:
+                spawn(item[1])
+        try:
+            rotate_log_file()
+        except OSError:
+            logger.warning("日志轮转失败: %s", LOG_FILE)
+        time.sleep(0.5)
+    SHARED_CACHE.delete("config")
+    logger.info("服务已停止 workers=%d", count)
+
+
 def run_server():
     host = os.getenv("HOST", "127.0.0.1")
     port = int(os.getenv("PORT", "8000"))
+    if WORKERS > 1:
+        if hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT"):
+            return run_supervisor(host, port, WORKERS)
+        logger.warning("当前平台不支持 fork/SO_REUSEPORT，按单进程运行 workers=%d", WORKERS)
     server = ThreadingHTTPServer((host, port), RequestHandler)
+    start_background_threads()
     print(f"服务已启动: http://{host}:{port}")
     logger.info("服务启动 host=%s port=%s", host, port)
     server.serve_forever()
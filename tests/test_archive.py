@@ -0,0 +1,32 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+class StepArchiveOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.archive = main.StepArchive(os.path.join(self.directory, "archive.db"), 90)
+
+    def test_steps_are_iterated_in_numeric_order(self):
+        connection = self.archive._connection()
+        for step in ("step_10", "step_2", "input", "step_1", "step_2", "step_0"):
+            connection.execute(
+                "INSERT INTO step_history (session, step, ts, mode, input, output, trace_id, prompt) "
+                "VALUES ('s', ?, 0, 'normal', '', ?, '', '')",
+                (step, step),
+            )
+        connection.commit()
+        steps = [row[0] for row in self.archive.iterate_session("s")]
+        self.assertEqual(steps, ["step_0", "step_1", "step_2", "step_2", "step_10", "input"])
+
+
+if __name__ == "__main__":
+    unittest.main()
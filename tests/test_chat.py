@@ -0,0 +1,76 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def make_turns(count, size):
+    turns = []
+    for seq in range(1, count + 1):
+        role = "user" if seq % 2 else "assistant"
+        content = f"第{seq}轮" + "内容" * size
+        turns.append((seq, role, content, main.estimate_tokens(content)))
+    return turns
+
+
+class BuildChatMessagesTest(unittest.TestCase):
+    def test_within_budget_sends_everything(self):
+        turns = make_turns(4, 10)
+        messages, excerpted, omitted = main.build_chat_messages("系统", "", turns, 10000)
+        self.assertEqual((excerpted, omitted), (0, 0))
+        self.assertEqual(len(messages), 5)
+        self.assertEqual(messages[0]["content"], "系统")
+
+    def test_lagging_summary_keeps_oldest_turns_truncated(self):
+        turns = make_turns(20, 400)
+        budget = 1500
+        messages, excerpted, omitted = main.build_chat_messages("系统", "旧摘要", turns, budget)
+        system = messages[0]["content"]
+        sent = len(messages) - 1
+        self.assertGreater(excerpted, 0)
+        self.assertEqual(excerpted + omitted + sent, len(turns))
+        self.assertIn("【此前对话摘要】\n旧摘要", system)
+        # 最早的未摘要轮次以截断形式保留，且不超过单轮截断长度。
+        self.assertIn("用户：第1轮", system)
+        for line in system.split("【较早对话节选")[1].splitlines()[1 : excerpted + 1]:
+            self.assertLessEqual(len(line), main.CHAT_BACKLOG_TURN_CHARS + 4)
+        if omitted:
+            self.assertIn(f"另有 {omitted} 轮", system)
+        self.assertEqual(messages[-1]["content"], turns[-1][2])
+
+
+class CompactionFailureTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = main.ChatStore(os.path.join(self.directory, "chat.db"), 0)
+        patcher = mock.patch.object(main, "CHAT_STORE", self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def test_repeated_failures_are_counted_and_reset_on_success(self):
+        history = [("user" if index % 2 == 0 else "assistant", "很长的内容" * 800) for index in range(8)]
+        conversation_id = self.store.create("p.md", history)
+        failing = mock.patch.object(main, "call_llm_with_config", side_effect=RuntimeError("boom"))
+        with failing, self.assertLogs(main.logger, "ERROR") as logs:
+            for _ in range(main.CHAT_SUMMARY_ALERT_FAILURES):
+                main.compact_chat_conversation(conversation_id, {})
+        self.assertIn(f"failures={main.CHAT_SUMMARY_ALERT_FAILURES}", logs.output[-1])
+        stats = self.store.snapshot()
+        self.assertEqual(stats["summary_failures"], main.CHAT_SUMMARY_ALERT_FAILURES)
+        self.assertEqual(stats["summary_failing"], 1)
+        with mock.patch.object(main, "call_llm_with_config", return_value="摘要"):
+            main.compact_chat_conversation(conversation_id, {})
+        stats = self.store.snapshot()
+        self.assertEqual((stats["summaries"], stats["summary_failing"]), (1, 0))
+        self.assertEqual(self.store.load(conversation_id)["summary"], "摘要")
+
+
+if __name__ == "__main__":
+    unittest.main()
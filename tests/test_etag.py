@@ -0,0 +1,79 @@
+import http.client
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+class ConfigVersionTest(unittest.TestCase):
+    def test_same_content_gives_same_version_and_etag(self):
+        # 模拟两个工作进程各自构建快照：内容相同则版本与 ETag 相同，与构建次数无关。
+        values = dict(main.get_effective_config())
+        image = dict(main.get_effective_image_config())
+        first = main.ConfigSnapshot(dict(values), dict(image))
+        main.rebuild_config_snapshot()
+        second = main.ConfigSnapshot(dict(values), dict(image))
+        self.assertEqual(first.version, second.version)
+        self.assertEqual(first.public_payload, second.public_payload)
+
+    def test_changed_content_changes_version_and_etag(self):
+        values = dict(main.get_effective_config())
+        image = dict(main.get_effective_image_config())
+        first = main.ConfigSnapshot(dict(values), image)
+        values["model"] = values["model"] + "-other"
+        second = main.ConfigSnapshot(values, image)
+        self.assertNotEqual(first.version, second.version)
+        self.assertNotEqual(first.public_payload[1], second.public_payload[1])
+
+
+class ConditionalGetTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.prompt_path = os.path.join(cls.directory, "prompt.md")
+        with open(cls.prompt_path, "w", encoding="utf-8") as handle:
+            handle.write("# 测试\n## STEP 1｜方案\n写方案\n## STEP 2｜细化\n细化方案\n")
+        cls.patch = mock.patch.dict(os.environ, {"SYSTEM_PROMPT_FILE": cls.prompt_path})
+        cls.patch.start()
+        main.rebuild_config_snapshot()
+        cls.server = main.ThreadingHTTPServer(("127.0.0.1", 0), main.RequestHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.patch.stop()
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def fetch(self, path, etag=None):
+        connection = http.client.HTTPConnection("127.0.0.1", self.server.server_address[1], timeout=10)
+        self.addCleanup(connection.close)
+        connection.request("GET", path, headers={"If-None-Match": etag} if etag else {})
+        response = connection.getresponse()
+        return response, response.read()
+
+    def test_revalidation_returns_304_without_body(self):
+        for path, cache_control in (("/api/steps", "no-cache"), ("/api/config", "no-store")):
+            response, body = self.fetch(path)
+            etag = response.getheader("ETag")
+            self.assertEqual(response.status, 200)
+            self.assertTrue(etag and body)
+            self.assertEqual(response.getheader("Cache-Control"), cache_control)
+            response, body = self.fetch(path, etag)
+            self.assertEqual((response.status, body), (304, b""))
+            self.assertEqual(response.getheader("ETag"), etag)
+            response, _ = self.fetch(path, '"stale"')
+            self.assertEqual(response.status, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+import http.client
+import io
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+PROMPT = "# 测试\n## STEP 0｜事实\n提取事实\n## STEP 3｜方案\n写方案\n## STEP 4｜细化\n细化方案\n"
+
+
+class CountingConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connects = 0
+
+    def connect(self):
+        self.connects += 1
+        super().connect()
+
+
+class KeepAliveTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        prompt_path = os.path.join(cls.directory, "prompt.md")
+        with open(prompt_path, "w", encoding="utf-8") as handle:
+            handle.write(PROMPT)
+        cls.patches = [
+            mock.patch.dict(os.environ, {"SYSTEM_PROMPT_FILE": prompt_path}),
+            mock.patch.object(main, "HTTP_KEEPALIVE_TIMEOUT_SECONDS", 1),
+            mock.patch.object(main, "HTTP_KEEPALIVE_MAX_REQUESTS", 5),
+        ]
+        for patch in cls.patches:
+            patch.start()
+        main.rebuild_config_snapshot()
+        cls.server = main.ThreadingHTTPServer(("127.0.0.1", 0), main.RequestHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.port = cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        for patch in reversed(cls.patches):
+            patch.stop()
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def connection(self):
+        connection = CountingConnection("127.0.0.1", self.port, timeout=10)
+        self.addCleanup(connection.close)
+        return connection
+
+    def fetch(self, connection, method, path, body=None, headers=None):
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        return response, response.read()
+
+    def raw(self, data, wait=0.3):
+        sock = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+        self.addCleanup(sock.close)
+        sock.sendall(data)
+        time.sleep(wait)
+        return sock, sock.recv(1 << 20)
+
+    def test_page_load_reuses_one_connection(self):
+        connection = self.connection()
+        for path in ("/", "/style.css", "/app.js", "/api/config"):
+            response, _ = self.fetch(connection, "GET", path)
+            self.assertEqual(response.status, 200, path)
+            self.assertIn("timeout=1", response.getheader("Keep-Alive", ""))
+        self.assertEqual(connection.connects, 1)
+
+    def test_errors_keep_the_connection(self):
+        connection = self.connection()
+        response, body = self.fetch(connection, "GET", "/api/nope")
+        self.assertEqual(response.status, 404)
+        self.assertEqual(int(response.getheader("Content-Length")), len(body))
+        response, _ = self.fetch(
+            connection, "POST", "/api/config", b"not json", {"Content-Type": "application/json"}
+        )
+        self.assertEqual(response.status, 400)
+        response, _ = self.fetch(connection, "GET", "/healthz")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(connection.connects, 1)
+
+    def test_request_cap_closes_the_connection(self):
+        connection = self.connection()
+        for index in range(5):
+            response, _ = self.fetch(connection, "GET", "/healthz")
+        self.assertEqual(response.getheader("Connection"), "close")
+        self.fetch(connection, "GET", "/healthz")
+        self.assertEqual(connection.connects, 2)
+
+    def test_idle_connection_is_closed_after_timeout(self):
+        sock, data = self.raw(b"GET /healthz HTTP/1.1\r\nHost: x\r\n\r\n", wait=0.1)
+        self.assertTrue(data.startswith(b"HTTP/1.1 200"))
+        started = time.monotonic()
+        self.assertEqual(sock.recv(10), b"")
+        self.assertLess(time.monotonic() - started, 3)
+
+    def test_pipelined_requests_are_answered_in_order(self):
+        _, data = self.raw(
+            b"GET /healthz HTTP/1.1\r\nHost: x\r\n\r\nGET /api/config HTTP/1.1\r\nHost: x\r\n\r\n"
+        )
+        self.assertEqual(data.count(b"HTTP/1.1 200"), 2)
+
+    def test_http10_closes_unless_keep_alive_requested(self):
+        for header, expect_closed in ((b"", True), (b"Connection: keep-alive\r\n", False)):
+            sock, _ = self.raw(b"GET /healthz HTTP/1.0\r\n" + header + b"\r\n", wait=0.2)
+            sock.settimeout(0.3)
+            try:
+                closed = sock.recv(10) == b""
+            except socket.timeout:
+                closed = False
+            self.assertEqual(closed, expect_closed, header)
+
+    def test_chunked_request_body_is_rejected(self):
+        _, data = self.raw(
+            b"POST /api/chat HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"2\r\n{}\r\n0\r\n\r\n"
+        )
+        self.assertTrue(data.startswith(b"HTTP/1.1 411"))
+
+    def test_chunked_export_leaves_the_connection_reusable(self):
+        connection = self.connection()
+        state = {"requirement": "做一个待办应用", "step_outputs": {"step_3": "x" * 200000}}
+        response, body = self.fetch(
+            connection,
+            "POST",
+            "/api/export",
+            json.dumps({"state": state}).encode("utf-8"),
+            {"Content-Type": "application/json"},
+        )
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Transfer-Encoding"), "chunked")
+        self.assertTrue(zipfile.ZipFile(io.BytesIO(body)).namelist())
+        response, _ = self.fetch(connection, "GET", "/healthz")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(connection.connects, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+class StepPrefetchCacheTest(unittest.TestCase):
+    def test_waits_for_pending_prefetch(self):
+        cache = main.StepPrefetchCache(60, 8)
+        self.assertTrue(cache.reserve("k"))
+        threading.Timer(0.2, cache.complete, ("k", "结果")).start()
+        self.assertEqual(cache.take("k"), "结果")
+        self.assertEqual(cache.snapshot()["hits"], 1)
+
+    def test_cancel_stops_waiting_and_keeps_entry(self):
+        cache = main.StepPrefetchCache(60, 8)
+        cache.reserve("k")
+        cancel = main.CallCancellation()
+        threading.Timer(0.2, cancel.cancel).start()
+        started = time.monotonic()
+        self.assertIsNone(cache.take("k", cancel))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(cache.snapshot()["misses"], 0)
+        cache.complete("k", "结果")
+        self.assertEqual(cache.take("k"), "结果")
+
+    def test_lookup_skipped_when_prefetch_off(self):
+        prompt = main.compile_prompt_text("# 测试\n## STEP 1｜方案\n写方案\n")
+        state = {"requirement": "做一个待办应用"}
+        with mock.patch.object(main.STEP_PREFETCH, "take") as take, mock.patch.object(
+            main, "call_llm", return_value="输出"
+        ):
+            output = main.generate_step_output("step_1", state, prompt, "", "", "normal")
+        self.assertEqual(output, "输出")
+        take.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
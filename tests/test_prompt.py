@@ -0,0 +1,35 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+class FrontMatterTest(unittest.TestCase):
+    def test_routes_block_is_stripped(self):
+        text = "---\nroutes:\n  STEP0_FACTS: fast\n  1: fast@a\n---\n## STEP 1｜方案\n写方案\n"
+        body, routes = main.parse_prompt_front_matter(text)
+        self.assertEqual(body, "## STEP 1｜方案\n写方案\n")
+        self.assertEqual(
+            [(route["model"], route["endpoint"]) for route in routes], [("fast", ""), ("fast", "a")]
+        )
+
+    def test_leading_horizontal_rule_is_kept(self):
+        for text in (
+            "---\n前言\n---\n## STEP 1｜方案\n写方案\n",
+            "---\n## STEP 1｜方案\n写方案\n---\n## STEP 2｜细化\n细化\n",
+            "---\n注意: 先读需求\n---\n## STEP 1｜方案\n写方案\n",
+            "---\ntitle: 示例\n---\n## STEP 1｜方案\n写方案\n",
+        ):
+            self.assertEqual(main.parse_prompt_front_matter(text), (text, []), text)
+
+    def test_steps_inside_leading_rules_are_parsed(self):
+        text = "---\n## STEP 1｜方案\n写方案\n---\n## STEP 2｜细化\n细化\n"
+        compiled = main.compile_prompt_text(text)
+        self.assertEqual([step.id for step in compiled.steps], ["step_1", "step_2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
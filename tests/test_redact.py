@@ -0,0 +1,71 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def reference_redact(text):
+    # 预筛选之前的逐条替换实现，作为等价性基准。
+    redacted = text
+    redacted = main.BEARER_RE.sub("Bearer ***", redacted)
+    redacted = main.KEY_RE.sub("sk-***", redacted)
+    redacted = main.EMAIL_RE.sub("***@***", redacted)
+    redacted = main.PHONE_RE.sub("***", redacted)
+    redacted = main.TOKEN_RE.sub("***", redacted)
+    return redacted
+
+
+FRAGMENTS = [
+    "sk-", "sk-abc", "sk-ABCDEFGH12", "SK-abcdefgh12", "bearer ", "Bearer\t", "BEARER  ",
+    "bearer", "token=", "@", "a@b", "user@example.com", "x.y@z.cn", "@@", ".com",
+    "13800138000", "1380013800", "138001380001", "１３８００１３８０００", "٣٤٥", "1",
+    "abcdefghijklmnopqrst", "ABCDEFGHIJKLMNOPQRS", "a_b-c_d-e_f-g_h-i_j-k", "-", "_", ".", "=",
+    "中文", "密钥", "：", "，", " ", "\n", "\t", "é", "ß", "ﬀ", "K", "ſk-", "ı",
+    "0123456789", "x" * 19, "y" * 21, "é" * 20,
+]
+ALPHABET = "abcXYZ019_-.=@ sk中é\n"
+
+
+def random_text(rng):
+    parts = []
+    for _ in range(rng.randint(0, 12)):
+        if rng.random() < 0.7:
+            parts.append(rng.choice(FRAGMENTS))
+        else:
+            parts.append("".join(rng.choice(ALPHABET) for _ in range(rng.randint(1, 25))))
+    return "".join(parts)
+
+
+class RedactForLogTest(unittest.TestCase):
+    def assert_same(self, text):
+        self.assertEqual(main.redact_for_log(text), reference_redact(text), repr(text))
+
+    def test_known_cases(self):
+        cases = [
+            "",
+            "普通中文文本，没有敏感信息。",
+            "Authorization: Bearer abcdefgh.ijkl=",
+            "key sk-abcdefgh12345678 end",
+            "mail me: someone@example.com",
+            "call 13800138000 now",
+            "id a1b2c3d4e5f6g7h8i9j0k1 ok",
+            "a" * 30 + "bearer 12345678",
+            "sk-" + "a" * 30,
+            "中文" + "b" * 25 + "中文",
+            "１３８００１３８０００",
+        ]
+        for text in cases:
+            self.assert_same(text)
+
+    def test_random_equivalence(self):
+        rng = random.Random(int(os.environ.get("REDACT_SEED", "20260101")))
+        for _ in range(int(os.environ.get("REDACT_CASES", "20000"))):
+            self.assert_same(random_text(rng))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,542 @@
+import argparse
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import glob
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import ipaddress
+import json
+import os
+import random
+import re
+import socket
+import ssl
+import sys
+import threading
+import time
+import urllib.parse
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOG_FILE = os.path.join(BASE_DIR, "logs", "app.log")
+LINE_RE = re.compile(
+    r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),(\d{3}) (\w+) \[[^\]]*\] [\w.]+: (\S+) ?(.*)$"
+)
+FIELD_RE = re.compile(r"(\w+)=(\S+)")
+# 只关心以下事件，其余日志行直接跳过。
+EVENTS = {
+    "LLM请求开始",
+    "LLM请求成功",
+    "LLM请求失败",
+    "LLM请求HTTP错误",
+    "LLM请求取消",
+    "步骤请求开始",
+    "步骤请求完成",
+    "对话请求开始",
+    "对话请求完成",
+}
+PERCENTILES = (0.5, 0.9, 0.99)
+FILLER = "用户需求描述与补充说明，包含页面、角色、流程和数据字段。"
+REPLAY_OUTPUT_CHARS = 800
+REPLAY_TIMEOUT_SECONDS = 600
+MOCK_DEFAULT_LATENCY_MS = 800
+MOCK_DEFAULT_RESP_CHARS = 1200
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def expand_log_paths(paths):
+    # 传入 app.log 时按 app.log.3、app.log.2、app.log.1、app.log 的顺序读取轮转备份。
+    expanded = []
+    for path in paths or [LOG_FILE]:
+        if os.path.isdir(path):
+            path = os.path.join(path, "app.log")
+        backups = []
+        for backup in glob.glob(glob.escape(path) + ".*"):
+            suffix = backup[len(path) + 1:]
+            if suffix.isdigit():
+                backups.append((int(suffix), backup))
+        expanded.extend(backup for _, backup in sorted(backups, reverse=True))
+        if os.path.exists(path):
+            expanded.append(path)
+    return expanded
+
+
+def parse_log_lines(paths):
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8", errors="replace") as handle:
+            for line in handle:
+                match = LINE_RE.match(line)
+                if not match or match.group(4) not in EVENTS:
+                    continue
+                try:
+                    stamp = datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S")
+                except ValueError:
+                    continue
+                ts = stamp.timestamp() + int(match.group(2)) / 1000
+                records.append((ts, match.group(4), dict(FIELD_RE.findall(match.group(5)))))
+    # 多进程共用日志文件时行序与时间序可能不一致，统一按时间排序后再配对。
+    records.sort(key=lambda item: item[0])
+    return records
+
+
+def to_int(value, default=0):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return default
+
+
+def collect_traffic(records):
+    # 返回 (LLM 调用列表, 入口请求列表)。LLM 调用按 (trace, tag) 把开始与结束配对，
+    # 入口请求为 /api/run_step 与 /api/chat，既用于统计端到端耗时，也作为回放的到达序列。
+    calls = []
+    requests = []
+    open_calls = defaultdict(deque)
+    open_requests = {}
+    for ts, event, fields in records:
+        trace = fields.get("trace", "")
+        if event == "LLM请求开始":
+            call = {
+                "ts": ts,
+                "tag": fields.get("tag", "-"),
+                "model": fields.get("model", "-"),
+                "chars": to_int(fields.get("chars")),
+                "attempts": 0,
+                "status": "incomplete",
+            }
+            open_calls[(trace, call["tag"])].append(call)
+            calls.append(call)
+            continue
+        if event.startswith("LLM请求"):
+            pending = open_calls.get((trace, fields.get("tag", "-")))
+            if not pending:
+                continue
+            call = pending[0]
+            call["attempts"] += 1
+            if event == "LLM请求成功":
+                call["status"] = "ok"
+                call["elapsed_ms"] = to_int(fields.get("elapsed_ms"))
+                call["total_ms"] = round((ts - call["ts"]) * 1000)
+                call["resp_chars"] = to_int(fields.get("resp_chars"))
+                pending.popleft()
+            elif event == "LLM请求取消":
+                call["status"] = "cancelled"
+                pending.popleft()
+            else:
+                call["status"] = "error"
+            continue
+        if event in {"步骤请求开始", "对话请求开始"}:
+            request = {"ts": ts, "fields": fields, "status": "incomplete"}
+            if event == "步骤请求开始":
+                request["kind"] = "run_step"
+                request["label"] = fields.get("step", "-")
+            else:
+                request["kind"] = "chat"
+                request["label"] = "conversation" if fields.get("conversation", "-") != "-" else "messages"
+            open_requests[trace] = request
+            requests.append(request)
+            continue
+        request = open_requests.pop(trace, None)
+        if request is not None:
+            request["status"] = "ok"
+            request["total_ms"] = round((ts - request["ts"]) * 1000)
+    return calls, requests
+
+
+def summarize(latencies):
+    row = {"p%d_ms" % round(fraction * 100): percentile(latencies, fraction) for fraction in PERCENTILES}
+    row["max_ms"] = max(latencies) if latencies else None
+    return row
+
+
+def build_report(calls, requests):
+    groups = defaultdict(list)
+    for call in calls:
+        hour = time.strftime("%Y-%m-%d %H:00", time.localtime(call["ts"]))
+        groups[("llm", call["tag"], call["model"], hour)].append(call)
+        groups[("llm", call["tag"], call["model"], "全部")].append(call)
+    for request in requests:
+        hour = time.strftime("%Y-%m-%d %H:00", time.localtime(request["ts"]))
+        groups[(request["kind"], request["label"], "-", hour)].append(request)
+        groups[(request["kind"], request["label"], "-", "全部")].append(request)
+    rows = []
+    for (kind, tag, model, hour), items in sorted(groups.items()):
+        done = [item for item in items if item["status"] == "ok"]
+        # LLM 调用按成功那次尝试的 elapsed_ms 统计，入口请求按开始到完成日志的间隔统计。
+        key = "elapsed_ms" if kind == "llm" else "total_ms"
+        latencies = [item[key] for item in done]
+        if hour == "全部":
+            span = max(item["ts"] for item in items) - min(item["ts"] for item in items)
+            minutes = max(1.0, span / 60)
+        else:
+            minutes = 60.0
+        row = {
+            "kind": kind,
+            "tag": tag,
+            "model": model,
+            "hour": hour,
+            "count": len(items),
+            "ok": len(done),
+            "errors": sum(1 for item in items if item["status"] == "error"),
+            "cancelled": sum(1 for item in items if item["status"] == "cancelled"),
+            "per_min": round(len(items) / minutes, 2),
+        }
+        row.update(summarize(latencies))
+        if kind == "llm":
+            row["avg_chars"] = round(sum(item["chars"] for item in items) / len(items))
+            row["avg_attempts"] = round(sum(item["attempts"] for item in done) / len(done), 2) if done else None
+        rows.append(row)
+    return rows
+
+
+def format_report(rows):
+    columns = (
+        ("hour", 16),
+        ("kind", 8),
+        ("tag", 16),
+        ("model", 20),
+        ("count", 6),
+        ("errors", 6),
+        ("per_min", 8),
+        ("p50_ms", 8),
+        ("p90_ms", 8),
+        ("p99_ms", 8),
+        ("max_ms", 8),
+        ("avg_chars", 9),
+    )
+    lines = [" ".join(name.ljust(width) for name, width in columns)]
+    for row in rows:
+        cells = []
+        for name, width in columns:
+            value = row.get(name)
+            cells.append(("-" if value is None else str(value)).ljust(width))
+        lines.append(" ".join(cells).rstrip())
+    return "\n".join(lines)
+
+
+def load_traffic(paths):
+    files = expand_log_paths(paths)
+    if not files:
+        raise SystemExit("未找到日志文件: %s" % ", ".join(paths or [LOG_FILE]))
+    calls, requests = collect_traffic(parse_log_lines(files))
+    return files, calls, requests
+
+
+def command_report(args):
+    files, calls, requests = load_traffic(args.logs)
+    rows = build_report(calls, requests)
+    if not args.hourly:
+        rows = [row for row in rows if row["hour"] == "全部"]
+    if args.json:
+        print(json.dumps({"files": files, "rows": rows}, ensure_ascii=False, indent=2))
+        return
+    print("日志文件: %s" % ", ".join(files))
+    print("LLM调用 %d 次，入口请求 %d 次" % (len(calls), len(requests)))
+    print(format_report(rows))
+
+
+def filler_text(length):
+    if length <= 0:
+        return ""
+    repeat = length // len(FILLER) + 1
+    return (FILLER * repeat)[:length]
+
+
+def parse_time_arg(value):
+    if not value:
+        return None
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            continue
+    raise SystemExit("时间格式无效: %s" % value)
+
+
+def build_replay_payload(request, step_ids, prompt_path, output_chars):
+    fields = request["fields"]
+    if request["kind"] == "chat":
+        # 按记录的条数与总字数构造 messages，保持上游请求体积一致。
+        count = max(1, to_int(fields.get("msgs"), 1))
+        chars = to_int(fields.get("chars"))
+        messages = []
+        for index in range(count):
+            role = "user" if (count - index) % 2 == 1 else "assistant"
+            messages.append({"role": role, "content": filler_text(max(1, chars // count))})
+        return "/api/chat", {"messages": messages, "config": {"prompt_path": prompt_path}}
+    step_id = fields.get("step", "")
+    if step_id not in step_ids:
+        step_id = step_ids[0]
+    others = [item for item in step_ids if item != step_id][: to_int(fields.get("outputs"))]
+    state = {
+        "requirement": filler_text(max(1, to_int(fields.get("req_len"), 1))),
+        "step_inputs": {step_id: filler_text(to_int(fields.get("input_len")))},
+        "step_outputs": {item: filler_text(output_chars) for item in others},
+    }
+    return "/api/run_step", {"step_id": step_id, "mode": fields.get("mode", "generate"), "state": state}
+
+
+def fetch_json(target, path):
+    parsed = urllib.parse.urlparse(target)
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=30)
+    try:
+        connection.request("GET", path)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b"{}")
+    finally:
+        connection.close()
+
+
+def is_local_url(url):
+    host = urllib.parse.urlparse(url).hostname or ""
+    try:
+        addresses = {item[4][0] for item in socket.getaddrinfo(host, None)}
+    except OSError:
+        return False
+    return bool(addresses) and all(ipaddress.ip_address(item.split("%")[0]).is_loopback for item in addresses)
+
+
+def first_prompt_file(tree):
+    for item in tree:
+        if item.get("type") == "file":
+            return item.get("path", "")
+        found = first_prompt_file(item.get("children", []))
+        if found:
+            return found
+    return ""
+
+
+def check_target(target, allow_remote, prompt_path):
+    # 回放会按生产流量发起模型调用，默认只允许目标实例指向本机的模拟上游。
+    status, config = fetch_json(target, "/api/config")
+    if status != 200:
+        raise SystemExit("读取目标实例配置失败 status=%s" % status)
+    urls = [config.get("base_url", "")] + [item.get("base_url", "") for item in config.get("endpoints", [])]
+    remote = [url for url in urls if url and not is_local_url(url)]
+    if remote and not allow_remote:
+        raise SystemExit("目标实例的上游不是本机地址，拒绝回放: %s（确需回放请加 --allow-remote-upstream）" % ", ".join(remote))
+    status, steps = fetch_json(target, "/api/steps")
+    if status != 200:
+        raise SystemExit("读取目标实例步骤失败 status=%s" % status)
+    step_ids = [item["id"] for item in steps.get("steps", []) if item.get("id") != "input"]
+    if not step_ids:
+        raise SystemExit("目标实例没有可运行的步骤")
+    # 对话请求需要指定提示词文件，未指定时沿用实例配置或取提示词目录中的第一个文件。
+    prompt_path = prompt_path or config.get("prompt_path", "")
+    if not prompt_path:
+        status, prompts = fetch_json(target, "/api/prompts")
+        prompt_path = first_prompt_file(prompts.get("tree", [])) if status == 200 else ""
+    return step_ids, prompt_path
+
+
+class ReplayRunner:
+    # 开环回放：按记录的到达间隔发出请求，不等待前一个请求完成，复现生产的并发形态。
+    def __init__(self, target, concurrency):
+        parsed = urllib.parse.urlparse(target)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="replay")
+        self.lock = threading.Lock()
+        self.results = []
+        self.in_flight = 0
+        self.peak = 0
+
+    def _send(self, kind, path, body, lag_ms):
+        with self.lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        start = time.monotonic()
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=REPLAY_TIMEOUT_SECONDS)
+        try:
+            connection.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException) as exc:
+            status = type(exc).__name__
+        finally:
+            connection.close()
+        elapsed_ms = (time.monotonic() - start) * 1000
+        with self.lock:
+            self.in_flight -= 1
+            self.results.append({"kind": kind, "status": status, "ms": elapsed_ms, "lag_ms": lag_ms})
+
+    def run(self, schedule):
+        started = time.monotonic()
+        futures = []
+        for offset, kind, path, body in schedule:
+            delay = started + offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            lag_ms = max(0.0, (time.monotonic() - started - offset) * 1000)
+            futures.append(self.executor.submit(self._send, kind, path, body, lag_ms))
+        for future in futures:
+            future.result()
+        self.executor.shutdown()
+        return time.monotonic() - started
+
+
+def command_replay(args):
+    _, _, requests = load_traffic(args.logs)
+    start = parse_time_arg(args.start)
+    end = parse_time_arg(args.end)
+    requests = [
+        item
+        for item in requests
+        if (start is None or item["ts"] >= start)
+        and (end is None or item["ts"] < end)
+        and (args.kind == "all" or item["kind"] == args.kind)
+    ]
+    if args.limit:
+        requests = requests[: args.limit]
+    if not requests:
+        raise SystemExit("选定范围内没有可回放的请求")
+    step_ids, prompt_path = check_target(args.target, args.allow_remote_upstream, args.prompt_path)
+    first = requests[0]["ts"]
+    schedule = []
+    for item in requests:
+        path, payload = build_replay_payload(item, step_ids, prompt_path, args.output_chars)
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        schedule.append(((item["ts"] - first) / args.speed, item["kind"], path, body))
+    recorded = schedule[-1][0]
+    print(
+        "回放 %d 个请求，原始时长 %.1fs，倍速 %.2f，预计 %.1fs"
+        % (len(schedule), recorded * args.speed, args.speed, recorded)
+    )
+    runner = ReplayRunner(args.target, args.concurrency)
+    duration = runner.run(schedule)
+    by_kind = defaultdict(list)
+    for result in runner.results:
+        by_kind[result["kind"]].append(result)
+    report = {"requests": len(runner.results), "duration_s": round(duration, 2), "peak_in_flight": runner.peak, "kinds": {}}
+    for kind, results in sorted(by_kind.items()):
+        statuses = defaultdict(int)
+        for result in results:
+            statuses[str(result["status"])] += 1
+        row = {"count": len(results), "status": dict(statuses)}
+        row.update({key: round(value) for key, value in summarize([item["ms"] for item in results]).items()})
+        row["lag_p99_ms"] = round(percentile([item["lag_ms"] for item in results], 0.99))
+        report["kinds"][kind] = row
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+class MockUpstream(BaseHTTPRequestHandler):
+    # 兼容 OpenAI chat/completions 的模拟上游：耗时与回复长度按日志中同一模型的成功调用抽样。
+    protocol_version = "HTTP/1.1"
+    samples = {}
+    latency_scale = 1.0
+
+    def log_message(self, format, *args):
+        return
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", "0") or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            payload = {}
+        model = str(payload.get("model", ""))
+        pool = self.samples.get(model) or self.samples.get("*") or [(MOCK_DEFAULT_LATENCY_MS, MOCK_DEFAULT_RESP_CHARS)]
+        elapsed_ms, resp_chars = random.choice(pool)
+        time.sleep(elapsed_ms * self.latency_scale / 1000)
+        body = json.dumps(
+            {
+                "model": model,
+                "choices": [{"message": {"role": "assistant", "content": filler_text(max(1, resp_chars))}}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": resp_chars, "total_tokens": resp_chars},
+            },
+            ensure_ascii=False,
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            pass
+
+
+def command_mock(args):
+    samples = defaultdict(list)
+    files = expand_log_paths(args.logs)
+    if files:
+        calls, _ = collect_traffic(parse_log_lines(files))
+        for call in calls:
+            if call["status"] == "ok":
+                sample = (call["elapsed_ms"], call["resp_chars"])
+                samples[call["model"]].append(sample)
+                samples["*"].append(sample)
+    MockUpstream.samples = dict(samples)
+    MockUpstream.latency_scale = args.latency_scale
+    server = ThreadingHTTPServer((args.host, args.port), MockUpstream)
+    server.daemon_threads = True
+    scheme = "http"
+    if args.cert:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(args.cert, args.key or None)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = "https"
+    print(
+        "模拟上游已启动: %s://%s:%d/v1/chat/completions 样本=%d"
+        % (scheme, args.host, server.server_address[1], len(samples.get("*", [])))
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="基于 app.log 的延迟报告与流量回放工具")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    report = commands.add_parser("report", help="按 tag、模型与小时统计延迟与吞吐")
+    report.add_argument("logs", nargs="*", help="日志文件或目录，默认 logs/app.log（自动包含轮转备份）")
+    report.add_argument("--hourly", action="store_true", help="输出逐小时明细")
+    report.add_argument("--json", action="store_true", help="以 JSON 输出")
+    report.set_defaults(func=command_report)
+
+    replay = commands.add_parser("replay", help="按记录的到达间隔向运行中的实例回放请求")
+    replay.add_argument("logs", nargs="*", help="日志文件或目录，默认 logs/app.log（自动包含轮转备份）")
+    replay.add_argument("--target", default="http://127.0.0.1:8000", help="目标实例地址")
+    replay.add_argument("--speed", type=float, default=1.0, help="回放倍速，2 表示间隔缩短一半")
+    replay.add_argument("--start", help="起始时间，如 2026-10-19 09:00")
+    replay.add_argument("--end", help="结束时间（不含）")
+    replay.add_argument("--kind", choices=("all", "run_step", "chat"), default="all")
+    replay.add_argument("--limit", type=int, default=0, help="最多回放的请求数")
+    replay.add_argument("--concurrency", type=int, default=256, help="回放端最大并发连接数")
+    replay.add_argument("--prompt-path", default="", help="对话请求使用的提示词文件（相对提示词目录）")
+    replay.add_argument("--output-chars", type=int, default=REPLAY_OUTPUT_CHARS, help="每个已有步骤输出的填充字数")
+    replay.add_argument("--allow-remote-upstream", action="store_true", help="允许目标实例指向非本机上游")
+    replay.set_defaults(func=command_replay)
+
+    mock = commands.add_parser("mock", help="启动按日志耗时抽样返回的模拟上游")
+    mock.add_argument("logs", nargs="*", help="用于抽样的日志，默认 logs/app.log；不存在时使用固定耗时")
+    mock.add_argument("--host", default="127.0.0.1")
+    mock.add_argument("--port", type=int, default=8443)
+    mock.add_argument("--cert", help="TLS 证书（实例要求上游为 https://）")
+    mock.add_argument("--key", help="TLS 私钥")
+    mock.add_argument("--latency-scale", type=float, default=1.0, help="耗时缩放系数")
+    mock.set_defaults(func=command_mock)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if getattr(args, "speed", 1.0) <= 0:
+        raise SystemExit("倍速必须大于 0")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
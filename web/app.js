@@ -5,6 +5,10 @@ const STORAGE_KEYS = {
 };
 
 const HISTORY_LIMIT = 100;
+const HISTORY_ROW_HEIGHT = 150;
+const HISTORY_OVERSCAN = 4;
+const HISTORY_SEARCH_DEBOUNCE_MS = 150;
+const IMAGE_JOB_POLL_MS = 1500;
 
 const state = {
   messages: [],
@@ -12,6 +16,11 @@ const state = {
   transferContent: "",
   inputHistory: [],
   historyFilter: "",
+  historyMatches: [],
+  historySearchTimer: 0,
+  historyFrame: 0,
+  requests: {},
+  conversationId: "",
   config: {
     api_key: "",
     model: "",
@@ -62,6 +71,10 @@ const historyList = document.getElementById("historyList");
 const historySearch = document.getElementById("historySearch");
 const historyStatus = document.getElementById("historyStatus");
 const toggleHistoryBtn = document.getElementById("toggleHistoryBtn");
+const historySpacer = document.createElement("div");
+const historyWindow = document.createElement("div");
+historySpacer.className = "history-list__spacer";
+historyWindow.className = "history-list__window";
 
 function setStatus(text, type = "") {
   statusBox.textContent = text || "";
@@ -131,6 +144,11 @@ function validateImageConfig(apiKey, model, baseUrl) {
   return "";
 }
 
+function createHistoryEntry(text, ts) {
+  // lower 为搜索用的小写索引，只在内存中保留。
+  return { text, ts, lower: text.toLowerCase() };
+}
+
 function loadInputHistory() {
   try {
     const raw = localStorage.getItem(STORAGE_KEYS.history);
@@ -138,10 +156,7 @@ function loadInputHistory() {
     if (!Array.isArray(parsed)) return [];
     const sanitized = parsed
       .filter((item) => item && typeof item.text === "string")
-      .map((item) => ({
-        text: item.text,
-        ts: typeof item.ts === "number" ? item.ts : Date.now(),
-      }));
+      .map((item) => createHistoryEntry(item.text, typeof item.ts === "number" ? item.ts : Date.now()));
     return sanitized.slice(0, HISTORY_LIMIT);
   } catch (error) {
     return [];
@@ -152,75 +167,120 @@ function persistInputHistory() {
   try {
     localStorage.setItem(
       STORAGE_KEYS.history,
-      JSON.stringify(state.inputHistory.slice(0, HISTORY_LIMIT))
+      JSON.stringify(
+        state.inputHistory.slice(0, HISTORY_LIMIT).map((item) => ({ text: item.text, ts: item.ts }))
+      )
     );
   } catch (error) {
     setHistoryStatus("无法写入本地存储。");
   }
 }
 
+function buildHistoryItem(entry, index) {
+  const item = document.createElement("div");
+  item.className = "history-item";
+  item.style.top = `${index * HISTORY_ROW_HEIGHT}px`;
+  const meta = document.createElement("div");
+  meta.className = "history-meta";
+  const badge = document.createElement("span");
+  badge.className = "history-badge";
+  badge.textContent = "用户输入";
+  const time = document.createElement("span");
+  time.textContent = new Date(entry.ts).toLocaleString();
+  meta.appendChild(badge);
+  meta.appendChild(time);
+  item.appendChild(meta);
+
+  const text = document.createElement("div");
+  text.className = "history-text";
+  text.textContent = entry.text;
+  text.title = entry.text;
+  item.appendChild(text);
+
+  const actions = document.createElement("div");
+  actions.className = "history-actions";
+  const copyBtn = document.createElement("button");
+  copyBtn.type = "button";
+  copyBtn.className = "btn btn--ghost btn--small";
+  copyBtn.textContent = "复制";
+  copyBtn.dataset.action = "copy";
+  copyBtn.dataset.index = String(index);
+
+  const fillBtn = document.createElement("button");
+  fillBtn.type = "button";
+  fillBtn.className = "btn btn--ghost btn--small";
+  fillBtn.textContent = "填入输入框";
+  fillBtn.dataset.action = "fill";
+  fillBtn.dataset.index = String(index);
+
+  actions.appendChild(copyBtn);
+  actions.appendChild(fillBtn);
+  item.appendChild(actions);
+  return item;
+}
+
+function renderHistoryWindow() {
+  // 只渲染可视区域附近的行，滚动时按固定行高换算起止下标。
+  state.historyFrame = 0;
+  if (!historyList) return;
+  const matches = state.historyMatches;
+  const viewport = historyList.clientHeight || HISTORY_ROW_HEIGHT * 3;
+  const first = Math.max(0, Math.floor(historyList.scrollTop / HISTORY_ROW_HEIGHT) - HISTORY_OVERSCAN);
+  const last = Math.min(
+    matches.length,
+    Math.ceil((historyList.scrollTop + viewport) / HISTORY_ROW_HEIGHT) + HISTORY_OVERSCAN
+  );
+  const fragment = document.createDocumentFragment();
+  for (let index = first; index < last; index += 1) {
+    fragment.appendChild(buildHistoryItem(matches[index], index));
+  }
+  historyWindow.replaceChildren(fragment);
+}
+
+function scheduleHistoryWindow() {
+  if (state.historyFrame) return;
+  state.historyFrame = requestAnimationFrame(renderHistoryWindow);
+}
+
 function renderInputHistory() {
   if (!historyList) return;
   const filter = (state.historyFilter || "").toLowerCase();
-  const filtered = state.inputHistory.filter((item) =>
-    item.text.toLowerCase().includes(filter)
-  );
-  historyList.innerHTML = "";
-  if (!filtered.length) {
+  state.historyMatches = filter
+    ? state.inputHistory.filter((item) => item.lower.includes(filter))
+    : state.inputHistory;
+  if (!state.historyMatches.length) {
     const empty = document.createElement("div");
     empty.className = "history-empty";
     empty.textContent = state.inputHistory.length
       ? "未找到匹配的记录。"
       : "暂无记录。";
-    historyList.appendChild(empty);
+    historyList.replaceChildren(empty);
   } else {
-    filtered.forEach((entry) => {
-      const item = document.createElement("div");
-      item.className = "history-item";
-      const meta = document.createElement("div");
-      meta.className = "history-meta";
-      const badge = document.createElement("span");
-      badge.className = "history-badge";
-      badge.textContent = "用户输入";
-      const time = document.createElement("span");
-      time.textContent = new Date(entry.ts).toLocaleString();
-      meta.appendChild(badge);
-      meta.appendChild(time);
-      item.appendChild(meta);
-
-      const text = document.createElement("div");
-      text.className = "history-text";
-      text.textContent = entry.text;
-      item.appendChild(text);
-
-      const actions = document.createElement("div");
-      actions.className = "history-actions";
-      const copyBtn = document.createElement("button");
-      copyBtn.type = "button";
-      copyBtn.className = "btn btn--ghost btn--small";
-      copyBtn.textContent = "复制";
-      copyBtn.addEventListener("click", () => copyText(entry.text));
-
-      const fillBtn = document.createElement("button");
-      fillBtn.type = "button";
-      fillBtn.className = "btn btn--ghost btn--small";
-      fillBtn.textContent = "填入输入框";
-      fillBtn.addEventListener("click", () => fillInputFromHistory(entry.text));
-
-      actions.appendChild(copyBtn);
-      actions.appendChild(fillBtn);
-      item.appendChild(actions);
-
-      historyList.appendChild(item);
-    });
+    if (historySpacer.parentNode !== historyList) {
+      historyList.replaceChildren(historySpacer, historyWindow);
+    }
+    historySpacer.style.height = `${state.historyMatches.length * HISTORY_ROW_HEIGHT}px`;
+    renderHistoryWindow();
   }
   setHistoryStatus(`已保存 ${state.inputHistory.length} 条`);
 }
 
+function handleHistoryClick(event) {
+  const button = event.target.closest("button[data-action]");
+  if (!button) return;
+  const entry = state.historyMatches[Number(button.dataset.index)];
+  if (!entry) return;
+  if (button.dataset.action === "copy") {
+    copyText(entry.text);
+  } else if (button.dataset.action === "fill") {
+    fillInputFromHistory(entry.text);
+  }
+}
+
 function addUserInputToHistory(text) {
   const normalized = (text || "").trim();
   if (!normalized) return;
-  state.inputHistory.unshift({ text: normalized, ts: Date.now() });
+  state.inputHistory.unshift(createHistoryEntry(normalized, Date.now()));
   if (state.inputHistory.length > HISTORY_LIMIT) {
     state.inputHistory.length = HISTORY_LIMIT;
   }
@@ -232,11 +292,18 @@ function toggleHistoryPanel() {
   if (!historySection) return;
   const collapsed = historySection.classList.toggle("history--collapsed");
   updateHistoryToggleLabel(collapsed);
+  if (!collapsed) {
+    renderHistoryWindow();
+  }
 }
 
 function handleHistorySearch(event) {
   state.historyFilter = event.target.value || "";
-  renderInputHistory();
+  clearTimeout(state.historySearchTimer);
+  state.historySearchTimer = setTimeout(() => {
+    if (historyList) historyList.scrollTop = 0;
+    renderInputHistory();
+  }, HISTORY_SEARCH_DEBOUNCE_MS);
 }
 
 function fillInputFromHistory(text) {
@@ -254,21 +321,24 @@ function initHistoryPanel() {
   }
 }
 
-async function postJson(url, payload) {
+async function postJson(url, payload, signal) {
   const response = await fetch(url, {
     method: "POST",
     headers: { "Content-Type": "application/json" },
     body: JSON.stringify(payload),
+    signal,
   });
   const data = await response.json();
   if (!response.ok) {
-    throw new Error(data.error || "请求失败");
+    const error = new Error(data.error || "请求失败");
+    error.status = response.status;
+    throw error;
   }
   return data;
 }
 
-async function getJson(url) {
-  const response = await fetch(url);
+async function getJson(url, signal) {
+  const response = await fetch(url, { signal });
   const data = await response.json();
   if (!response.ok) {
     throw new Error(data.error || "请求失败");
@@ -276,6 +346,32 @@ async function getJson(url) {
   return data;
 }
 
+function beginRequest(name) {
+  // 同名请求只保留最新的一个，之前未完成的直接取消。
+  const previous = state.requests[name];
+  if (previous) previous.abort();
+  const controller = new AbortController();
+  state.requests[name] = controller;
+  return controller;
+}
+
+function finishRequest(name, controller) {
+  if (state.requests[name] !== controller) return false;
+  delete state.requests[name];
+  return true;
+}
+
+function cancelRequest(name) {
+  const controller = state.requests[name];
+  if (!controller) return;
+  controller.abort();
+  delete state.requests[name];
+}
+
+function isAbortError(error) {
+  return Boolean(error) && error.name === "AbortError";
+}
+
 function loadStoredConfig(key) {
   try {
     const raw = sessionStorage.getItem(key);
@@ -585,6 +681,42 @@ function handlePromptTransferSelect(path) {
   state.transferContent = "";
 }
 
+function sleep(ms, signal) {
+  return new Promise((resolve, reject) => {
+    const timer = setTimeout(resolve, ms);
+    if (signal) {
+      signal.addEventListener(
+        "abort",
+        () => {
+          clearTimeout(timer);
+          reject(new DOMException("Aborted", "AbortError"));
+        },
+        { once: true }
+      );
+    }
+  });
+}
+
+async function waitImageJob(jobId, signal) {
+  while (true) {
+    const job = await getJson(`/api/image_jobs/${encodeURIComponent(jobId)}`, signal);
+    if (job.status === "done" || job.status === "failed") {
+      return job;
+    }
+    const finished = (job.completed || 0) + (job.failed || 0);
+    setStatus(`正在调用生图模型...（${finished}/${job.total || 1}）`, "status--loading");
+    await sleep(IMAGE_JOB_POLL_MS, signal);
+  }
+}
+
+function collectJobImages(job) {
+  const images = [];
+  (job.variants || []).forEach((variant) => {
+    (variant.images || []).forEach((img) => images.push(img));
+  });
+  return images;
+}
+
 async function handleTransferToImage() {
   if (!state.transferContent) {
     setStatus("没有可发送的内容。", "status--warn");
@@ -596,6 +728,7 @@ async function handleTransferToImage() {
     return;
   }
   setStatus("正在调用生图模型...", "status--loading");
+  const controller = beginRequest("image");
   try {
     const payload = {
       prompt: state.transferContent,
@@ -605,102 +738,129 @@ async function handleTransferToImage() {
         base_url: config.base_url,
       },
     };
-    const data = await postJson("/api/image_generate", payload);
-    addMessage("assistant", data.reply || "已生成图片。", "image", data.images || []);
-    setStatus("已生成图片。", "status--ok");
     closeModal(promptTransferModal);
     state.transferContent = "";
+    const submitted = await postJson("/api/image_jobs", payload, controller.signal);
+    const job = await waitImageJob(submitted.job_id, controller.signal);
+    const images = collectJobImages(job);
+    if (!images.length) {
+      const failed = (job.variants || []).find((variant) => variant.error);
+      throw new Error((failed && failed.error) || "未返回图片数据。");
+    }
+    const cached = (job.variants || []).every((variant) => variant.cached);
+    addMessage(
+      "assistant",
+      `已生成 ${images.length} 张图片。${cached ? "（命中缓存）" : ""}`,
+      "image",
+      images
+    );
+    setStatus("已生成图片。", "status--ok");
   } catch (error) {
-    setStatus(error.message, "status--warn");
+    if (!isAbortError(error)) {
+      setStatus(error.message, "status--warn");
+    }
+  } finally {
+    finishRequest("image", controller);
   }
 }
 
-function renderMessages() {
-  chatList.innerHTML = "";
-  state.messages.forEach((message) => {
-    const bubble = document.createElement("div");
-    bubble.className = "chat__bubble";
-    bubble.classList.add(
-      message.role === "user" ? "chat__bubble--user" : "chat__bubble--assistant"
+function buildMessageBubble(message) {
+  const bubble = document.createElement("div");
+  bubble.className = "chat__bubble";
+  bubble.classList.add(
+    message.role === "user" ? "chat__bubble--user" : "chat__bubble--assistant"
+  );
+  const meta = document.createElement("div");
+  meta.className = "chat__meta";
+  const label =
+    message.role === "user"
+      ? "你"
+      : message.source === "image"
+      ? "生图模型"
+      : "模型";
+  meta.textContent = `${label} ${message.ts || ""}`.trim();
+  bubble.appendChild(meta);
+  if (message.content) {
+    const text = document.createElement("div");
+    text.className = "chat__text";
+    text.textContent = message.content || "";
+    bubble.appendChild(text);
+  }
+  if (Array.isArray(message.images) && message.images.length) {
+    const images = document.createElement("div");
+    images.className = "chat__images";
+    message.images.forEach((img) => {
+      if (!img || !img.value) return;
+      const imageEl = document.createElement("img");
+      imageEl.className = "chat__image";
+      imageEl.loading = "lazy";
+      imageEl.decoding = "async";
+      if (img.type === "b64") {
+        const fmt = (img.format || "png").toLowerCase();
+        imageEl.src = `data:image/${fmt};base64,${img.value}`;
+      } else {
+        imageEl.src = img.value;
+      }
+      imageEl.alt = "生成图片";
+      images.appendChild(imageEl);
+    });
+    bubble.appendChild(images);
+  }
+  if (message.role === "assistant") {
+    const actions = document.createElement("div");
+    actions.className = "chat__actions chat__actions--inline";
+    const copyBtn = document.createElement("button");
+    copyBtn.type = "button";
+    copyBtn.className = "btn btn--ghost btn--small";
+    copyBtn.textContent = "复制";
+    copyBtn.addEventListener("click", () => copyText(message.content || ""));
+    const transferBtn = document.createElement("button");
+    transferBtn.type = "button";
+    transferBtn.className = "btn btn--ghost btn--small";
+    transferBtn.textContent = "发送至";
+    transferBtn.addEventListener("click", () =>
+      openPromptTransferModal(message.content || "", bubble)
     );
-    const meta = document.createElement("div");
-    meta.className = "chat__meta";
-    const label =
-      message.role === "user"
-        ? "你"
-        : message.source === "image"
-        ? "生图模型"
-        : "模型";
-    meta.textContent = `${label} ${message.ts || ""}`.trim();
-    bubble.appendChild(meta);
-    if (message.content) {
-      const text = document.createElement("div");
-      text.className = "chat__text";
-      text.textContent = message.content || "";
-      bubble.appendChild(text);
-    }
-    if (Array.isArray(message.images) && message.images.length) {
-      const images = document.createElement("div");
-      images.className = "chat__images";
-      message.images.forEach((img) => {
-        if (!img || !img.value) return;
-        const imageEl = document.createElement("img");
-        imageEl.className = "chat__image";
-        if (img.type === "b64") {
-          const fmt = (img.format || "png").toLowerCase();
-          imageEl.src = `data:image/${fmt};base64,${img.value}`;
-        } else {
-          imageEl.src = img.value;
-        }
-        imageEl.alt = "生成图片";
-        images.appendChild(imageEl);
-      });
-      bubble.appendChild(images);
-    }
-    if (message.role === "assistant") {
-      const actions = document.createElement("div");
-      actions.className = "chat__actions chat__actions--inline";
-      const copyBtn = document.createElement("button");
-      copyBtn.type = "button";
-      copyBtn.className = "btn btn--ghost btn--small";
-      copyBtn.textContent = "复制";
-      copyBtn.addEventListener("click", () => copyText(message.content || ""));
-      const transferBtn = document.createElement("button");
-      transferBtn.type = "button";
-      transferBtn.className = "btn btn--ghost btn--small";
-      transferBtn.textContent = "发送至";
-      transferBtn.addEventListener("click", () =>
-        openPromptTransferModal(message.content || "", bubble)
-      );
-      actions.appendChild(copyBtn);
-      actions.appendChild(transferBtn);
-      bubble.appendChild(actions);
-    }
-    chatList.appendChild(bubble);
-  });
+    actions.appendChild(copyBtn);
+    actions.appendChild(transferBtn);
+    bubble.appendChild(actions);
+  }
+  return bubble;
+}
+
+function updateChatCount() {
   if (chatCount) {
     chatCount.textContent = `${state.messages.length} 条消息`;
   }
+}
+
+function renderMessages() {
+  const fragment = document.createDocumentFragment();
+  state.messages.forEach((message) => fragment.appendChild(buildMessageBubble(message)));
+  chatList.replaceChildren(fragment);
+  updateChatCount();
   chatList.scrollTop = chatList.scrollHeight;
 }
 
 function addMessage(role, content, source = "", images = []) {
-  state.messages.push({
+  const message = {
     role,
     content: content || "",
     ts: new Date().toLocaleString(),
     source,
     images: Array.isArray(images) ? images : [],
-  });
-  renderMessages();
+  };
+  state.messages.push(message);
+  // 新消息只追加一个气泡，已有气泡与图片不重建。
+  chatList.appendChild(buildMessageBubble(message));
+  updateChatCount();
+  chatList.scrollTop = chatList.scrollHeight;
 }
 
-function buildChatPayload(config) {
-  return {
-    messages: state.messages.map((msg) => ({
-      role: msg.role,
-      content: msg.content,
-    })),
+function buildChatPayload(config, text) {
+  // 历史由服务端保存，每轮只发送新消息；没有对话标识时带上已有消息建立新对话。
+  const payload = {
+    message: text,
     config: {
       api_key: config.api_key,
       model: config.model,
@@ -709,6 +869,15 @@ function buildChatPayload(config) {
       prompt_path: state.config.prompt_path,
     },
   };
+  if (state.conversationId) {
+    payload.conversation_id = state.conversationId;
+  } else {
+    payload.history = state.messages.slice(0, -1).map((msg) => ({
+      role: msg.role,
+      content: msg.content,
+    }));
+  }
+  return payload;
 }
 
 async function sendMessage(target = "language") {
@@ -734,20 +903,36 @@ async function sendMessage(target = "language") {
   chatInput.value = "";
   setStatus(target === "image" ? "正在调用生图模型..." : "正在生成回复...", "status--loading");
   sendBtn.disabled = true;
+  const controller = beginRequest("chat");
   try {
-    const payload = buildChatPayload(config);
-    const data = await postJson("/api/chat", payload);
+    let data;
+    try {
+      data = await postJson("/api/chat", buildChatPayload(config, text), controller.signal);
+    } catch (error) {
+      if (error.status !== 404 || !state.conversationId) throw error;
+      // 服务端对话已过期，用本地消息重建一次。
+      state.conversationId = "";
+      data = await postJson("/api/chat", buildChatPayload(config, text), controller.signal);
+    }
+    state.conversationId = data.conversation_id || "";
     addMessage("assistant", data.reply || "", target === "image" ? "image" : "language");
     setStatus("已生成回复。", "status--ok");
   } catch (error) {
-    setStatus(error.message, "status--warn");
+    if (!isAbortError(error)) {
+      setStatus(error.message, "status--warn");
+    }
   } finally {
-    sendBtn.disabled = false;
+    if (finishRequest("chat", controller)) {
+      sendBtn.disabled = false;
+    }
   }
 }
 
 function clearChat() {
+  cancelRequest("chat");
+  sendBtn.disabled = false;
   state.messages = [];
+  state.conversationId = "";
   renderMessages();
   setStatus("已清空对话。", "status--ok");
 }
@@ -821,6 +1006,10 @@ if (toggleHistoryBtn) {
 if (historySearch) {
   historySearch.addEventListener("input", handleHistorySearch);
 }
+if (historyList) {
+  historyList.addEventListener("scroll", scheduleHistoryWindow, { passive: true });
+  historyList.addEventListener("click", handleHistoryClick);
+}
 
 lmConfigBtn.addEventListener("click", () => openModal(lmConfigModal));
 imgConfigBtn.addEventListener("click", () => openModal(imgConfigModal));